@@ -6,7 +6,7 @@
 # - Forzamos --out al ejecutar lote/test
 # - Bloque de WebUI sólo visible con proveedor automatic1111
 # - Selector de CSV de prompts (por defecto PROJECT/prompts_template.csv)
-import os, sys, subprocess, threading, time, webbrowser, yaml, pathlib, requests, shutil, tkinter as tk
+import os, sys, signal, subprocess, threading, time, webbrowser, yaml, pathlib, requests, shutil, sqlite3, queue, socket, json, hashlib, tkinter as tk
 from tkinter import messagebox
 from tkinter import filedialog, scrolledtext, simpledialog
 from tkinter import ttk
@@ -47,18 +47,60 @@ def read_env():
 def write_env(d: dict):
     ENV.write_text("\n".join(f"{k}={v}" for k,v in d.items() if v) + "\n", encoding="utf-8")
 
-def ensure_venv_and_reqs(log):
-    venv_py = KIT / ".venv" / "Scripts" / "python.exe"
-    if not venv_py.exists():
+VENV = KIT / ".venv"
+VENV_STAMP = VENV / "batchkit-ready.json"   # huella del entorno ya preparado
+KIT_PACKAGES = ["pyyaml", "requests", "tqdm", "pillow", "python-dotenv", "ttkbootstrap"]
+
+def venv_fingerprint():
+    """
+    Huella del entorno sin lanzar procesos: requirements.txt, paquetes del kit, pyvenv.cfg
+    (versión del intérprete) y los *.dist-info instalados (nombre y versión de cada paquete).
+    """
+    h = hashlib.sha256()
+    req = KIT / "requirements.txt"
+    h.update(req.read_bytes() if req.exists() else b"")
+    h.update(" ".join(KIT_PACKAGES).encode())
+    cfg = VENV / "pyvenv.cfg"
+    h.update(cfg.read_bytes() if cfg.exists() else b"")
+    for site in (VENV / "Lib" / "site-packages", *(VENV / "lib").glob("python*/site-packages")):
+        if site.is_dir():
+            h.update("\n".join(sorted(e.name for e in os.scandir(site) if e.name.endswith(".dist-info"))).encode())
+    return h.hexdigest()
+
+def venv_ready():
+    try:
+        return json.loads(VENV_STAMP.read_text(encoding="utf-8")).get("fingerprint") == venv_fingerprint()
+    except (OSError, ValueError):
+        return False
+
+def ensure_venv_and_reqs(log, repair=False):
+    """
+    Crea el venv del kit e instala dependencias sólo si algo cambió desde la última vez (huella en
+    .venv/batchkit-ready.json); si no, vuelve enseguida. repair=True lo rehace todo: recrea el venv
+    si su intérprete no arranca, actualiza pip, reinstala y ejecuta pip check.
+    """
+    venv_py = VENV / "Scripts" / "python.exe"
+    if not repair and venv_py.exists() and venv_ready():
+        return str(venv_py)
+    if repair and venv_py.exists() and subprocess.call([str(venv_py), "-c", "pass"]) != 0:
+        log("El intérprete del venv no arranca; se recrea…")
+        subprocess.check_call([sys.executable, "-m", "venv", "--clear", str(VENV)])
+    created = not venv_py.exists()
+    if created:
         log("Creando venv del kit…")
-        subprocess.check_call([sys.executable, "-m", "venv", str(KIT/".venv")])
+        subprocess.check_call([sys.executable, "-m", "venv", str(VENV)])
     py = str(venv_py)
-    log("Preparando entorno (solo la primera vez)…")
-    subprocess.check_call([py, "-m", "pip", "install", "--upgrade", "pip"])
+    log("Reparando entorno…" if repair else "Preparando entorno (requirements.txt o paquetes cambiaron)…")
+    if created or repair:
+        subprocess.check_call([py, "-m", "pip", "install", "--upgrade", "pip"])
     req = KIT / "requirements.txt"
     if req.exists():
         subprocess.check_call([py, "-m", "pip", "install", "-r", str(req)])
-    subprocess.check_call([py, "-m", "pip", "install", "pyyaml", "requests", "tqdm", "pillow", "python-dotenv", "ttkbootstrap"])
+    subprocess.check_call([py, "-m", "pip", "install", *KIT_PACKAGES])
+    if repair and subprocess.call([py, "-m", "pip", "check"]) != 0:
+        log("pip check encontró dependencias incompatibles (ver consola).")
+    VENV_STAMP.write_text(json.dumps({"fingerprint": venv_fingerprint(), "time": time.time()}), encoding="utf-8")
+    log("Entorno listo.")
     return py
 
 def _abs_out_from_gui(outdir_str: str) -> pathlib.Path:
@@ -144,16 +186,16 @@ class Tooltip:
         if self.tip: self.tip.destroy(); self.tip = None
 
 # --------- WebUI / A1111 ----------
-def api_alive(api_base="http://127.0.0.1:7860"):
+def api_alive(api_base="http://127.0.0.1:7860", session=None):
     try:
-        r = requests.get(f"{api_base}/sdapi/v1/progress?skip_current_image=true", timeout=2)
+        r = (session or requests).get(f"{api_base}/sdapi/v1/progress?skip_current_image=true", timeout=2)
         return r.status_code == 200
     except Exception:
         return False
 
-def fetch_samplers(api_base, log=lambda *_: None):
+def fetch_samplers(api_base, log=lambda *_: None, session=None):
     try:
-        r = requests.get(f"{api_base}/sdapi/v1/samplers", timeout=4)
+        r = (session or requests).get(f"{api_base}/sdapi/v1/samplers", timeout=4)
         r.raise_for_status()
         data = r.json()
         names = [s.get("name","") for s in data if s.get("name")]
@@ -162,35 +204,147 @@ def fetch_samplers(api_base, log=lambda *_: None):
         log(f"No se pudieron obtener samplers desde {api_base}: {e}")
         return []
 
+WEBUI_LOG = "batchkit-webui.log"   # copia de la consola de la WebUI, en su carpeta
+WEBUI_EXIT_MARKER = "[batchkit] WebUI exited with code"  # lo escribe webui_console.py al terminar
+
 def start_webui(webui_dir, log):
+    """
+    Lanza webui-user.bat en su propia consola, a través de webui_console.py, que muestra la salida
+    y la copia a WEBUI_LOG (la sigue WebUIWatcher). El proceso no depende de la GUI.
+    """
     bat = pathlib.Path(webui_dir) / "webui-user.bat"
     if not bat.exists():
         log("ERROR: no encuentro webui-user.bat en esa carpeta.")
         return None
 
-    log("Arrancando Stable Diffusion WebUI (consola visible)…")
+    log_path = pathlib.Path(webui_dir) / WEBUI_LOG
+    log(f"Arrancando Stable Diffusion WebUI en su consola (copia en {log_path})…")
+    try:
+        log_path.unlink()  # el vigilante no debe leer el arranque anterior
+    except OSError:
+        pass
 
+    venv_py = KIT / ".venv" / "Scripts" / "python.exe"
+    py = str(venv_py) if venv_py.exists() else sys.executable
     return subprocess.Popen(
-        [
-            "cmd.exe",
-            "/k",
-            "call",
-            str(bat)
-        ],
+        [py, str(KIT / "webui_console.py"), str(bat), str(log_path)],
         cwd=str(webui_dir),
         creationflags=subprocess.CREATE_NEW_CONSOLE
     )
 
-def wait_api_ready(api_base, seconds=60, log=lambda *_: None):
-    for _ in range(seconds):
-        if api_alive(api_base): break
-        time.sleep(1)
-    else:
-        return "timeout_api"
-    for _ in range(seconds):
-        if fetch_samplers(api_base, log): return "ready"
-        time.sleep(1)
-    return "api_up_initializing"
+# Marcadores de la consola de A1111: API levantada (Gradio, con --api) y modelo cargado
+WEBUI_API_MARKERS = ("Running on local URL", "Running on public URL")
+WEBUI_MODEL_MARKERS = ("Model loaded in",)
+WEBUI_ERROR_MARKERS = ("Traceback", "Error", "ERROR")
+
+class WebUIWatcher:
+    """
+    Detecta cuándo está lista la WebUI sin bloquear a quien la arranca. Sigue la copia de su
+    consola (log_path, si se le pasa proc) buscando los marcadores de API y de modelo cargado y,
+    en paralelo, sondea la API con backoff exponencial sobre una única sesión HTTP (nodos ya
+    arrancados o remotos); un marcador despierta al sondeo para confirmarlo al momento. Al log
+    de la GUI sólo pasan esas líneas y las de error. stop() lo detiene (cierre de la ventana).
+    on_state(watcher, estado) se llama desde sus hilos, una vez por estado y en orden:
+    "api_up" (API responde; el modelo puede seguir cargando), "ready" (modelo/samplers listos),
+    y si no se llega a "ready": "timeout" o "exited" (la WebUI terminó).
+    """
+    def __init__(self, api_base, on_state, proc=None, timeout=300, log=lambda *_: None, log_path=None):
+        self.api_base = api_base
+        self.on_state = on_state
+        self.log = log
+        self.deadline = time.time() + timeout
+        self.session = requests.Session()
+        self.samplers = []
+        self.states = []
+        self.model_loaded = False  # visto en consola; cuenta como "ready" en cuanto responda la API
+        self._lock = threading.Lock()
+        self.wake = threading.Event()
+        self.done = threading.Event()
+        if proc is not None and log_path is not None:
+            threading.Thread(target=self._tail_log, args=(proc, pathlib.Path(log_path)), daemon=True).start()
+        threading.Thread(target=self._probe, daemon=True).start()
+
+    def _set(self, state):
+        with self._lock:
+            if state in self.states or self.done.is_set():
+                return
+            self.states.append(state)
+            if state in ("ready", "timeout", "exited"):
+                self.done.set()
+        self.wake.set()
+        self.on_state(self, state)
+
+    def stop(self):
+        with self._lock:
+            self.done.set()
+        self.wake.set()
+
+    def _tail_log(self, proc, log_path):
+        f, pending = None, b""
+        try:
+            while not self.done.is_set():
+                if f is None:
+                    try:
+                        f = open(log_path, "rb")
+                    except OSError:
+                        f = None  # webui_console.py aún no lo ha creado
+                chunk = f.read() if f is not None else b""
+                if not chunk:
+                    if proc.poll() is not None:
+                        self._set("exited")  # consola cerrada
+                        return
+                    time.sleep(0.25)
+                    continue
+                *lines, pending = (pending + chunk).split(b"\n")
+                for line in lines:
+                    self._console_line(last_line_state(line))
+        finally:
+            if f is not None:
+                f.close()
+
+    def _console_line(self, txt):
+        if not txt:
+            return
+        if txt.startswith(WEBUI_EXIT_MARKER):
+            self._set("exited")
+        elif any(m in txt for m in WEBUI_API_MARKERS):
+            self.log(f"[WebUI] {txt}")
+            self.wake.set()  # el sondeo lo confirma ya, sin esperar su siguiente intento
+        elif any(m in txt for m in WEBUI_MODEL_MARKERS):
+            self.log(f"[WebUI] {txt}")
+            self.model_loaded = True
+            self.wake.set()
+        elif any(m in txt for m in WEBUI_ERROR_MARKERS):
+            self.log(f"[WebUI] {txt}")
+
+    def _probe(self):
+        delay = 0.25
+        while not self.done.is_set():
+            if "api_up" not in self.states:
+                if api_alive(self.api_base, self.session):
+                    self._set("api_up")
+                    if self.model_loaded:
+                        self._set("ready")
+                        break
+                    delay = 0.25
+                    continue
+            elif self.model_loaded:
+                self._set("ready")
+                break
+            else:
+                sams = fetch_samplers(self.api_base, session=self.session)
+                if sams:
+                    self.samplers = sams
+                    self._set("ready")
+                    break
+            left = self.deadline - time.time()
+            if left <= 0:
+                self._set("timeout")
+                break
+            self.wake.wait(min(delay, left))
+            self.wake.clear()
+            delay = min(delay * 2, 4.0)
+        self.session.close()
 
 def taskkill_tree(pid, log):
     try:
@@ -201,15 +355,25 @@ def taskkill_tree(pid, log):
         log(f"ERROR al finalizar PID {pid}: {e}")
 
 # --------- ejecución de lote ----------
+def last_line_state(line: bytes) -> str:
+    """tqdm redibuja la barra con \r dentro de una misma línea: sólo interesa el último estado."""
+    segs = [t for t in line.decode(errors="ignore").split("\r") if t.strip()]
+    return segs[-1].rstrip() if segs else ""
+
+
 def run_batch(log, provider: str, size_override=None, set_batch_proc=None, on_finish=None,
-              prompts_path="prompts.csv", extra_args=None):
+              prompts_path="prompts.csv", extra_args=None, on_event=None):
     def _target():
+        listener = None
         try:
             venv_py = KIT / ".venv" / "Scripts" / "python.exe"
             py = str(venv_py) if venv_py.exists() else sys.executable
             cmd = [py,"generator.py","--provider",provider,"--prompts",prompts_path,"--config","config.yaml"]
             if size_override: cmd += ["--size", size_override]
             if extra_args:    cmd += list(extra_args)
+            if on_event:
+                listener = EventListener(on_event)
+                cmd += ["--events", listener.address]
             log("")
             log(f"Lanzando lote con proveedor: {provider} …")
             proc = subprocess.Popen(cmd, cwd=str(KIT),
@@ -217,19 +381,231 @@ def run_batch(log, provider: str, size_override=None, set_batch_proc=None, on_fi
                                     creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
             if set_batch_proc: set_batch_proc(proc)
             for line in iter(proc.stdout.readline, b""):
-                txt = line.decode(errors="ignore").rstrip()
+                txt = last_line_state(line)
                 if txt: log(txt)
             rc = proc.wait()
+            if listener: listener.close()  # on_finish ya ve todos los eventos
             log("Lote terminado." if rc==0 else f"ERROR: generator salió con código {rc}")
             log("")
         except Exception as e:
             log(f"ERROR: {e}")
             log("")
         finally:
+            if listener: listener.close()
             if set_batch_proc: set_batch_proc(None)
             if on_finish: on_finish()
     threading.Thread(target=_target, daemon=True).start()
 
+# --------- progreso (generator.py --events) ----------
+class EventListener:
+    """
+    Socket local para generator.py --events: lee sus eventos JSON (uno por línea) en un hilo y
+    llama a on_event con cada uno, desde ese hilo. close() espera a que se lean los últimos.
+    """
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.srv = socket.create_server(("127.0.0.1", 0))
+        self.address = f"127.0.0.1:{self.srv.getsockname()[1]}"
+        self.readers = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.srv.accept()
+            except OSError:
+                return  # cerrado
+            t = threading.Thread(target=self._read, args=(conn,), daemon=True)
+            self.readers.append(t)
+            t.start()
+
+    def _read(self, conn):
+        with conn, conn.makefile("rb") as f:
+            for line in f:
+                try:
+                    ev = json.loads(line)
+                except ValueError:
+                    continue
+                self.on_event(ev)
+
+    def close(self, timeout=5):
+        self.srv.close()
+        for t in list(self.readers):
+            t.join(timeout)
+
+class BatchProgress:
+    """Estado del lote según los eventos: réplicas resueltas de total, img/min y ETA."""
+    def __init__(self):
+        self.total = None
+        self.done = 0        # finished + failed + skipped (réplicas)
+        self.finished = 0
+        self.failed = 0
+        self.bytes = 0
+        self.t0 = None
+        self.last_file = None
+        self.ended = False
+
+    def update(self, ev):
+        kind = ev.get("event")
+        n = int(ev.get("count") or 1)
+        if kind == "batch":
+            self.total = ev.get("total")
+        elif kind == "started" and self.t0 is None:
+            self.t0 = time.time()
+        elif kind == "finished":
+            self.done += n; self.finished += n
+            self.bytes += ev.get("bytes") or 0
+            self.last_file = ev.get("file_path")
+        elif kind == "failed":
+            self.done += n; self.failed += n
+        elif kind == "skipped":
+            self.done += n
+        elif kind == "done":
+            self.ended = True
+
+    def per_minute(self):
+        if self.t0 is None or not self.finished:
+            return 0.0
+        return self.finished / max(1e-6, time.time() - self.t0) * 60
+
+    def text(self):
+        parts = [f"{self.done}/{self.total}" if self.total else f"{self.done}"]
+        rate = self.per_minute()
+        if rate:
+            parts.append(f"{rate:.1f} img/min")
+        if self.total and rate and not self.ended:
+            left = max(0, self.total - self.done) / rate * 60
+            parts.append(f"ETA {int(left // 3600):02d}:{int(left % 3600 // 60):02d}:{int(left % 60):02d}")
+        if self.failed:
+            parts.append(f"{self.failed} con error")
+        if self.bytes:
+            parts.append(f"{self.bytes / 2**20:.1f} MB")
+        return " · ".join(parts)
+
+# --------- log de la GUI ----------
+LOG_MAX_LINES = 5000   # scrollback del log (las líneas más antiguas se descartan)
+LOG_FLUSH_MS = 100     # como mucho un repintado del log cada LOG_FLUSH_MS
+
+class LogSink:
+    """
+    Log thread-safe para el ScrolledText: cualquier hilo encola líneas con put() y el hilo de Tk
+    las vuelca por lotes cada LOG_FLUSH_MS con after() (un insert por lote), recortando el
+    scrollback a LOG_MAX_LINES. Sólo baja al final si el usuario ya estaba abajo.
+    """
+    def __init__(self, widget, max_lines=LOG_MAX_LINES, interval_ms=LOG_FLUSH_MS):
+        self.widget = widget
+        self.max_lines = max_lines
+        self.interval_ms = interval_ms
+        self.q = queue.SimpleQueue()
+        self.lines = 0
+        self.widget.after(self.interval_ms, self._drain)
+
+    def put(self, msg):
+        self.q.put(str(msg))
+
+    def clear(self):
+        """Desde el hilo de Tk: vacía el widget y lo pendiente."""
+        self._take()
+        self.widget.configure(state="normal"); self.widget.delete("1.0", tk.END); self.widget.configure(state="disabled")
+        self.lines = 0
+
+    def _take(self):
+        batch = []
+        for _ in range(self.q.qsize()):  # sólo lo que hay ahora: si los hilos escriben sin parar, no se queda aquí
+            try:
+                batch.append(self.q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        try:
+            batch = self._take()
+            if batch:
+                text = "\n".join(batch).split("\n")[-self.max_lines:]
+                w = self.widget
+                follow = w.yview()[1] >= 0.999
+                w.configure(state="normal")
+                w.insert(tk.END, "\n".join(text) + "\n")
+                self.lines += len(text)
+                if self.lines > self.max_lines:
+                    w.delete("1.0", f"{self.lines - self.max_lines + 1}.0")
+                    self.lines = self.max_lines
+                if follow:
+                    w.see(tk.END)
+                w.configure(state="disabled")
+        except tk.TclError:
+            return  # ventana cerrada
+        self.widget.after(self.interval_ms, self._drain)
+
+# --------- servicio (generator.py --serve) ----------
+def service_base():
+    port = int((read_cfg().get("default") or {}).get("daemon_port", 7870))
+    return f"http://127.0.0.1:{port}"
+
+def service_headers(out_dir):
+    """Cabecera con el token del servicio; lo escribe generator.py --serve en <out_dir>/.daemon/token."""
+    try:
+        token = (pathlib.Path(out_dir) / ".daemon" / "token").read_text(encoding="utf-8").strip()
+    except OSError:
+        return {}
+    return {"X-Batchkit-Token": token}
+
+def service_alive(base):
+    try:
+        return requests.get(f"{base}/health", timeout=1).status_code == 200
+    except Exception:
+        return False
+
+def start_service(log, out_dir, set_proc=None):
+    """Arranca generator.py --serve en segundo plano y vuelca su salida al log."""
+    def _target():
+        try:
+            venv_py = KIT / ".venv" / "Scripts" / "python.exe"
+            py = str(venv_py) if venv_py.exists() else sys.executable
+            cmd = [py,"generator.py","--serve","--config","config.yaml","--out",out_dir]
+            log("Arrancando servicio de generación…")
+            proc = subprocess.Popen(cmd, cwd=str(KIT),
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+            if set_proc: set_proc(proc)
+            for line in iter(proc.stdout.readline, b""):
+                txt = last_line_state(line)
+                if txt: log(txt)
+            rc = proc.wait()
+            log("Servicio detenido." if rc==0 else f"ERROR: servicio salió con código {rc}")
+        except Exception as e:
+            log(f"ERROR: {e}")
+        finally:
+            if set_proc: set_proc(None)
+    threading.Thread(target=_target, daemon=True).start()
+
+def stop_proc(proc, log, done_msg):
+    # Ctrl+Break primero: generator.py vuelca y cierra el manifiesto antes de salir
+    try:
+        proc.send_signal(signal.CTRL_BREAK_EVENT)
+    except Exception:
+        taskkill_tree(proc.pid, log); return
+    def _ensure_dead():
+        try:
+            proc.wait(timeout=5)
+            log(done_msg)
+        except subprocess.TimeoutExpired:
+            taskkill_tree(proc.pid, log)
+    threading.Thread(target=_ensure_dead, daemon=True).start()
+
+# --------- estado del lote (ledger.sqlite) ----------
+def ledger_summary(path: pathlib.Path, limit=10):
+    """Réplicas por estado y las últimas que faltan; sólo lectura, no bloquea al lote en marcha."""
+    db = sqlite3.connect(f"file:{path.as_posix()}?mode=ro", uri=True, timeout=2)
+    try:
+        counts = dict(db.execute("SELECT status, COUNT(*) FROM replicates GROUP BY status").fetchall())
+        missing = db.execute("SELECT prompt_id, replicate_index, status, error FROM replicates "
+                             "WHERE status != 'done' ORDER BY updated DESC LIMIT ?", (limit,)).fetchall()
+    finally:
+        db.close()
+    return counts, missing
+
 # --------- UI ----------
 class App(tb.Window if tb else tk.Tk):
     def __init__(self):
@@ -246,7 +622,9 @@ class App(tb.Window if tb else tk.Tk):
         self.envd = read_env()
 
         self.webui_proc = None
+        self.webui_watchers = []
         self.batch_proc = None
+        self.service_proc = None
         self.running_batch = False
         self.env_ready = False
 
@@ -289,6 +667,12 @@ class App(tb.Window if tb else tk.Tk):
             value="" if d.get("temperature") is None else str(d.get("temperature"))
         )
         self.rand_var    = tk.BooleanVar(value=bool(d.get("randomize_order",True)))
+        self.engine_var  = tk.StringVar(value=d.get("engine","threads"))
+        self.dedup_var   = tk.StringVar(value=d.get("dedup") or "off")  # "off" sin comillas en YAML es False
+        self.cache_var   = tk.BooleanVar(value=bool(d.get("result_cache",False)))
+        self.format_var  = tk.StringVar(value=d.get("output_format","png"))
+        self.quality_var = tk.StringVar(value=str(d.get("output_quality",90)))
+        self.lossless_var = tk.BooleanVar(value=bool(d.get("output_lossless",False)))
 
         for v in (
             self.size_var,
@@ -297,19 +681,25 @@ class App(tb.Window if tb else tk.Tk):
             self.delay_var,
             self.seed_var,
             self.temp_var,
+            self.quality_var,
         ):
             v.trace_add("write", mark_dirty)
 
         self.rand_var.trace_add("write", mark_dirty)
+        self.engine_var.trace_add("write", mark_dirty)
+        self.dedup_var.trace_add("write", mark_dirty)
+        self.cache_var.trace_add("write", mark_dirty)
+        self.format_var.trace_add("write", mark_dirty)
+        self.lossless_var.trace_add("write", mark_dirty)
 
 
         # Fila 0
         add_cell(0, 0, "Size",        self.size_var,    10, "Tamaño WxH (p. ej. 512x512)")
         add_cell(0, 2, "Repeats",     self.repeats_var, 6,  "Nº de repeticiones por prompt")
-        add_cell(0, 4, "Concurrency", self.conc_var,    6,  "Prompts en paralelo")
+        add_cell(0, 4, "Concurrency", self.conc_var,    6,  "Peticiones en paralelo al proveedor (imágenes simultáneas)")
 
         # Fila 1
-        add_cell(1, 0, "Delay (s)",   self.delay_var,   6,  "Pausa entre llamadas")
+        add_cell(1, 0, "Delay (s)",   self.delay_var,   6,  "Intervalo mínimo entre peticiones al proveedor (0 = sin límite).\nEl ritmo se reduce solo ante 429/503 y se recupera después.")
         add_cell(1, 2, "Seed",        self.seed_var,    10, "Semilla (-1 = aleatoria)")
         add_cell(1, 4, "Temperature", self.temp_var,    6,  "Solo OpenAI / Stability")
 
@@ -318,6 +708,38 @@ class App(tb.Window if tb else tk.Tk):
         chk.grid(row=2, column=0, columnspan=2, sticky="w", padx=6, pady=6)
         Tooltip(chk, "Barajar el orden de los prompts")
 
+        ttk.Label(frm_def, text="Engine").grid(row=2, column=2, sticky="w", padx=(6,2), pady=6)
+        cb_engine = ttk.Combobox(frm_def, textvariable=self.engine_var, state="readonly",
+                                 values=["threads","async"], width=8)
+        cb_engine.grid(row=2, column=3, sticky="w", padx=(0,10), pady=6)
+        Tooltip(cb_engine, "threads: un hilo por petición en curso.\nasync: un único bucle asyncio; para Concurrency alta con OpenAI/Stability.")
+
+        # Fila 3
+        ttk.Label(frm_def, text="Dedup").grid(row=3, column=0, sticky="w", padx=(6,2), pady=6)
+        cb_dedup = ttk.Combobox(frm_def, textvariable=self.dedup_var, state="readonly",
+                                values=["off","hardlink","symlink","reference"], width=10)
+        cb_dedup.grid(row=3, column=1, sticky="w", padx=(0,10), pady=6)
+        Tooltip(cb_dedup, "Almacén por contenido en <out>/<proveedor>/objects/: cada imagen se guarda una vez.\n"
+                          "hardlink/symlink: la carpeta del prompt enlaza al objeto.\n"
+                          "reference: el manifiesto apunta directamente al objeto.")
+
+        chk_cache = ttk.Checkbutton(frm_def, text="Result cache", variable=self.cache_var)
+        chk_cache.grid(row=3, column=2, columnspan=2, sticky="w", padx=6, pady=6)
+        Tooltip(chk_cache, "Con Seed fija (>= 0), reutiliza las imágenes de peticiones idénticas ya generadas\n"
+                           "(A1111/Stability) sin llamar al proveedor. Se guarda en <out>/.cache/.")
+
+        # Fila 4
+        ttk.Label(frm_def, text="Formato").grid(row=4, column=0, sticky="w", padx=(6,2), pady=6)
+        cb_format = ttk.Combobox(frm_def, textvariable=self.format_var, state="readonly",
+                                 values=["png","webp","jpeg","avif"], width=8)
+        cb_format.grid(row=4, column=1, sticky="w", padx=(0,10), pady=6)
+        Tooltip(cb_format, "Formato de las imágenes guardadas.\npng: tal cual lo devuelve el proveedor.\n"
+                           "webp/jpeg/avif: se recodifican en el post-proceso (menos disco).")
+        add_cell(4, 2, "Calidad", self.quality_var, 6, "Calidad 0-100 para webp/jpeg/avif.\nCon Lossless: esfuerzo de compresión.")
+        chk_lossless = ttk.Checkbutton(frm_def, text="Lossless", variable=self.lossless_var)
+        chk_lossless.grid(row=4, column=4, sticky="w", padx=6, pady=6)
+        Tooltip(chk_lossless, "WebP sin pérdida")
+
         ttk.Button(
             frm_def,
             text="Guardar config.yaml",
@@ -416,11 +838,14 @@ class App(tb.Window if tb else tk.Tk):
 
         a = self.cfg.get("providers", {}).get("automatic1111", {})
 
-        self.auto_api_var     = tk.StringVar(value=a.get("api_base", "http://127.0.0.1:7860"))
+        api_base = a.get("api_base", "http://127.0.0.1:7860")
+        # Varios nodos A1111: en config.yaml es una lista, aquí separados por comas
+        self.auto_api_var     = tk.StringVar(value=", ".join(api_base) if isinstance(api_base, list) else api_base)
         self.auto_sampler_var = tk.StringVar(value=a.get("sampler_name", "DPM++ 2M Karras"))
         self.auto_steps_var   = tk.StringVar(value=str(a.get("steps", 32)))
         self.auto_cfg_var     = tk.StringVar(value=str(a.get("cfg_scale", 6.0)))
         self.auto_timeout_var = tk.StringVar(value=str(a.get("timeout_seconds", 900)))
+        self.auto_batch_var   = tk.StringVar(value=str(a.get("batch_size", 1)))
 
         for v in (
             self.auto_api_var,
@@ -428,6 +853,7 @@ class App(tb.Window if tb else tk.Tk):
             self.auto_steps_var,
             self.auto_cfg_var,
             self.auto_timeout_var,
+            self.auto_batch_var,
         ):
             v.trace_add("write", mark_dirty)
 
@@ -466,7 +892,8 @@ class App(tb.Window if tb else tk.Tk):
             "API base",
             self.auto_api_var,
             46,
-            "URL local de Automatic1111 (http://127.0.0.1:7860)"
+            "URL local de Automatic1111 (http://127.0.0.1:7860).\n"
+            "Varias URLs separadas por comas reparten el lote entre nodos (el primero es la WebUI local)."
         )
         add_auto_cell(
             0, 2,
@@ -509,6 +936,13 @@ class App(tb.Window if tb else tk.Tk):
             8,
             "Tiempo máximo de espera HTTP por imagen. CPU puede tardar varios minutos."
         )
+        add_auto_cell(
+            2, 2,
+            "Batch",
+            self.auto_batch_var,
+            8,
+            "Réplicas de un prompt por petición txt2img (batch_size). 1 = una petición por imagen.\nValores altos necesitan más VRAM."
+        )
 
         # -------- FILA 3 (CONTROL WEBUI) --------
         sub = ttk.LabelFrame(self.frm_auto, text="Stable Diffusion local")
@@ -605,16 +1039,41 @@ class App(tb.Window if tb else tk.Tk):
         act = ttk.Frame(self); act.pack(fill="x", padx=12, pady=6)
         ttk.Button(act, text="Ejecutar Lote", command=self.on_run_batch).pack(side="left", padx=12)
         ttk.Button(act, text="Parar Lote", command=self.on_stop_batch).pack(side="left")
+        self.resume_var = tk.BooleanVar(value=False)
+        chk_resume = ttk.Checkbutton(act, text="Reanudar", variable=self.resume_var)
+        chk_resume.pack(side="left", padx=(12, 0))
+        Tooltip(chk_resume, "Omite las réplicas ya generadas con éxito según ledger.sqlite\n(mismo prompt, id y parámetros). Útil tras un corte o 'Parar Lote'.")
         ttk.Button(act, text="Test imagen", command=self.on_test_image).pack(side="left", padx=12)
+        self.btn_service = ttk.Button(act, text="Iniciar servicio", command=self.on_toggle_service)
+        self.btn_service.pack(side="left", padx=(0, 12))
+        Tooltip(self.btn_service, "generator.py --serve: mantiene el proveedor conectado entre trabajos.\n"
+                                  "Con el servicio activo, 'Test imagen' tarda solo lo que tarde el proveedor.")
         ttk.Button(act, text="Abrir carpeta de salida", command=self.open_out).pack(side="left")
+        ttk.Button(act, text="Estado", command=self.on_ledger_status).pack(side="left", padx=(6, 0))
         ttk.Button(act, text="Elegir CSV de prompts…", command=self.browse_prompts_csv).pack(side="left", padx=6)
         self.lbl_prompts = ttk.Label(act, text=f"CSV: {self._shorten(self.prompts_path)}")
         self.lbl_prompts.pack(side="left", padx=8)
         ttk.Button(act, text="Limpiar log", command=self.clear_log).pack(side="right")
+        btn_repair = ttk.Button(act, text="Reparar entorno", command=self.on_repair_env)
+        btn_repair.pack(side="right", padx=6)
+        Tooltip(btn_repair, "Reinstala el venv del kit aunque su huella no haya cambiado\n"
+                            "(pip, requirements.txt y paquetes; lo recrea si el intérprete no arranca).")
+
+        # --- Progreso del lote (eventos de generator.py) ---
+        prog = ttk.Frame(self); prog.pack(fill="x", padx=12, pady=(0, 4))
+        self.progressbar = ttk.Progressbar(prog, mode="determinate", maximum=1, value=0, length=320)
+        self.progressbar.pack(side="left")
+        self.lbl_progress = ttk.Label(prog, text="")
+        self.lbl_progress.pack(side="left", padx=8)
+        self.progress = None
+        self.progress_q = queue.SimpleQueue()
+        self.after(250, self._poll_progress)
 
         # --- Log RO ---
         self.logbox = scrolledtext.ScrolledText(self, height=22, font=("Consolas", 10), state="disabled")
         self.logbox.pack(fill="both", expand=True, padx=12, pady=6)
+        self.log_sink = LogSink(self.logbox)
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
 
         self._try_auto_reload_samplers()
 
@@ -624,10 +1083,11 @@ class App(tb.Window if tb else tk.Tk):
         return s if len(s) <= maxlen else "…" + s[-(maxlen-1):]
 
     def clear_log(self):
-        self.logbox.configure(state="normal"); self.logbox.delete("1.0", tk.END); self.logbox.configure(state="disabled")
+        self.log_sink.clear()
 
     def log(self, msg):
-        self.logbox.configure(state="normal"); self.logbox.insert(tk.END, msg+"\n"); self.logbox.see(tk.END); self.logbox.configure(state="disabled")
+        # desde cualquier hilo: el widget sólo lo toca el hilo de Tk (LogSink)
+        self.log_sink.put(msg)
 
     def _initial_provider_name(self):
         prov = self.cfg.get("providers", {})
@@ -648,7 +1108,7 @@ class App(tb.Window if tb else tk.Tk):
             self.frm_stab_bg.pack(fill="x", padx=8, pady=6)
 
     def _try_auto_reload_samplers(self):
-        base = self.auto_api_var.get().strip() or "http://127.0.0.1:7860"
+        base = self._auto_base()
         def _run():
             if not api_alive(base): return
             sams = fetch_samplers(base, self.log)
@@ -738,18 +1198,32 @@ class App(tb.Window if tb else tk.Tk):
 
         self.webui_proc = start_webui(self.webui_var.get(), self.log)
         self.log("Esperando API 7860…")
-        threading.Thread(target=self._wait_and_report_api, daemon=True).start()
-
-    def _wait_and_report_api(self):
-        base = self.auto_api_var.get().strip() or "http://127.0.0.1:7860"
-        status = wait_api_ready(base, seconds=60, log=self.log)
-        if status == "ready":
-            self.log(f"API lista en {base} (modelo cargado).")
-            self.cb_sampler['values'] = fetch_samplers(base, self.log)
-        elif status == "api_up_initializing":
-            self.log(f"API OK en {base}, inicializando modelo… (puede tardar)")
-        else:
-            self.log("No respondió la API (o tardó demasiado).")
+        self._watch_webui(self.webui_proc)
+
+    def _watch_webui(self, proc, then=None):
+        """
+        Sigue el arranque de la WebUI (WebUIWatcher) e informa en el log; then() se llama en el
+        hilo de Tk en cuanto responde la API (como antes, sin esperar a que cargue el modelo).
+        """
+        base = self._auto_base()
+        def on_state(watcher, state):
+            if state == "api_up":
+                self.log(f"API OK en {base}, inicializando modelo… (puede tardar)")
+                if then: self.call_in_tk(then)
+            elif state == "ready":
+                self.log(f"API lista en {base} (modelo cargado).")
+                sams = watcher.samplers or fetch_samplers(base, self.log)
+                if sams: self.call_in_tk(lambda: self.cb_sampler.configure(values=sams))
+            elif state == "exited":
+                self.log("La WebUI terminó antes de estar lista (revisa el log).")
+            else:
+                self.log("No respondió la API (o tardó demasiado)." if "api_up" not in watcher.states
+                         else "La API responde, pero el modelo sigue sin cargar.")
+        log_path = pathlib.Path(self.webui_var.get()) / WEBUI_LOG if proc is not None else None
+        self.webui_watchers = [w for w in self.webui_watchers if not w.done.is_set()]
+        watcher = WebUIWatcher(base, on_state, proc=proc, log=self.log, log_path=log_path)
+        self.webui_watchers.append(watcher)
+        return watcher
 
     def on_stop_webui(self):
         if self.webui_proc and self.webui_proc.poll() is None:
@@ -757,9 +1231,16 @@ class App(tb.Window if tb else tk.Tk):
         else:
             self.log("WebUI no está ejecutándose.")
 
+    def _auto_base(self):
+        """Primer nodo de API base (la WebUI local que arranca/para la GUI)."""
+        bases = [b.strip() for b in self.auto_api_var.get().split(",") if b.strip()]
+        return bases[0] if bases else "http://127.0.0.1:7860"
+
     def on_probe_api(self):
-        base = self.auto_api_var.get().strip() or "http://127.0.0.1:7860"
-        self.log("API viva" if api_alive(base) else "API no responde")
+        bases = [b.strip() for b in self.auto_api_var.get().split(",") if b.strip()] or ["http://127.0.0.1:7860"]
+        for base in bases:
+            alive = "API viva" if api_alive(base) else "API no responde"
+            self.log(f"{alive} ({base})" if len(bases) > 1 else alive)
 
     # ---------- Guardar config / env ----------
     def on_save_cfg(self):
@@ -782,16 +1263,24 @@ class App(tb.Window if tb else tk.Tk):
             c["default"]["concurrency"] = int(self.conc_var.get())
             c["default"]["delay_seconds"] = float(self.delay_var.get())
             c["default"]["randomize_order"] = bool(self.rand_var.get())
+            c["default"]["engine"] = self.engine_var.get() or "threads"
+            c["default"]["dedup"] = self.dedup_var.get() or "off"
+            c["default"]["result_cache"] = bool(self.cache_var.get())
+            c["default"]["output_format"] = self.format_var.get() or "png"
+            c["default"]["output_quality"] = int(self.quality_var.get())
+            c["default"]["output_lossless"] = bool(self.lossless_var.get())
             c["default"]["seed"] = int(self.seed_var.get())
             t = self.temp_var.get().strip()
             c["default"]["temperature"] = None if t == "" else float(t)
 
             auto = c["providers"]["automatic1111"]
-            auto["api_base"] = self.auto_api_var.get()
+            bases = [b.strip() for b in self.auto_api_var.get().split(",") if b.strip()]
+            auto["api_base"] = bases if len(bases) > 1 else (bases[0] if bases else "http://127.0.0.1:7860")
             auto["sampler_name"] = self.auto_sampler_var.get()
             auto["steps"] = int(self.auto_steps_var.get())
             auto["cfg_scale"] = float(self.auto_cfg_var.get())
             auto["timeout_seconds"] = max(30, int(self.auto_timeout_var.get() or 900))
+            auto["batch_size"] = max(1, int(self.auto_batch_var.get() or 1))
 
 
             oai = c["providers"]["openai"]
@@ -831,20 +1320,66 @@ class App(tb.Window if tb else tk.Tk):
     def set_batch_proc(self, proc):
         self.batch_proc = proc; self.running_batch = proc is not None
 
-    def _autostart_a1111_if_needed(self):
-        base = self.auto_api_var.get().strip() or "http://127.0.0.1:7860"
+    def on_repair_env(self):
+        if self.running_batch:
+            self.log("Hay un lote en ejecución; repara el entorno cuando termine."); return
+        def _target():
+            try:
+                ensure_venv_and_reqs(self.log, repair=True)
+                self.env_ready = True
+            except Exception as e:
+                self.log(f"ERROR reparando entorno: {e}")
+        threading.Thread(target=_target, daemon=True).start()
+
+    # ---------- Progreso ----------
+    def call_in_tk(self, fn):
+        """Ejecuta fn en el hilo de Tk (Tk no es thread-safe): se encola y la llama _poll_progress."""
+        self.progress_q.put(fn)
+
+    def _poll_progress(self):
+        # los eventos llegan en el hilo del socket (y las llamadas de call_in_tk, de otros hilos);
+        # aquí se aplican y se repinta una vez por tanda
+        changed = False
+        for _ in range(self.progress_q.qsize()):
+            try:
+                ev = self.progress_q.get_nowait()
+            except queue.Empty:
+                break
+            if callable(ev):
+                try:
+                    ev()
+                except Exception as e:
+                    self.log(f"ERROR: {e}")
+                continue
+            if ev is None:
+                self.progress = BatchProgress()
+            elif self.progress is not None:
+                self.progress.update(ev)
+            changed = True
+        if changed and self.progress is not None:
+            p = self.progress
+            self.progressbar.configure(maximum=max(1, p.total or p.done or 1), value=p.done)
+            self.lbl_progress.configure(text=p.text())
+        self.after(250, self._poll_progress)
+
+    def _autostart_a1111_if_needed(self, then):
+        """
+        True si la API de A1111 ya responde. Si no, arranca la WebUI y devuelve False sin
+        bloquear la ventana: then() se ejecuta cuando la API esté arriba.
+        """
+        base = self._auto_base()
         if api_alive(base): return True
         self.log("API de A1111 no responde; intentando arrancar WebUI…")
         if not self.webui_var.get().strip():
             self.log("Ruta WebUI no definida. Cancelo."); return False
+        if self.webui_proc and self.webui_proc.poll() is None:
+            self.log("La WebUI ya está arrancando; se seguirá cuando responda.")
+            self._watch_webui(None, then)
+            return False
         self.webui_proc = start_webui(self.webui_var.get(), self.log)
-        self.log("Esperando API…")
-        status = wait_api_ready(base, seconds=60, log=self.log)
-        if status in ("ready","api_up_initializing"):
-            if status == "ready":
-                self.cb_sampler['values'] = fetch_samplers(base, self.log)
-            return True
-        self.log("No pude confirmar la API de A1111.")
+        if self.webui_proc is None: return False
+        self.log("Esperando API… (se seguirá solo cuando responda)")
+        self._watch_webui(self.webui_proc, then)
         return False
 
     def on_run_batch(self):
@@ -867,24 +1402,74 @@ class App(tb.Window if tb else tk.Tk):
                 return
 
         provider = self.provider_var.get()
-        if provider == "automatic1111" and not self._autostart_a1111_if_needed():
+        if provider == "automatic1111" and not self._autostart_a1111_if_needed(self.on_run_batch):
             return
 
+        extra = ["--out", str(_abs_out_from_gui(self.outdir_var.get()))]
+        if self.resume_var.get():
+            extra.append("--resume")
+
+        self.progress_q.put(None)  # nuevo lote: progreso a cero
         run_batch(
             self.log,
             provider=provider,
             size_override=self.size_var.get(),
             set_batch_proc=self.set_batch_proc,
-            extra_args=["--out", str(_abs_out_from_gui(self.outdir_var.get()))],
-            prompts_path=str(self.prompts_path)
+            extra_args=extra,
+            prompts_path=str(self.prompts_path),
+            on_event=self.progress_q.put
         )
 
     def on_stop_batch(self):
         if self.batch_proc and self.batch_proc.poll() is None:
-            pid = self.batch_proc.pid; taskkill_tree(pid, self.log); self.set_batch_proc(None)
+            proc = self.batch_proc; self.set_batch_proc(None)
+            stop_proc(proc, self.log, "Lote detenido.")
         else:
             self.log("No hay lote en ejecución.")
 
+    # ---------- Servicio ----------
+    def set_service_proc(self, proc):
+        self.service_proc = proc
+        self.call_in_tk(lambda: self.btn_service.configure(text="Parar servicio" if proc else "Iniciar servicio"))
+
+    def on_toggle_service(self):
+        if self.service_proc and self.service_proc.poll() is None:
+            stop_proc(self.service_proc, self.log, "Servicio detenido.")
+            return
+        if service_alive(service_base()):
+            self.log(f"Ya hay un servicio escuchando en {service_base()}.")
+            return
+        if not self.env_ready:
+            try:
+                ensure_venv_and_reqs(self.log)
+                self.env_ready = True
+            except Exception as e:
+                self.log(f"ERROR preparando entorno: {e}")
+                return
+        start_service(self.log, str(_abs_out_from_gui(self.outdir_var.get())), set_proc=self.set_service_proc)
+
+    def _test_via_service(self, base, provider, prompt):
+        out_dir = _abs_out_from_gui(self.outdir_var.get())  # variables Tk: se leen en este hilo
+        size = self.size_var.get()
+        def _run():
+            self.log(f"Generando 1 imagen de prueba (servicio {base})…")
+            try:
+                r = requests.post(f"{base}/generate", timeout=900, headers=service_headers(out_dir), json={
+                    "provider": provider, "prompt": prompt, "size": size,
+                    "out": str(out_dir / "test"),
+                })
+                job = r.json()
+                if job.get("status") == "done":
+                    res = job["result"]
+                    self.log(f"Imagen generada en {res['seconds']:.1f}s.")
+                    self.log(f"Ruta: {res['file_path']}")
+                else:
+                    self.log(f"ERROR en el test: {job.get('error')}")
+            except Exception as e:
+                self.log(f"ERROR hablando con el servicio: {e}")
+            self.log("Fin test.")
+        threading.Thread(target=_run, daemon=True).start()
+
     def on_test_image(self):
         if self.cfg_dirty:
             messagebox.showwarning(
@@ -908,7 +1493,14 @@ class App(tb.Window if tb else tk.Tk):
             return
 
         provider = self.provider_var.get()
-        if provider == "automatic1111" and not self._autostart_a1111_if_needed():
+        if provider == "automatic1111" and not self._autostart_a1111_if_needed(lambda: self._run_test(provider, prompt)):
+            return
+        self._run_test(provider, prompt)
+
+    def _run_test(self, provider, prompt):
+        base = service_base()
+        if service_alive(base):
+            self._test_via_service(base, provider, prompt)
             return
 
         # CSV temporal
@@ -920,20 +1512,25 @@ class App(tb.Window if tb else tk.Tk):
         )
 
         self.log("Generando 1 imagen de prueba…")
+        self.progress_q.put(None)
+
+        # La ruta exacta llega en el evento "finished" (sin recorrer la carpeta de salida)
+        events = []
 
-        # Carpeta real de salida del test
-        test_out_root = _abs_out_from_gui(self.outdir_var.get()) / "test" / provider
+        def _on_event(ev):
+            events.append(ev)
+            self.progress_q.put(ev)
 
         def _after():
-            try:
-                pngs = list(test_out_root.rglob("*.png"))
-                if pngs:
-                    self.log(f"Imagen generada correctamente ({len(pngs)} archivo/s).")
-                    self.log(f"Ruta: {pngs[0]}")
-                else:
-                    self.log("El test terminó, pero no se encontró ninguna imagen.")
-            except Exception as e:
-                self.log(f"Aviso comprobando salida del test: {e}")
+            done = [ev for ev in events if ev.get("event") == "finished"]
+            failed = [ev for ev in events if ev.get("event") == "failed"]
+            if done:
+                self.log(f"Imagen generada en {done[0].get('latency_seconds') or 0:.1f}s.")
+                self.log(f"Ruta: {done[0]['file_path']}")
+            elif failed:
+                self.log(f"ERROR en el test: {failed[0].get('error')}")
+            else:
+                self.log("El test terminó, pero no se generó ninguna imagen.")
 
             try:
                 if tmp_csv.exists():
@@ -953,11 +1550,47 @@ class App(tb.Window if tb else tk.Tk):
                 "--out", str(_abs_out_from_gui(self.outdir_var.get()) / "test")
             ],
             set_batch_proc=self.set_batch_proc,
-            on_finish=_after
+            on_finish=_after,
+            on_event=_on_event
         )
 
 
 
+    def on_ledger_status(self):
+        prov = self.provider_var.get()
+        path = _abs_out_from_gui(self.outdir_var.get()) / prov / "ledger.sqlite"
+        if not path.exists():
+            self.log(f"Sin registro de trabajos para {prov} ({path})."); return
+        try:
+            counts, missing = ledger_summary(path)
+        except sqlite3.Error as e:
+            self.log(f"ERROR leyendo {path}: {e}"); return
+        self.log(f"Estado {prov}: " + ", ".join(f"{counts.get(s, 0)} {s}" for s in ("done", "failed", "running", "pending")))
+        for pid, rep, status, err in missing:
+            self.log(f"  {pid} rep{rep}: {status}" + (f" ({err})" if err else ""))
+
+    # ---------- cierre ----------
+    def on_close(self):
+        # La WebUI sigue en su consola; el lote y el servicio escriben en pipes que lee la GUI,
+        # así que se paran (Ctrl+Break: cierran su manifiesto) antes de salir.
+        running = [p for p in (self.batch_proc, self.service_proc) if p and p.poll() is None]
+        if running and not messagebox.askyesno(
+                "Salir", "Hay un lote o el servicio en marcha.\n\n¿Pararlos y salir? (La WebUI sigue en su consola.)"):
+            return
+        for w in self.webui_watchers:
+            w.stop()
+        for p in running:
+            try:
+                p.send_signal(signal.CTRL_BREAK_EVENT)
+            except Exception:
+                pass
+        for p in running:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                taskkill_tree(p.pid, self.log)
+        self.destroy()
+
     # ---------- salida ----------
     def open_out(self):
         abs_out = _abs_out_from_gui(self.outdir_var.get())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# bench_encode.py — formatos de salida: tiempo de codificación frente a bytes escritos
+#
+# Para cada formato (png tal cual y recomprimido, webp con y sin pérdida, jpeg, avif) pasa las
+# imágenes por generator.encode_image, como el pool de post-proceso, y mide:
+#   - ms por imagen con un hilo (mediana),
+#   - imágenes/s con --workers hilos (Pillow libera el GIL al codificar),
+#   - bytes escritos y ratio frente al PNG original.
+# Sin --images usa imágenes sintéticas (degradados, ruido y desenfoque, parecidas a un render).
+#
+# Uso (desde batchkit/):
+#   python benchmarks/bench_encode.py [--images DIR] [--count 6] [--px 1024] [--workers 4]
+import argparse, os, pathlib, shutil, statistics, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import generator  # noqa: E402
+from PIL import Image, ImageChops, ImageFilter  # noqa: E402
+
+CASES = [
+    ("png (tal cual)", dict(output_format="png")),
+    ("png level 1", dict(output_format="png", png_compress_level=1)),
+    ("png level 9", dict(output_format="png", png_compress_level=9)),
+    ("webp lossless", dict(output_format="webp", output_lossless=True, output_quality=80)),
+    ("webp q90", dict(output_format="webp", output_quality=90)),
+    ("jpeg q92", dict(output_format="jpeg", output_quality=92)),
+    ("avif q80", dict(output_format="avif", output_quality=80)),
+]
+
+def synthetic(i: int, px: int) -> Image.Image:
+    """Render sintético: degradados y fractal de fondo, ruido fino, suavizado."""
+    base = Image.merge("RGB", (
+        Image.radial_gradient("L").resize((px, px)),
+        Image.linear_gradient("L").rotate(30 * i).resize((px, px)),
+        Image.effect_mandelbrot((px, px), (-2.0 + 0.1 * i, -1.2, 0.8, 1.2), 64),
+    ))
+    noise = Image.effect_noise((px, px), 24 + 4 * i).convert("RGB")
+    return ImageChops.add(base.filter(ImageFilter.GaussianBlur(2)), noise, scale=1.6)
+
+def sources(args, work: str):
+    if args.images:
+        files = sorted(pathlib.Path(args.images).glob("*.png"))[:args.count]
+        if not files:
+            raise SystemExit(f"No PNG files in {args.images}")
+        return [str(f) for f in files]
+    out = []
+    for i in range(args.count):
+        path = os.path.join(work, f"src{i}.png")
+        synthetic(i, args.px).save(path)
+        out.append(path)
+    return out
+
+def encode_one(src: str, stage_dir: str, rc) -> int:
+    staged = generator.stage_file(src, stage_dir)
+    img = generator.encode_image(staged, rc) if generator.needs_encoding(rc) else staged
+    generator.discard_image(img)
+    return img.get("stored_bytes", img["bytes"])
+
+def supported(fmt: str) -> bool:
+    if fmt != "avif":
+        return True
+    if generator._pil_has("avif"):
+        return True
+    try:
+        import pillow_avif  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def main():
+    ap = argparse.ArgumentParser(description="Output formats: encode time vs bytes written")
+    ap.add_argument("--images", help="directory with PNG images (default: synthetic images)")
+    ap.add_argument("--count", type=int, default=6)
+    ap.add_argument("--px", type=int, default=1024, help="side of the synthetic images")
+    ap.add_argument("--workers", type=int, default=4)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as work:
+        srcs = sources(args, work)
+        stage_dir = os.path.join(work, "stage")
+        src_bytes = sum(os.path.getsize(s) for s in srcs)
+        print(f"{len(srcs)} imágenes, {src_bytes / 2**20:.1f} MiB en PNG original, workers={args.workers}")
+        print(f"{'formato':<16}{'ms/img':>9}{'img/s':>9}{'MiB':>9}{'ratio':>8}")
+        for name, opts in CASES:
+            if not supported(opts["output_format"]):
+                print(f"{name:<16}  (sin soporte en este Pillow)")
+                continue
+            rc = generator.RunConfig(**opts)
+            times, written = [], 0
+            for s in srcs:
+                t0 = time.perf_counter()
+                written += encode_one(s, stage_dir, rc)
+                times.append((time.perf_counter() - t0) * 1000)
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(args.workers) as pool:
+                list(pool.map(lambda s: encode_one(s, stage_dir, rc), srcs))
+            rate = len(srcs) / (time.perf_counter() - t0)
+            print(f"{name:<16}{statistics.median(times):>9.1f}{rate:>9.1f}"
+                  f"{written / 2**20:>9.2f}{written / src_bytes:>8.2f}")
+        shutil.rmtree(stage_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
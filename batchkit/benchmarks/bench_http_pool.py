@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# bench_http_pool.py — sobrecoste por petición: requests.post "suelto" vs ProviderClient (Session con pool)
+#
+# Levanta un servidor stub local (HTTP/1.1 keep-alive) que imita los endpoints de
+# Stability y Automatic1111 y mide gen_stability / gen_automatic1111 con y sin sesión.
+# La respuesta es inmediata, así que el tiempo medido es sobrecoste de cliente + conexión.
+#
+# Uso (desde batchkit/):
+#   python benchmarks/bench_http_pool.py [--requests 300] [--threads 4]
+import argparse, base64, json, pathlib, statistics, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import generator  # noqa: E402
+
+# PNG 1x1 transparente
+PNG_1PX = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+A1111_BODY = json.dumps({"images": [base64.b64encode(PNG_1PX).decode()], "info": "{}"}).encode()
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # sin esto, keep-alive + delayed ACK añade ~40 ms por respuesta
+
+    def log_message(self, *_):
+        pass
+
+    def do_POST(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        if n:
+            self.rfile.read(n)
+        if self.path.startswith("/sdapi/v1/txt2img"):
+            body, ctype = A1111_BODY, "application/json"
+        else:
+            body, ctype = PNG_1PX, "image/png"
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_stub():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://127.0.0.1:{srv.server_address[1]}"
+
+def call(provider, base, session):
+    if provider == "stability":
+        generator.gen_stability("bench", "64x64", "sd3", base, "dummy", session=session)
+    else:
+        generator.gen_automatic1111("bench", "64x64", base, "Euler", 1, 1.0, -1, 30, session=session)
+
+def measure(provider, base, n, threads, session):
+    lat = []
+    lock = threading.Lock()
+
+    def one(_):
+        t0 = time.perf_counter()
+        call(provider, base, session)
+        dt = time.perf_counter() - t0
+        with lock:
+            lat.append(dt)
+
+    call(provider, base, session)  # calentamiento
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(n)))
+    wall = time.perf_counter() - t0
+    lat.sort()
+    return {
+        "mean_ms": statistics.mean(lat) * 1000,
+        "p50_ms": lat[len(lat) // 2] * 1000,
+        "p95_ms": lat[int(len(lat) * 0.95) - 1] * 1000,
+        "req_s": n / wall,
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Per-request overhead: bare requests vs pooled session")
+    ap.add_argument("--requests", type=int, default=300)
+    ap.add_argument("--threads", type=int, default=4)
+    args = ap.parse_args()
+
+    srv, base = start_stub()
+    try:
+        print(f"stub: {base}  requests={args.requests}  threads={args.threads}")
+        print(f"{'provider':<14}{'mode':<10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'req/s':>10}")
+        for provider in ("stability", "automatic1111"):
+            before = measure(provider, base, args.requests, args.threads, None)
+            with generator.ProviderClient(pool_size=args.threads) as client:
+                after = measure(provider, base, args.requests, args.threads, client.session)
+            for mode, m in (("bare", before), ("pooled", after)):
+                print(f"{provider:<14}{mode:<10}{m['mean_ms']:>10.2f}{m['p50_ms']:>10.2f}{m['p95_ms']:>10.2f}{m['req_s']:>10.0f}")
+    finally:
+        srv.shutdown()
+
+if __name__ == "__main__":
+    main()
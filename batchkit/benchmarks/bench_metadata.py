@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# bench_metadata.py — buscar el prompt/semilla de una imagen: manifiesto frente a metadatos embebidos
+#
+# Crea una carpeta de salida sintética (--images PNG con el iTXt "batchkit" de generator.py, y un
+# manifest.jsonl con --rows filas, como el de un lote largo) y mide:
+#   - búsqueda por file_path recorriendo el manifiesto frente a read_image_metadata de la imagen,
+#   - reconstrucción del manifiesto desde las imágenes (rebuild_manifest) con 1 hilo y con el pool.
+#
+# Uso (desde batchkit/):
+#   python benchmarks/bench_metadata.py [--images 2000] [--rows 500000] [--kb 512]
+import argparse, base64, json, os, pathlib, statistics, sys, tempfile, time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import generator  # noqa: E402
+
+# PNG 1x1 transparente
+PNG_1PX = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+def fake_png(kb: int) -> bytes:
+    """PNG válido de ~kb KiB: un chunk auxiliar de relleno delante de IEND, como los IDAT de un render."""
+    pad = generator.png_chunk(b"prVt", os.urandom(kb * 1024))
+    return PNG_1PX[:-len(generator.PNG_IEND)] + pad + generator.PNG_IEND
+
+def make_tree(root: str, images: int, rows: int, kb: int):
+    out_root = os.path.join(root, "automatic1111")
+    body = fake_png(kb)
+    paths = []
+    with open(os.path.join(out_root + ".manifest.jsonl"), "w", encoding="utf-8") as mf:
+        for i in range(rows):
+            pid = f"p{i // 10}"
+            rep = i % 10 + 1
+            path = os.path.join(out_root, pid, f"{pid}_rep{rep}_{i:016x}.png")
+            row = {"timestamp": generator.timestamp(), "provider": "automatic1111", "prompt_id": pid,
+                   "replicate_index": rep, "sha256_16": f"{i:016x}", "prompt_sha256_16": "0" * 16,
+                   "params_sha256_16": "1" * 16, "seed": i, "file_path": path}
+            mf.write(json.dumps(row) + "\n")
+            if i >= rows - images:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = os.path.join(os.path.dirname(path), f"src{i}.png")
+                with open(tmp, "wb") as f:
+                    f.write(body)
+                staged = generator.stage_file(tmp, os.path.dirname(path))
+                os.remove(tmp)
+                meta = dict(row, prompt=f"prompt {pid}", params={"steps": 20})
+                del meta["file_path"]
+                generator.commit_image(generator.embed_png_metadata(staged, meta), path)
+                paths.append(path)
+    return out_root, paths
+
+def scan_manifest(manifest: str, path: str):
+    needle = json.dumps(path)
+    with open(manifest, "r", encoding="utf-8", buffering=1 << 20) as f:
+        for line in f:
+            if needle in line:
+                return json.loads(line)
+    return None
+
+def main():
+    ap = argparse.ArgumentParser(description="Image lookup: manifest scan vs embedded metadata; manifest rebuild")
+    ap.add_argument("--images", type=int, default=2000)
+    ap.add_argument("--rows", type=int, default=500000, help="manifest rows (the images are the last ones)")
+    ap.add_argument("--kb", type=int, default=512, help="image size in KiB")
+    ap.add_argument("--lookups", type=int, default=20)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        out_root, paths = make_tree(root, args.images, max(args.rows, args.images), args.kb)
+        manifest = out_root + ".manifest.jsonl"
+        print(f"{len(paths)} imágenes de {args.kb} KiB, manifiesto de {os.path.getsize(manifest) / 2**20:.0f} MiB")
+        # las imágenes son las últimas filas: lo reciente, que es lo que más se busca, está al final
+        sample = paths[-args.lookups:]
+        scan = []
+        for p in sample:
+            t0 = time.perf_counter()
+            scan_manifest(manifest, p)
+            scan.append(time.perf_counter() - t0)
+        embedded = []
+        for p in sample:
+            t0 = time.perf_counter()
+            generator.read_image_metadata(p)
+            embedded.append(time.perf_counter() - t0)
+        print(f"{'búsqueda en manifiesto':<28}{statistics.median(scan) * 1000:>10.2f} ms")
+        print(f"{'metadatos embebidos':<28}{statistics.median(embedded) * 1000:>10.2f} ms")
+        for workers in (1, 0):
+            t0 = time.perf_counter()
+            n, _ = generator.rebuild_manifest(out_root, os.path.join(root, f"rebuilt{workers}.jsonl"), workers=workers)
+            label = f"rebuild ({workers or 'pool'} hilo{'s' if workers != 1 else ''})"
+            print(f"{label:<28}{(time.perf_counter() - t0) * 1000:>10.0f} ms  ({n} filas)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# bench_startup.py — coste de arranque de generator.py: tiempo de importación y tiempo hasta la primera petición
+#
+# 1) `python -X importtime -c "import generator"`: tiempo acumulado de importación y módulos más caros.
+# 2) Tiempo hasta la primera petición: lanza generator.py (1 prompt, 1 réplica, automatic1111)
+#    contra un servidor stub local y mide desde el arranque del proceso hasta que llega el txt2img,
+#    que es lo que paga el "Test imagen" de la GUI en cada clic.
+# Ambos en modo "lazy" (el actual) y "eager" (importando antes tqdm, httpx, PIL,
+# openai y http.server, como hacía generator.py al cargarse), si están instalados.
+#
+# Uso (desde batchkit/):
+#   python benchmarks/bench_startup.py [--runs 7] [--top 12]
+import argparse, base64, importlib.util, json, os, pathlib, statistics, subprocess, sys, tempfile, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+KIT = pathlib.Path(__file__).resolve().parent.parent
+EAGER = [m for m in ("tqdm", "httpx", "PIL.Image", "openai", "http.server")
+         if importlib.util.find_spec(m.split(".")[0]) is not None]
+
+# PNG 1x1 transparente
+PNG_1PX = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+A1111_BODY = json.dumps({"images": [base64.b64encode(PNG_1PX).decode()], "info": "{}"}).encode()
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    first_request = None  # threading.Event que se marca al recibir un txt2img
+    first_at = 0.0
+
+    def log_message(self, *_):
+        pass
+
+    def _send(self, body: bytes):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._send(b'{"progress": 0, "state": {"job_count": 0}}')
+
+    def do_POST(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        if n:
+            self.rfile.read(n)
+        if self.path.startswith("/sdapi/v1/txt2img") and not StubHandler.first_request.is_set():
+            StubHandler.first_at = time.perf_counter()
+            StubHandler.first_request.set()
+        self._send(A1111_BODY)
+
+def start_stub():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://127.0.0.1:{srv.server_address[1]}"
+
+def python_cmd(code: str, eager: bool):
+    pre = "".join(f"import {m}; " for m in EAGER) if eager else ""
+    return [sys.executable, "-c", pre + code]
+
+def import_time(eager: bool):
+    """
+    (µs acumulados de `import generator` + importaciones previas, {módulo: µs acumulados} de las
+    importaciones directas de generator) de una ejecución.
+    """
+    cmd = [sys.executable, "-X", "importtime"] + python_cmd("import generator", eager)[1:]
+    err = subprocess.run(cmd, cwd=KIT, capture_output=True, text=True, check=True).stderr
+    top, children, direct = {}, {}, {}
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "cumulative" in line:
+            continue
+        _, cum, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = int(cum)
+        elif depth == 0:
+            # importtime escribe los hijos antes que el padre
+            top[name.strip()] = int(cum)
+            if name.strip() == "generator":
+                direct = children
+            children = {}
+    pre = {m for m in EAGER for m in (m, m.split(".")[0])} if eager else set()
+    total = sum(us for name, us in top.items() if name == "generator" or name in pre)
+    return total, direct
+
+def first_request_time(base: str, work: str, eager: bool) -> float:
+    cfg = os.path.join(work, "config.yaml")
+    with open(cfg, "w", encoding="utf-8") as f:
+        json.dump({"default": {"out_dir": os.path.join(work, "out"), "repeats": 1, "size": "64x64",
+                               "randomize_order": False},
+                   "providers": {"automatic1111": {"api_base": base, "steps": 1}}}, f)  # JSON es YAML válido
+    prompts = os.path.join(work, "prompts.csv")
+    with open(prompts, "w", encoding="utf-8") as f:
+        f.write("id,prompt\nb1,bench\n")
+    argv = ["generator.py", "--provider", "automatic1111", "--config", cfg, "--prompts", prompts]
+    code = f"import runpy, sys; sys.argv = {argv!r}; runpy.run_path('generator.py', run_name='__main__')"
+    StubHandler.first_request = threading.Event()
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(python_cmd(code, eager), cwd=KIT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not StubHandler.first_request.wait(60):
+            raise RuntimeError("generator.py did not reach the stub")
+        return StubHandler.first_at - t0
+    finally:
+        proc.wait(60)
+
+def main():
+    ap = argparse.ArgumentParser(description="generator.py startup: import time and time to first request")
+    ap.add_argument("--runs", type=int, default=7)
+    ap.add_argument("--top", type=int, default=12, help="most expensive imports to list (lazy mode)")
+    args = ap.parse_args()
+
+    srv, base = start_stub()
+    try:
+        print(f"python {sys.version.split()[0]}  runs={args.runs}  eager extra imports: {', '.join(EAGER) or '-'}")
+        print(f"{'mode':<8}{'import ms':>12}{'first req ms':>15}")
+        lazy_mods = {}
+        with tempfile.TemporaryDirectory() as work:
+            for mode, eager in (("eager", True), ("lazy", False)):
+                imp, req = [], []
+                for _ in range(args.runs):
+                    total, mods = import_time(eager)
+                    imp.append(total / 1000)
+                    req.append(first_request_time(base, work, eager) * 1000)
+                    if not eager:
+                        lazy_mods = mods
+                print(f"{mode:<8}{statistics.median(imp):>12.1f}{statistics.median(req):>15.1f}")
+        print(f"\nImportaciones más caras (lazy, acumulado ms):")
+        top = sorted(((us, m) for m, us in lazy_mods.items()), reverse=True)[:args.top]
+        for us, m in top:
+            print(f"  {us / 1000:>8.1f}  {m}")
+    finally:
+        srv.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# bench_stream_save.py — pico de memoria al guardar imágenes: respuesta en memoria vs streaming a disco
+#
+# Levanta un servidor stub local que devuelve imágenes del tamaño pedido (bytes aleatorios, como
+# un PNG 2048px poco comprimible) por los endpoints de Stability y Automatic1111, y mide con
+# tracemalloc el pico de memoria de gen_* + job_rows con y sin save_dir.
+#
+# Uso (desde batchkit/):
+#   python benchmarks/bench_stream_save.py [--mb 12] [--batch 4]
+import argparse, base64, json, os, pathlib, sys, tempfile, threading, time, tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+import generator  # noqa: E402
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    image = b""
+    a1111_body = b""
+
+    def log_message(self, *_):
+        pass
+
+    def do_POST(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n) if n else b""
+        if self.path.startswith("/sdapi/v1/txt2img"):
+            p = json.loads(raw or b"{}")
+            k = int(p.get("batch_size", 1)) * int(p.get("n_iter", 1))
+            body, ctype = self.a1111_body[k], "application/json"
+        else:
+            body, ctype = self.image, "image/png"
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_stub(mb: int, batch: int):
+    StubHandler.image = os.urandom(mb * 1024 * 1024)
+    b64 = base64.b64encode(StubHandler.image).decode()
+    StubHandler.a1111_body = {
+        k: json.dumps({"images": [b64] * k, "parameters": {}, "info": json.dumps({"all_seeds": list(range(k))})}).encode()
+        for k in (1, batch)
+    }
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://127.0.0.1:{srv.server_address[1]}"
+
+def measure(provider, base, count, out_dir, streaming):
+    job = generator.Job(seq=0, idx=1, prompt_id="bench", prompt_text="bench", rep=1, last_rep=True,
+                        prompt_dir=out_dir, count=count)
+    save_dir = out_dir if streaming else None
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    if provider == "stability":
+        out = generator.gen_stability("bench", "2048x2048", "sd3", base, "dummy", save_dir=save_dir)
+    else:
+        out = generator.gen_automatic1111("bench", "2048x2048", base, "Euler", 1, 1.0, -1, 60,
+                                          batch_size=count, save_dir=save_dir)
+    rows = generator.job_rows(provider, job, out, 0.0)
+    dt = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del out
+    for r in rows:
+        os.remove(r["file_path"])
+    return peak / 2**20, dt * 1000
+
+def main():
+    ap = argparse.ArgumentParser(description="Peak memory while saving images: in-memory vs streaming")
+    ap.add_argument("--mb", type=int, default=12, help="image size in MiB")
+    ap.add_argument("--batch", type=int, default=4, help="A1111 images per request")
+    args = ap.parse_args()
+
+    srv, base = start_stub(args.mb, args.batch)
+    try:
+        print(f"stub: {base}  image={args.mb} MiB  batch={args.batch}")
+        print(f"{'case':<24}{'mode':<12}{'peak MiB':>10}{'ms':>10}")
+        cases = (("stability", 1), ("automatic1111", 1), ("automatic1111", args.batch))
+        with tempfile.TemporaryDirectory() as out_dir:
+            for provider, count in cases:
+                for mode, streaming in (("in-memory", False), ("streaming", True)):
+                    peak, ms = measure(provider, base, count, out_dir, streaming)
+                    print(f"{provider + ' x' + str(count):<24}{mode:<12}{peak:>10.1f}{ms:>10.0f}")
+    finally:
+        srv.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
-import os, csv, json, time, base64, hashlib, random, argparse, pathlib, sys, datetime
-from dataclasses import dataclass
-from typing import Optional, Dict, Any, List
-from tqdm import tqdm
+import os, csv, json, time, base64, hashlib, random, argparse, pathlib, sys, datetime, threading, signal, atexit, codecs, collections, io, socket, sqlite3, secrets, hmac, struct, zlib, shutil, queue, contextlib, asyncio
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, replace
+from typing import Optional, Dict, Any, List, Tuple
 import re
 
 PROJECT_ROOT = pathlib.Path(__file__).resolve().parent.parent
@@ -25,14 +25,31 @@ except Exception:
     print("Please 'pip install pyyaml' or add it to requirements if you want to use YAML configs.", file=sys.stderr)
     yaml = None
 
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None
-
 import requests
-from PIL import Image
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+
+# ---------- Importación diferida ----------
+# openai (sólo su proveedor), httpx (sólo engine: async) y tqdm (sólo con terminal) se cargan en el
+# primer uso: el arranque, que la GUI paga en cada "Test imagen", no los importa. asyncio se importa
+# arriba: es barato y LazyLoader no es seguro entre hilos (varios proveedores con engine: async).
+
+def openai_sdk():
+    try:
+        import openai
+    except Exception:
+        raise RuntimeError("OpenAI SDK not installed. Run: pip install openai")
+    return openai
+
+def httpx_module():
+    try:
+        import httpx
+    except Exception:
+        raise RuntimeError("httpx not installed. Run: pip install httpx")
+    return httpx
+
+def tqdm_class():
+    from tqdm import tqdm
+    return tqdm
 
 @dataclass
 class RunConfig:
@@ -41,9 +58,23 @@ class RunConfig:
     size: str = "1024x1024"
     temperature: Optional[float] = None
     randomize_order: bool = True
+    shuffle_buffer: int = 10000
     concurrency: int = 1
+    engine: str = "threads"
     delay_seconds: float = 0.0
+    max_rps: Optional[float] = None
+    max_retries: int = 3
+    dedup: str = "off"
+    result_cache: bool = False
+    result_cache_max_mb: int = 10240
     seed: Optional[int] = None
+    post_workers: int = 0           # hilos de post-proceso (0 = automático)
+    output_format: str = "png"      # png, webp, jpeg o avif
+    output_quality: int = 90        # webp/jpeg/avif; con output_lossless, esfuerzo de compresión
+    output_lossless: bool = False   # webp sin pérdida
+    png_compress_level: Optional[int] = None  # 0-9: recomprime el PNG (None = tal cual lo da el proveedor)
+    embed_metadata: bool = True     # prompt, semilla y parámetros dentro de cada imagen (iTXt / EXIF)
+    thumbnail_px: int = 0           # lado mayor de las miniaturas (0 = sin miniaturas)
 
 @dataclass
 class ProviderConfig:
@@ -55,6 +86,9 @@ class ProviderConfig:
     steps: Optional[int] = None
     cfg_scale: Optional[float] = None
     timeout_seconds: Optional[int] = None
+    batch_size: Optional[int] = None
+    endpoints: Optional[List[str]] = None  # A1111 con varios nodos (api_base como lista)
+    warmup: Optional[bool] = None          # A1111: generación mínima antes del lote (None: auto)
 
 def sha256_bytes(b: bytes) -> str:
     return hashlib.sha256(b).hexdigest()
@@ -74,30 +108,174 @@ def write_jsonl(path: str, rows: List[Dict[str, Any]]):
         for r in rows:
             f.write(json.dumps(r, ensure_ascii=False) + "\n")
 
-def load_prompts_csv(path: str) -> List[Dict[str, str]]:
-    encodings = ("utf-8", "utf-8-sig", "cp1252", "latin-1")
-    last_err = None
-    raw_text = None
-    for enc in encodings:
-        try:
-            with open(path, "r", encoding=enc, newline="") as f:
-                raw_text = f.read()
-            break
-        except UnicodeDecodeError as e:
-            last_err = e
-            continue
-    if raw_text is None:
-        raise last_err or RuntimeError(f"No se pudo leer {path}")
-
+class ManifestWriter:
+    """
+    Escritor del manifest.jsonl con un único descriptor abierto toda la ejecución.
+    Acumula filas y las vuelca cuando hay max_rows pendientes o la más antigua supera
+    max_delay segundos (un hilo de fondo cubre los lotes lentos); hace fsync cada
+    fsync_seconds y siempre al cerrar. Se puede llamar desde varios hilos.
+    """
+    def __init__(self, path: str, max_rows: int = 64, max_delay: float = 2.0, fsync_seconds: float = 10.0):
+        self.path = path
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.fsync_seconds = fsync_seconds
+        self._f = open(path, "a", encoding="utf-8")
+        self._buf: List[str] = []
+        self._oldest = 0.0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="manifest-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def write(self, rows: List[Dict[str, Any]]):
+        lines = [json.dumps(r, ensure_ascii=False) + "\n" for r in rows]
+        with self._lock:
+            if self._f.closed:
+                write_jsonl(self.path, rows)  # tras close() (p.ej. desde atexit) no se pierden filas
+                return
+            if not self._buf:
+                self._oldest = time.monotonic()
+            self._buf.extend(lines)
+            if len(self._buf) >= self.max_rows:
+                self._flush_locked()
+
+    def flush(self, fsync: bool = False):
+        with self._lock:
+            self._flush_locked(fsync)
+
+    def _flush_locked(self, fsync: bool = False):
+        if self._f.closed:
+            return
+        if self._buf:
+            self._f.write("".join(self._buf))
+            self._buf.clear()
+            self._f.flush()
+        now = time.monotonic()
+        if fsync or now - self._last_sync >= self.fsync_seconds:
+            os.fsync(self._f.fileno())
+            self._last_sync = now
+
+    def _flush_loop(self):
+        while not self._closed.wait(min(self.max_delay, self.fsync_seconds) / 2):
+            with self._lock:
+                if self._buf and time.monotonic() - self._oldest >= self.max_delay:
+                    self._flush_locked()
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            if self._f.closed:
+                return
+            self._flush_locked(fsync=True)
+            self._f.close()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def install_exit_signals():
+    """
+    SIGTERM / SIGBREAK (Ctrl+Break al grupo de procesos en Windows) se convierten en
+    SystemExit para que los bloques with cierren el manifiesto y las sesiones.
+    """
+    def _exit(signum, _frame):
+        raise SystemExit(128 + signum)
+    for name in ("SIGTERM", "SIGBREAK"):
+        sig = getattr(signal, name, None)
+        if sig is not None:
+            try:
+                signal.signal(sig, _exit)
+            except (ValueError, OSError):
+                pass
+
+CSV_ENCODINGS = ("utf-8", "cp1252", "latin-1")
+
+def detect_csv_format(path: str, sample_bytes: int = 64 * 1024):
+    """
+    Detecta codificación y delimitador leyendo sólo la cabecera del fichero.
+    Devuelve (encoding, delimiter). latin-1 nunca falla, así que siempre hay resultado.
+    """
+    with open(path, "rb") as f:
+        head = f.read(sample_bytes)
+    if head.startswith(codecs.BOM_UTF8):
+        encoding, sample = "utf-8-sig", head[len(codecs.BOM_UTF8):].decode("utf-8", errors="ignore")
+    else:
+        encoding, sample = "latin-1", None
+        for enc in CSV_ENCODINGS:
+            try:
+                # final=False: la muestra puede cortar un carácter multibyte al final
+                sample = codecs.getincrementaldecoder(enc)().decode(head, final=False)
+                encoding = enc
+                break
+            except UnicodeDecodeError:
+                continue
+        if sample is None:
+            sample = head.decode("latin-1")
+
+    # Sólo líneas completas para el Sniffer
+    if len(head) == sample_bytes and "\n" in sample:
+        sample = sample[:sample.rindex("\n")]
     try:
-        dialect = csv.Sniffer().sniff(raw_text[:4096], delimiters=";,")
-        delimiter = dialect.delimiter
+        delimiter = csv.Sniffer().sniff(sample[:4096], delimiters=";,").delimiter
     except Exception:
-        delimiter = ";" if ";" in raw_text[:4096] else ","
+        delimiter = ";" if ";" in sample[:4096] else ","
+    return encoding, delimiter
+
+def iter_prompts_csv(path: str):
+    """
+    Lector en streaming: detecta formato con una muestra y produce las filas (claves en
+    minúsculas) según se leen, con memoria constante. La decodificación es estricta: si más
+    allá de la muestra aparecen bytes que no valen en la codificación detectada (p. ej. un
+    cp1252 con cabecera ASCII), se relee con la siguiente de CSV_ENCODINGS saltando las filas
+    ya producidas. Nunca se sustituyen bytes: el texto llega tal cual a proveedores y hashes.
+    """
+    encoding, delimiter = detect_csv_format(path)
+    bom = encoding == "utf-8-sig"
+    candidates = CSV_ENCODINGS[CSV_ENCODINGS.index("utf-8" if bom else encoding):]
+    yielded = 0
+    for i, enc in enumerate(candidates):
+        try:
+            with open(path, "rb") as raw:
+                if bom:
+                    raw.seek(len(codecs.BOM_UTF8))
+                with io.TextIOWrapper(raw, encoding=enc, newline="") as f:
+                    # Los saltos de línea, comillas y delimitadores son ASCII en todas las
+                    # candidatas, así que las filas coinciden una a una al releer
+                    for n, r in enumerate(csv.DictReader(f, delimiter=delimiter)):
+                        if n < yielded:
+                            continue
+                        yield dict((k.strip().lower(), (v or "")) for k, v in r.items() if k is not None)
+                        yielded += 1
+            return
+        except UnicodeDecodeError:
+            if i == len(candidates) - 1:
+                raise
+            console(f"CSV: bytes no válidos en {enc} tras {yielded} filas; se lee como {candidates[i + 1]}.")
 
-    reader = csv.DictReader(raw_text.splitlines(), delimiter=delimiter)
-    rows = [dict((k.strip().lower(), (v or "")) for k, v in r.items()) for r in reader]
-    return rows
+def load_prompts_csv(path: str) -> List[Dict[str, str]]:
+    return list(iter_prompts_csv(path))
+
+def shuffle_stream(rows, buffer_size: int = 10000):
+    """
+    Barajado con memoria acotada: mantiene un buffer de buffer_size filas y emite una al
+    azar por cada fila nueva. Con ficheros menores que el buffer equivale a random.shuffle.
+    """
+    buf = []
+    for row in rows:
+        if len(buf) < buffer_size:
+            buf.append(row)
+            continue
+        i = random.randrange(buffer_size)
+        yield buf[i]
+        buf[i] = row
+    random.shuffle(buf)
+    yield from buf
 
 def safe_name(s: str) -> str:
     if not s:
@@ -105,25 +283,1136 @@ def safe_name(s: str) -> str:
     s = re.sub(r'[^A-Za-z0-9._-]+', '_', str(s)).strip('_')
     return (s or "noid")[:64]
 
+class ProviderHTTPError(RuntimeError):
+    """Respuesta HTTP de error de un proveedor; conserva estado y cabeceras."""
+    def __init__(self, message: str, status: Optional[int] = None, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = dict(headers or {})
+
+def http_status_and_headers(e: BaseException):
+    """(status, cabeceras) de un error de requests / httpx / openai / ProviderHTTPError, si los hay."""
+    if isinstance(e, ProviderHTTPError):
+        return e.status, e.headers
+    resp = getattr(e, "response", None)
+    status = getattr(e, "status_code", None) or getattr(resp, "status_code", None)
+    headers = getattr(resp, "headers", None)
+    return status, (dict(headers) if headers is not None else {})
+
+# ---------- Control de ritmo ----------
+def _header_seconds(v) -> Optional[float]:
+    """'2', '1.5', '250ms', '6m0s', o un epoch; devuelve segundos desde ahora."""
+    if v is None:
+        return None
+    v = str(v).strip()
+    try:
+        x = float(v)
+        return max(0.0, x - time.time()) if x > 1e9 else x
+    except ValueError:
+        pass
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", v)
+    if not parts:
+        return None
+    mult = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(n) * mult[u] for n, u in parts)
+
+class RateController:
+    """
+    Control de ritmo por proveedor (token bucket con AIMD), en lugar de una pausa fija:
+    - Sin límite mientras el proveedor no se queje, o max_rps si se configuró (1/delay_seconds).
+    - 429/503: ritmo a la mitad (del actual o del observado) y pausa según Retry-After /
+      x-ratelimit-reset, con jitter.
+    - Cada éxito suma INCREASE req/s; tras RECOVER_SECONDS sin avisos vuelve a su techo.
+    - x-ratelimit-remaining a 0-1: se espera al reset antes de la siguiente petición.
+    Sirve a la vez a hilos (acquire) y a asyncio (aacquire). El cliente (y su limitador) se
+    comparte entre trabajos del servicio: cada lote se suscribe con listen() mientras corre.
+    """
+    DECREASE = 0.5
+    INCREASE = 0.1
+    MIN_RPS = 0.05
+    RECOVER_SECONDS = 60.0
+    WINDOW_SECONDS = 10.0
+
+    def __init__(self, provider: str, max_rps: Optional[float] = None, on_event=None):
+        self.provider = provider
+        self.max_rps = max_rps
+        self.rate = max_rps
+        self._listeners = [on_event] if on_event else []
+        self.throttle_events = 0
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+        self._blocked_until = 0.0
+        self._last_throttle = 0.0
+        self._recent = collections.deque()
+
+    def current_rps(self) -> Optional[float]:
+        return round(self.rate, 3) if self.rate else None
+
+    @contextlib.contextmanager
+    def listen(self, fn):
+        """Suscribe fn a los eventos de ritmo mientras dura el bloque."""
+        with self._lock:
+            self._listeners.append(fn)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._listeners.remove(fn)
+
+    def on_event(self, ev: Dict[str, Any]):
+        with self._lock:
+            listeners = list(self._listeners)
+        for fn in listeners:
+            fn(dict(ev))
+
+    def _reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._blocked_until)
+            if self.rate:
+                start = max(start, self._next_slot)
+                self._next_slot = start + 1.0 / self.rate
+            self._recent.append(start)
+            while self._recent and self._recent[0] < now - self.WINDOW_SECONDS:
+                self._recent.popleft()
+            return start - now
+
+    def acquire(self):
+        wait_s = self._reserve()
+        if wait_s > 0:
+            time.sleep(wait_s)
+
+    async def aacquire(self):
+        wait_s = self._reserve()
+        if wait_s > 0:
+            await asyncio.sleep(wait_s)
+
+    def _observed_rps(self, now: float) -> float:
+        if len(self._recent) < 2:
+            return self.MIN_RPS * 2
+        return len(self._recent) / max(1.0, now - self._recent[0])
+
+    def on_success(self, headers=None):
+        event = None
+        with self._lock:
+            now = time.monotonic()
+            if self.rate is not None and self.rate != self.max_rps:
+                if now - self._last_throttle >= self.RECOVER_SECONDS:
+                    self.rate = self.max_rps
+                    event = {"event": "rate_recovered", "rate_rps": self.current_rps()}
+                else:
+                    self.rate = min(self.rate + self.INCREASE, self.max_rps or float("inf"))
+        if event:
+            self.on_event(event)
+        if headers:
+            self._apply_headers(headers)
+
+    def on_error(self, e: BaseException):
+        status, headers = http_status_and_headers(e)
+        if status in (429, 503):
+            self._throttle(status, headers)
+        elif headers:
+            self._apply_headers(headers)
+
+    def _throttle(self, status: int, headers):
+        h = {str(k).lower(): v for k, v in (headers or {}).items()}
+        hinted = _header_seconds(h.get("retry-after")) or _header_seconds(h.get("x-ratelimit-reset"))
+        with self._lock:
+            now = time.monotonic()
+            base = self.rate or self._observed_rps(now)
+            self.rate = max(self.MIN_RPS, base * self.DECREASE)
+            wait_s = (hinted if hinted is not None else 1.0 / self.rate) * random.uniform(1.0, 1.5)
+            self._blocked_until = max(self._blocked_until, now + wait_s)
+            self._last_throttle = now
+            self.throttle_events += 1
+            rate = self.current_rps()
+        self.on_event({"event": "throttle", "status": status, "rate_rps": rate, "wait_seconds": round(wait_s, 2)})
+
+    def _apply_headers(self, headers):
+        h = {str(k).lower(): v for k, v in headers.items()}
+        remaining = h.get("x-ratelimit-remaining", h.get("x-ratelimit-remaining-requests"))
+        reset = _header_seconds(h.get("x-ratelimit-reset", h.get("x-ratelimit-reset-requests")))
+        try:
+            remaining = int(float(remaining)) if remaining is not None else None
+        except ValueError:
+            remaining = None
+        if remaining is not None and remaining <= 1 and reset:
+            with self._lock:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + reset * random.uniform(1.0, 1.2))
+
+# ---------- Clientes HTTP ----------
+class ProviderClient:
+    """
+    Recursos de red de una ejecución: una requests.Session con pool de conexiones
+    (keep-alive, sin handshake TCP/TLS por imagen) y un único cliente OpenAI.
+    Es seguro compartirlo entre los hilos del pool de generación.
+    """
+    def __init__(self, pool_size: int = 1, limiter: Optional[RateController] = None,
+                 balancer: Optional["A1111Balancer"] = None):
+        self.limiter = limiter or RateController("")
+        self.balancer = balancer
+        self.checkpoints: Dict[str, str] = {}       # nodo A1111 -> checkpoint fijado en la validación
+        self.warmup: List[Dict[str, Any]] = []      # filas de calentamiento pendientes de manifiesto
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(1, pool_size))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._openai = None
+        self._openai_key = None
+        self._lock = threading.Lock()
+
+    def openai(self, api_key: str):
+        with self._lock:
+            if self._openai is None or self._openai_key != api_key:
+                self._openai = openai_sdk().OpenAI(api_key=api_key)
+                self._openai_key = api_key
+            return self._openai
+
+    def close(self):
+        if self.balancer is not None:
+            self.balancer.close()
+        self.session.close()
+        if self._openai is not None:
+            try:
+                self._openai.close()
+            except Exception:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class AsyncProviderClient:
+    """
+    Equivalente asíncrono de ProviderClient para el motor asyncio: pool_size conexiones
+    keep-alive repartidas en varios httpx.AsyncClient y un único AsyncOpenAI.
+    """
+    # El pool de httpcore recorre todas sus conexiones por cada petición en cola; con
+    # cientos de conexiones en un solo cliente eso domina el tiempo (x8 a 200 en vuelo).
+    SHARD_CONNECTIONS = 16
+
+    def __init__(self, pool_size: int = 1, limiter: Optional[RateController] = None,
+                 balancer: Optional["A1111Balancer"] = None, checkpoints: Optional[Dict[str, str]] = None):
+        self.limiter = limiter or RateController("")
+        self.balancer = balancer
+        self.checkpoints = checkpoints or {}
+        httpx = httpx_module()
+        pool_size = max(1, pool_size)
+        per_shard = min(pool_size, self.SHARD_CONNECTIONS)
+        limits = httpx.Limits(max_connections=per_shard, max_keepalive_connections=per_shard)
+        self._shards = [httpx.AsyncClient(limits=limits, timeout=None)
+                        for _ in range(-(-pool_size // per_shard))]
+        self._next = 0
+        self._openai = None
+        self._openai_key = None
+
+    @property
+    def http(self):
+        """Cliente httpx para la siguiente petición (reparto round-robin entre shards)."""
+        self._next = (self._next + 1) % len(self._shards)
+        return self._shards[self._next]
+
+    def openai(self, api_key: str):
+        if self._openai is None or self._openai_key != api_key:
+            self._openai = openai_sdk().AsyncOpenAI(api_key=api_key)
+            self._openai_key = api_key
+        return self._openai
+
+    async def aclose(self):
+        for c in self._shards:
+            await c.aclose()
+        if self._openai is not None:
+            try:
+                await self._openai.close()
+            except Exception:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+# ---------- Balanceo entre nodos A1111 ----------
+@dataclass
+class A1111Node:
+    url: str
+    in_flight: int = 0      # peticiones nuestras en curso
+    queue: int = 0          # state.job_count de /sdapi/v1/progress (último sondeo)
+    healthy: bool = True
+    jobs: int = 0
+    failures: int = 0
+
+    @property
+    def load(self) -> int:
+        # job_count ya incluye nuestra petición en curso: se toma el mayor, no la suma
+        return max(self.in_flight, self.queue)
+
+class NoEndpointError(ConnectionError):
+    pass
+
+class A1111Balancer:
+    """
+    Reparte las peticiones entre varias instancias de la WebUI: cada una va al nodo sano menos
+    ocupado (peticiones en curso y cola según /sdapi/v1/progress). Un nodo que falla por red o 5xx
+    sale de la rotación y la petición se repite en otro; un hilo de sondeo lo devuelve a la
+    rotación cuando vuelve a responder.
+    """
+    def __init__(self, urls: List[str], probe_seconds: float = 5.0):
+        self.nodes = [A1111Node(u.rstrip("/")) for u in urls]
+        self.probe_seconds = probe_seconds
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._session = requests.Session()
+        self._thread: Optional[threading.Thread] = None
+
+    def probe(self, node: A1111Node) -> bool:
+        try:
+            r = self._session.get(f"{node.url}/sdapi/v1/progress?skip_current_image=true", timeout=2)
+            r.raise_for_status()
+            depth = int(((r.json() or {}).get("state") or {}).get("job_count") or 0)
+        except Exception:
+            with self._lock:
+                if node.healthy:
+                    node.healthy = False
+                    console(f"Nodo A1111 fuera de rotación: {node.url} (no responde)")
+            return False
+        with self._lock:
+            node.queue = depth
+            if not node.healthy:
+                node.healthy = True
+                console(f"Nodo A1111 de vuelta en rotación: {node.url}")
+        return True
+
+    def probe_all(self) -> int:
+        return sum(self.probe(n) for n in self.nodes)
+
+    def _probe_loop(self):
+        while not self._stop.wait(self.probe_seconds):
+            self.probe_all()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._probe_loop, name="a1111-probe", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._session.close()
+
+    def healthy_count(self) -> int:
+        with self._lock:
+            return sum(n.healthy for n in self.nodes)
+
+    def pick(self) -> A1111Node:
+        with self._lock:
+            healthy = [n for n in self.nodes if n.healthy]
+            if not healthy:
+                raise NoEndpointError("No healthy Automatic1111 endpoint")
+            node = min(healthy, key=lambda n: (n.load, n.jobs))
+            node.in_flight += 1
+            return node
+
+    def release(self, node: A1111Node, error: Optional[BaseException] = None) -> bool:
+        """Libera el nodo. Devuelve True si el error es del nodo (red/5xx) y se ha sacado de la rotación."""
+        down = error is not None and classify_error("automatic1111", error) in (ERR_NETWORK, ERR_SERVER)
+        with self._lock:
+            node.in_flight -= 1
+            if error is None:
+                node.jobs += 1
+            elif down:
+                node.failures += 1
+                if node.healthy:
+                    node.healthy = False
+                    console(f"Nodo A1111 fuera de rotación: {node.url} ({str(error) or repr(error)})")
+        return down
+
+    def summary(self) -> str:
+        with self._lock:
+            return ", ".join(f"{n.url}: {n.jobs} ok/{n.failures} fallos" for n in self.nodes)
+
+def balanced_call(balancer: A1111Balancer, fn):
+    """
+    Ejecuta fn(url) en el nodo menos ocupado. Si el nodo falla, se reencola la petición en otro
+    nodo sano (sin contar como reintento); si no queda ninguno, el error sube a run_job.
+    """
+    for _ in range(len(balancer.nodes)):
+        node = balancer.pick()
+        try:
+            out = fn(node.url)
+        except Exception as e:
+            if balancer.release(node, e) and balancer.healthy_count():
+                continue
+            raise
+        balancer.release(node)
+        out["endpoint"] = node.url
+        return out
+    raise NoEndpointError("No healthy Automatic1111 endpoint")
+
+async def abalanced_call(balancer: A1111Balancer, afn):
+    for _ in range(len(balancer.nodes)):
+        node = balancer.pick()
+        try:
+            out = await afn(node.url)
+        except Exception as e:
+            if balancer.release(node, e) and balancer.healthy_count():
+                continue
+            raise
+        balancer.release(node)
+        out["endpoint"] = node.url
+        return out
+    raise NoEndpointError("No healthy Automatic1111 endpoint")
+
+
+# ---------- Guardado en streaming ----------
+STREAM_CHUNK = 64 * 1024
+
+class ImageSink:
+    """
+    Escribe una imagen por trozos en un temporal del directorio destino, hasheándola en la
+    misma pasada. El nombre definitivo (que lleva el hash) se da después con commit_image().
+    """
+    def __init__(self, dir_path: str, ext: str = ".png"):
+        ensure_dir(dir_path)
+        # open() en vez de mkstemp: el fichero final conserva los permisos habituales (umask)
+        self.tmp_path = os.path.join(dir_path, f".part-{os.urandom(8).hex()}{ext}")
+        self.f = open(self.tmp_path, "xb")
+        self.h = hashlib.sha256()
+        self.size = 0
+
+    def write(self, b: bytes):
+        self.h.update(b)
+        self.f.write(b)
+        self.size += len(b)
+
+    def close(self) -> Dict[str, Any]:
+        self.f.close()
+        return {"tmp_path": self.tmp_path, "sha256": self.h.hexdigest(), "bytes": self.size}
+
+    def discard(self):
+        self.f.close()
+        discard_image({"tmp_path": self.tmp_path})
+
+class Base64Sink(ImageSink):
+    """ImageSink que recibe base64 (con o sin prefijo data:) y escribe los bytes decodificados."""
+    def __init__(self, dir_path: str):
+        super().__init__(dir_path)
+        self.pending = b""
+        self.started = False
+
+    def write_b64(self, s: bytes):
+        s = self.pending + s.replace(b"\\", b"")  # JSON puede escapar "/" como "\/"
+        if not self.started:
+            if len(s) < 64:
+                self.pending = s
+                return
+            if s.startswith(b"data:"):
+                s = s.split(b",", 1)[-1]
+            self.started = True
+        cut = len(s) - len(s) % 4
+        self.pending = s[cut:]
+        if cut:
+            self.write(base64.b64decode(s[:cut]))
+
+    def close(self) -> Dict[str, str]:
+        s = self.pending
+        if not self.started and s.startswith(b"data:"):
+            s = s.split(b",", 1)[-1]
+        if s:
+            self.write(base64.b64decode(s + b"=" * (-len(s) % 4)))
+        return super().close()
+
+class RawImageStream:
+    """Cuerpo binario (Stability con Accept: image/*) -> un único temporal."""
+    def __init__(self, save_dir: str):
+        self.sink = ImageSink(save_dir)
+
+    def feed(self, chunk: bytes):
+        self.sink.write(chunk)
+
+    def finish(self) -> List[Dict[str, str]]:
+        return [self.sink.close()]
+
+    def discard(self):
+        self.sink.discard()
+
+class A1111ImageStream:
+    """
+    Respuesta JSON de txt2img leída por trozos: las cadenas base64 de "images" se decodifican
+    directamente a temporales y el resto del documento (parameters, info) se guarda en meta,
+    con "images" vacío. Así nunca está en memoria la respuesta completa ni la imagen decodificada.
+    """
+    IMAGES_KEY = re.compile(rb'"images"\s*:\s*\[')
+
+    def __init__(self, save_dir: str):
+        self.save_dir = save_dir
+        self.meta = bytearray()
+        self.state = "head"
+        self.sink = None
+        self.sinks: List[Base64Sink] = []
+
+    def feed(self, chunk: bytes):
+        i = 0
+        while i < len(chunk):
+            if self.state == "head":
+                self.meta += chunk[i:]
+                m = self.IMAGES_KEY.search(self.meta)
+                if not m:
+                    return
+                chunk, i = bytes(self.meta[m.end():]), 0
+                del self.meta[m.end():]
+                self.state = "list"
+            elif self.state == "list":
+                c = chunk[i:i + 1]
+                if c == b'"':
+                    self.sink = Base64Sink(self.save_dir)
+                    self.sinks.append(self.sink)
+                    self.state = "image"
+                elif c == b"]":
+                    self.meta += b"]"
+                    self.state = "tail"
+                i += 1
+            elif self.state == "image":
+                j = chunk.find(b'"', i)
+                if j < 0:
+                    self.sink.write_b64(chunk[i:])
+                    return
+                self.sink.write_b64(chunk[i:j])
+                self.state = "list"
+                i = j + 1
+            else:  # tail
+                self.meta += chunk[i:]
+                return
+
+    def finish(self):
+        """Devuelve (documento sin imágenes, temporales de las imágenes en orden)."""
+        if self.state in ("list", "image"):
+            raise RuntimeError("Automatic1111 response truncated while reading images.")
+        saved = [s.close() for s in self.sinks]
+        self.sinks = []
+        return json.loads(bytes(self.meta)), saved
+
+    def discard(self):
+        for s in self.sinks:
+            s.discard()
+        self.sinks = []
+
+def consume_stream(parser, chunks):
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+        return parser.finish()
+    except BaseException:
+        parser.discard()
+        raise
+
+async def aconsume_stream(parser, chunks):
+    """Como consume_stream; las escrituras a disco van a un hilo para no bloquear el bucle de eventos."""
+    try:
+        async for chunk in chunks:
+            await asyncio.to_thread(parser.feed, chunk)
+        return await asyncio.to_thread(parser.finish)
+    except BaseException:
+        parser.discard()
+        raise
+
+def stage_image_bytes(img_bytes: bytes, dir_path: str) -> Dict[str, str]:
+    """Imagen ya en memoria (OpenAI, o llamadas sin save_dir) -> temporal, igual que en streaming."""
+    sink = ImageSink(dir_path)
+    try:
+        sink.write(img_bytes)
+    except BaseException:
+        sink.discard()
+        raise
+    return sink.close()
+
+def commit_image(staged: Dict[str, str], path: str):
+    os.replace(staged["tmp_path"], path)  # atómico: nunca queda un PNG a medias con el nombre final
+
+def discard_image(staged: Dict[str, str]):
+    try:
+        os.remove(staged["tmp_path"])
+    except OSError:
+        pass
+
+
+# ---------- Post-proceso (recodificación y miniaturas) ----------
+OUTPUT_FORMATS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg", "avif": ".avif"}
+THUMB_DIR = "thumbs"
+_encode_warned = set()
+
+def needs_encoding(rc: RunConfig) -> bool:
+    return rc.output_format != "png" or rc.png_compress_level is not None
+
+def post_workers(rc: RunConfig) -> int:
+    """Hilos de post-proceso: los de config, o más si hay que recodificar o hacer miniaturas (CPU)."""
+    if rc.post_workers > 0:
+        return rc.post_workers
+    if needs_encoding(rc) or rc.thumbnail_px:
+        return max(2, min(8, os.cpu_count() or 2))
+    return 2
+
+def encode_options(rc: RunConfig) -> Dict[str, Any]:
+    """Parámetros de Image.save() para rc.output_format."""
+    fmt, q = rc.output_format, rc.output_quality
+    if fmt == "png":
+        return {"compress_level": 6 if rc.png_compress_level is None else rc.png_compress_level}
+    if fmt == "webp":
+        return {"lossless": rc.output_lossless, "quality": q, "method": 4}
+    if fmt == "jpeg":
+        # calidad alta: sin submuestreo de color (4:4:4)
+        return {"quality": q, "subsampling": 0 if q >= 90 else 2, "optimize": True}
+    return {"quality": q, "speed": 6}  # avif
+
+def encode_image(staged: Dict[str, Any], rc: RunConfig, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Recodifica el temporal del proveedor según rc en otro temporal, con Pillow. Conserva el sha256
+    y el tamaño del original (el hash del nombre de fichero) y añade los del fichero guardado.
+    Los textos PNG (p. ej. "parameters" de A1111) se mantienen al recomprimir PNG; meta se embebe
+    como iTXt en PNG y como UserComment EXIF en el resto.
+    Si no se puede recodificar, se queda el original (con meta embebido si es PNG), se avisa una vez
+    por formato y el error va en "encode_error" para que conste en la fila.
+    """
+    fmt = rc.output_format
+    try:
+        from PIL import Image
+        if fmt == "avif" and not _pil_has("avif"):
+            import pillow_avif  # noqa: F401  (plugin para Pillow < 11.2)
+        buf = io.BytesIO()
+        with Image.open(staged["tmp_path"]) as im:
+            opts = encode_options(rc)
+            if fmt == "png" and (getattr(im, "text", None) or meta is not None):
+                from PIL.PngImagePlugin import PngInfo
+                info = PngInfo()
+                for k, v in getattr(im, "text", {}).items():
+                    if k != METADATA_KEY:
+                        info.add_itxt(k, v)
+                if meta is not None:
+                    info.add_itxt(METADATA_KEY, json.dumps(meta, ensure_ascii=False))
+                opts["pnginfo"] = info
+            elif meta is not None:
+                exif = Image.Exif()
+                exif.get_ifd(EXIF_IFD)[EXIF_USER_COMMENT] = EXIF_UNICODE + json.dumps(meta, ensure_ascii=False).encode("utf-16-be")
+                opts["exif"] = exif.tobytes()
+            if fmt == "jpeg" and im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            im.save(buf, format=fmt.upper(), **opts)
+        sink = ImageSink(os.path.dirname(staged["tmp_path"]), OUTPUT_FORMATS[fmt])
+        try:
+            sink.write(buf.getbuffer())
+        except BaseException:
+            sink.discard()
+            raise
+        stored = sink.close()
+    except Exception as e:
+        if fmt not in _encode_warned:
+            _encode_warned.add(fmt)
+            console(f"No se pudo recodificar a {fmt} ({e}); se guarda la imagen original.")
+        staged = dict(staged, encode_error=str(e) or repr(e))
+        return embed_png_metadata(staged, meta) if meta is not None else staged
+    discard_image(staged)
+    return dict(staged, tmp_path=stored["tmp_path"], ext=OUTPUT_FORMATS[fmt], format=fmt,
+                stored_sha256=stored["sha256"], stored_bytes=stored["bytes"])
+
+def _pil_has(feature: str) -> bool:
+    from PIL import features
+    try:
+        return bool(features.check(feature))
+    except ValueError:
+        return False  # Pillow sin ese feature registrado
+
+def write_thumbnail(path: str, prompt_dir: str, px: int) -> Optional[str]:
+    """Miniatura JPEG (lado mayor px) en <prompt_dir>/thumbs/, con el mismo nombre que la imagen."""
+    thumb_dir = os.path.join(prompt_dir, THUMB_DIR)
+    thumb = os.path.join(thumb_dir, os.path.splitext(os.path.basename(path))[0] + ".jpg")
+    tmp = f"{thumb}.{os.urandom(4).hex()}.part"
+    try:
+        from PIL import Image
+        ensure_dir(thumb_dir)
+        with Image.open(path) as im:
+            im.thumbnail((px, px))
+            im.convert("RGB").save(tmp, format="JPEG", quality=85)
+        os.replace(tmp, thumb)
+        return thumb
+    except Exception as e:
+        discard_image({"tmp_path": tmp})
+        console(f"Miniatura no generada para {os.path.basename(path)} ({e})")
+        return None
+
+# ---------- Metadatos embebidos ----------
+# Cada imagen lleva su prompt, semilla y parámetros (JSON) para no tener que buscarla en el manifiesto:
+# PNG en un chunk iTXt "batchkit"; WebP/JPEG/AVIF en el UserComment EXIF, como hace A1111.
+METADATA_KEY = "batchkit"
+EXIF_IFD = 0x8769
+EXIF_USER_COMMENT = 0x9286
+EXIF_UNICODE = b"UNICODE\0"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_IEND = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+IMAGE_EXTS = tuple(OUTPUT_FORMATS.values())
+# Campos de la fila del manifiesto que se embeben (además del prompt y los parámetros)
+METADATA_ROW_FIELDS = ("timestamp", "provider", "prompt_id", "replicate_index", "sha256_16",
+                       "prompt_sha256_16", "params_sha256_16", "seed", "endpoint")
+
+def image_metadata(row: Dict[str, Any], job: "Job") -> Dict[str, Any]:
+    meta = {k: row[k] for k in METADATA_ROW_FIELDS if k in row}
+    meta["prompt"] = job.prompt_text
+    if job.params:
+        meta["params"] = job.params
+    return meta
+
+def png_chunk(ctype: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + ctype + data + struct.pack(">I", zlib.crc32(ctype + data))
+
+def embed_png_metadata(staged: Dict[str, Any], meta: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copia el PNG del proveedor a otro temporal con un chunk iTXt antes de IEND, sin decodificarlo
+    (el original puede estar enlazado en la caché de resultados, así que no se toca).
+    Si no es un PNG bien cerrado, se deja como está.
+    """
+    path = staged["tmp_path"]
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(8)
+        f.seek(max(0, size - len(PNG_IEND)))
+        tail = f.read()
+    if head != PNG_SIGNATURE or tail != PNG_IEND:
+        return staged
+    text = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    itxt = png_chunk(b"iTXt", METADATA_KEY.encode("latin-1") + b"\0\0\0\0\0" + text)
+    sink = ImageSink(os.path.dirname(path))
+    try:
+        with open(path, "rb") as f:
+            left = size - len(PNG_IEND)
+            while left > 0:
+                chunk = f.read(min(STREAM_CHUNK, left))
+                if not chunk:
+                    raise OSError(f"{path} shrank while copying")
+                sink.write(chunk)
+                left -= len(chunk)
+        sink.write(itxt)
+        sink.write(PNG_IEND)
+    except BaseException:
+        sink.discard()
+        raise
+    stored = sink.close()
+    discard_image(staged)
+    return dict(staged, tmp_path=stored["tmp_path"], stored_sha256=stored["sha256"], stored_bytes=stored["bytes"])
+
+def read_png_metadata(path: str) -> Optional[Dict[str, Any]]:
+    """Recorre los chunks saltando los datos de imagen (seek) hasta el iTXt "batchkit"."""
+    key = METADATA_KEY.encode("latin-1") + b"\0"
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        while True:
+            hdr = f.read(8)
+            if len(hdr) < 8:
+                return None
+            n, ctype = struct.unpack(">I4s", hdr)
+            if ctype == b"IEND":
+                return None
+            if ctype in (b"iTXt", b"tEXt"):
+                data = f.read(n)
+                f.seek(4, 1)
+                if data.startswith(key):
+                    body = data[len(key):]
+                    if ctype == b"iTXt":
+                        if body[:1] != b"\0":
+                            body = zlib.decompress(body[2:].split(b"\0", 2)[2])
+                        else:
+                            body = body[2:].split(b"\0", 2)[2]
+                    return json.loads(body.decode("utf-8" if ctype == b"iTXt" else "latin-1"))
+            else:
+                f.seek(n + 4, 1)
+
+def read_image_metadata(path: str) -> Optional[Dict[str, Any]]:
+    """Metadatos embebidos por el generador en una imagen (None si no tiene o no se pueden leer)."""
+    try:
+        if path.lower().endswith(".png"):
+            return read_png_metadata(path)
+        from PIL import Image
+        if path.lower().endswith(".avif") and not _pil_has("avif"):
+            import pillow_avif  # noqa: F401
+        with Image.open(path) as im:  # sólo lee la cabecera, no decodifica
+            raw = im.getexif().get_ifd(EXIF_IFD).get(EXIF_USER_COMMENT)
+        if isinstance(raw, bytes) and raw.startswith(EXIF_UNICODE):
+            return json.loads(raw[len(EXIF_UNICODE):].decode("utf-16-be"))
+    except (OSError, ValueError, ImportError, SyntaxError, zlib.error):
+        pass
+    return None
+
+def iter_image_files(out_root: str):
+    """Imágenes bajo <out>/<provider>/ (sin miniaturas ni temporales); las del almacén dedup, al final."""
+    objects = []
+    for root, dirs, files in os.walk(out_root):
+        dirs[:] = sorted(d for d in dirs if d not in (THUMB_DIR, ".cache"))
+        in_objects = os.path.relpath(root, out_root).split(os.sep)[0] == "objects"
+        for name in sorted(files):
+            if not name.lower().endswith(IMAGE_EXTS) or name.startswith(".part-"):
+                continue
+            if in_objects:
+                objects.append(os.path.join(root, name))
+            else:
+                yield os.path.join(root, name)
+    yield from objects
+
+def rebuild_manifest(out_root: str, out_path: str, ledger: Optional["JobLedger"] = None,
+                     workers: int = 0) -> Tuple[int, int]:
+    """
+    Reconstruye el manifiesto a partir de los metadatos embebidos en las imágenes, leyéndolas en
+    paralelo. Una fila por réplica: la imagen más reciente, y las del almacén dedup sólo si la
+    réplica no aparece en otra carpeta. Si se pasa ledger, marca como done las réplicas que no lo
+    estuvieran. Devuelve (filas escritas, imágenes sin metadatos).
+    """
+    workers = workers or min(32, 4 * (os.cpu_count() or 2))
+    objects_dir = os.path.join(out_root, "objects") + os.sep
+    best, missing = {}, 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="meta") as pool:
+        paths = list(iter_image_files(out_root))
+        for path, meta in zip(paths, pool.map(read_image_metadata, paths, chunksize=64)):
+            if not meta or "replicate_index" not in meta:
+                missing += 1
+                continue
+            key = (str(meta.get("prompt_id")), meta["replicate_index"],
+                   meta.get("prompt_sha256_16"), meta.get("params_sha256_16"))
+            rank = (not path.startswith(objects_dir), meta.get("timestamp") or "")
+            if key in best and best[key][0] >= rank:
+                continue
+            row = {k: meta[k] for k in METADATA_ROW_FIELDS if k in meta}
+            row["file_path"] = path
+            row["stored_bytes"] = os.path.getsize(path)
+            fmt = next((f for f, ext in OUTPUT_FORMATS.items() if path.lower().endswith(ext)), "png")
+            if fmt != "png":
+                row["format"] = fmt
+            row["rebuilt"] = True
+            best[key] = (rank, row)
+    rows = sorted((row for _, row in best.values()), key=lambda r: r.get("timestamp") or "")
+    tmp = f"{out_path}.{os.urandom(4).hex()}.part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(tmp, out_path)
+    if ledger is not None:
+        ledger.import_rows(rows)
+    return len(rows), missing
+
+
+# ---------- Almacén por contenido (dedup) ----------
+DEDUP_MODES = ("off", "hardlink", "symlink", "reference")
+
+class ObjectStore:
+    """
+    Almacén direccionado por contenido: cada imagen se guarda una sola vez en
+    <out_root>/objects/<sha[:2]>/<sha256>.png, con el hash de los bytes guardados (ya recodificados
+    y con sus metadatos embebidos: dos réplicas sólo comparten objeto si sus ficheros son idénticos). La ruta por prompt pasa a ser un hardlink o
+    symlink al objeto ("hardlink"/"symlink") o sólo una referencia en el manifiesto ("reference").
+    Si el sistema de ficheros no admite el enlace, se baja al siguiente modo y se avisa una vez.
+    """
+    def __init__(self, root: str, mode: str = "hardlink"):
+        self.root = root
+        self.mode = mode
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.deduped = 0
+        self.bytes_saved = 0
+
+    def object_path(self, sha256: str, ext: str = ".png") -> str:
+        return os.path.join(self.root, sha256[:2], sha256 + ext)
+
+    def put(self, staged: Dict[str, str], path: str):
+        """Guarda el temporal como objeto (o lo descarta si ya existía). Devuelve (ruta para el manifiesto, duplicado)."""
+        obj = self.object_path(stored_sha256(staged), staged.get("ext", ".png"))
+        ensure_dir(os.path.dirname(obj))
+        dup = os.path.exists(obj)
+        if dup:
+            size = os.path.getsize(obj)
+            discard_image(staged)
+        else:
+            os.replace(staged["tmp_path"], obj)
+        with self._lock:
+            if dup:
+                self.deduped += 1
+                self.bytes_saved += size
+            else:
+                self.stored += 1
+        return self._link(obj, path), dup
+
+    def _link(self, obj: str, path: str) -> str:
+        mode = self.mode
+        if mode == "hardlink":
+            try:
+                self._replace_link(lambda dst: os.link(obj, dst), path)
+                return path
+            except OSError as e:
+                mode = self._fallback("hardlink", "symlink", e)
+        if mode == "symlink":
+            try:
+                self._replace_link(lambda dst: os.symlink(os.path.relpath(obj, os.path.dirname(path)), dst), path)
+                return path
+            except OSError as e:
+                self._fallback("symlink", "reference", e)
+        return obj
+
+    @staticmethod
+    def _replace_link(make, path: str):
+        """Crea el enlace; si ya existe (reintento o rerun de la réplica) lo sustituye de forma atómica."""
+        try:
+            make(path)
+        except FileExistsError:
+            tmp = f"{path}.{os.urandom(4).hex()}.part"
+            make(tmp)
+            try:
+                os.replace(tmp, path)
+            except OSError:
+                discard_image({"tmp_path": tmp})
+                raise
+
+    def _fallback(self, mode: str, to: str, e: OSError) -> str:
+        with self._lock:
+            if self.mode == mode:
+                self.mode = to
+                console(f"Dedup: {mode} no disponible ({e}); se usa {to}.")
+            return self.mode
+
+def stored_sha256(staged: Dict[str, Any]) -> str:
+    """Hash del fichero que se va a guardar: el recodificado/con metadatos si lo hay, si no el original."""
+    return staged.get("stored_sha256") or staged["sha256"]
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def dedup_report(manifest_path: str, top: int = 10) -> Dict[str, Any]:
+    """
+    Informe de duplicados de un manifiesto: imágenes, contenidos únicos, bytes en disco y bytes
+    recuperables (copias físicas de un contenido que ya está en otro fichero). Sirve también para
+    salidas generadas sin almacén por contenido: hashea los ficheros que no traen object_sha256.
+    """
+    groups: Dict[str, Dict[str, Any]] = {}
+    missing = 0
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if '"file_path"' not in line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            path = row.get("file_path")
+            if not path or not os.path.exists(path):
+                missing += 1
+                continue
+            st = os.stat(path)
+            sha = row.get("object_sha256") or _file_sha256(path)
+            g = groups.setdefault(sha, {"size": st.st_size, "paths": set(), "inodes": set()})
+            g["paths"].add(os.path.abspath(path))
+            g["inodes"].add((st.st_dev, st.st_ino))
+
+    images = sum(len(g["paths"]) for g in groups.values())
+    copies = sum(len(g["inodes"]) for g in groups.values())
+    return {
+        "manifest": manifest_path,
+        "images": images,
+        "unique_contents": len(groups),
+        "duplicate_images": images - len(groups),
+        "missing_files": missing,
+        "bytes_on_disk": sum(len(g["inodes"]) * g["size"] for g in groups.values()),
+        "bytes_logical": sum(len(g["paths"]) * g["size"] for g in groups.values()),
+        "bytes_reclaimable": sum((len(g["inodes"]) - 1) * g["size"] for g in groups.values()),
+        "physical_copies": copies,
+        "top_duplicates": [
+            {"sha256": sha, "count": len(g["paths"]), "size": g["size"], "paths": sorted(g["paths"])[:5]}
+            for sha, g in sorted(groups.items(), key=lambda kv: (len(kv[1]["paths"]) - 1) * kv[1]["size"],
+                                 reverse=True)[:top]
+            if len(g["paths"]) > 1
+        ],
+    }
+
+def stage_file(path: str, dir_path: str) -> Dict[str, Any]:
+    """Copia un fichero a un temporal de dir_path (rehasheándolo), como si llegara del proveedor."""
+    sink = ImageSink(dir_path)
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK), b""):
+                sink.write(chunk)
+    except BaseException:
+        sink.discard()
+        raise
+    return sink.close()
+
+def print_dedup_report(rep: Dict[str, Any]):
+    mb = lambda n: f"{n / 2**20:.1f} MB"
+    print(f"Imágenes en el manifiesto: {rep['images']} ({rep['missing_files']} ficheros no encontrados)")
+    print(f"Contenidos únicos: {rep['unique_contents']}  duplicadas: {rep['duplicate_images']}")
+    print(f"Tamaño lógico: {mb(rep['bytes_logical'])}  en disco: {mb(rep['bytes_on_disk'])}"
+          f"  recuperable con dedup: {mb(rep['bytes_reclaimable'])}")
+    for d in rep["top_duplicates"]:
+        print(f"  {d['sha256'][:16]}  x{d['count']}  {mb(d['size'])}  {d['paths'][0]}")
+
+
+# ---------- Caché de resultados ----------
+class ResultCache:
+    """
+    Caché persistente de resultados con semilla fija: con la misma petición (result_key: proveedor,
+    modelo, engine, sampler, steps, cfg, tamaño, prompt, semilla de la réplica, réplicas que cubre
+    y batch_size) A1111 y Stability devuelven las mismas imágenes, así que se reutilizan sin
+    llamar al proveedor. Un error de SQLite (p. ej. "database is locked" con varios proveedores
+    sobre el mismo <out>/.cache) cuenta como fallo de caché, nunca aborta el lote.
+    Índice SQLite en <dir>/results.sqlite e imágenes en <dir>/blobs/<sha[:2]>/<sha256>.png,
+    compartidas entre entradas. Expulsión LRU cuando los blobs superan max_bytes.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            images TEXT NOT NULL,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used);
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            bytes INTEGER NOT NULL,
+            refs INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.dir = cache_dir
+        self.max_bytes = max_bytes
+        ensure_dir(os.path.join(cache_dir, "blobs"))
+        self.db = sqlite3.connect(os.path.join(cache_dir, "results.sqlite"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.dir, "blobs", sha256[:2], sha256 + ".png")
+
+    def get(self, key: str, save_dir: str) -> Optional[Dict[str, Any]]:
+        """Si hay entrada, copia sus imágenes a temporales de save_dir y devuelve un resultado como el de gen_*."""
+        try:
+            with self._lock:
+                row = self.db.execute("SELECT images FROM entries WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            console(f"Caché: no se pudo leer ({e})")
+            row = None
+        images = json.loads(row[0]) if row else []
+        staged = []
+        try:
+            for im in images:
+                staged.append(stage_file(self.blob_path(im["sha256"]), save_dir))
+                if staged[-1]["sha256"] != im["sha256"]:
+                    raise OSError(f"cached blob {im['sha256'][:16]} is corrupt")
+        except OSError as e:
+            for s in staged:
+                discard_image(s)
+            console(f"Caché: entrada descartada ({e})")
+            try:
+                with self._lock:
+                    self._drop(key)
+            except sqlite3.Error:
+                pass  # se reintenta en el próximo fallo de esa entrada
+            images = []
+        with self._lock:
+            if images:
+                try:
+                    with self.db:
+                        self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+                except sqlite3.Error as e:
+                    console(f"Caché: no se pudo actualizar ({e})")
+                    for s in staged:
+                        discard_image(s)
+                    images = []
+            if not images:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {"saved_images": staged, "seeds": [im.get("seed") for im in images if im.get("seed") is not None]}
+
+    def put(self, key: str, staged: List[Dict[str, Any]]):
+        """
+        Registra las imágenes de un trabajo tal como las devolvió el proveedor (temporales ya
+        hasheados, antes de recodificar), así un acierto pasa por el mismo post-proceso.
+        """
+        images = []
+        for s in staged:
+            sha = s["sha256"]
+            blob = self.blob_path(sha)
+            if not os.path.exists(blob):
+                ensure_dir(os.path.dirname(blob))
+                try:
+                    os.link(s["tmp_path"], blob)
+                except OSError:
+                    tmp = f"{blob}.{os.urandom(4).hex()}.part"
+                    shutil.copyfile(s["tmp_path"], tmp)
+                    os.replace(tmp, blob)
+            images.append({"sha256": sha, "seed": s.get("seed"), "bytes": os.path.getsize(blob)})
+        now = time.time()
+        with self._lock:
+            with self.db:
+                if self.db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone():
+                    return
+                self.db.execute("INSERT INTO entries (key, images, created, last_used) VALUES (?, ?, ?, ?)",
+                                (key, json.dumps(images), now, now))
+                for im in images:
+                    self.db.execute("INSERT INTO blobs (sha256, bytes, refs) VALUES (?, ?, 1) "
+                                    "ON CONFLICT(sha256) DO UPDATE SET refs = refs + 1", (im["sha256"], im["bytes"]))
+            self.stored += 1
+            self._evict()
+
+    def _drop(self, key: str):
+        row = self.db.execute("SELECT images FROM entries WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            for im in json.loads(row[0]):
+                self.db.execute("UPDATE blobs SET refs = refs - 1 WHERE sha256 = ?", (im["sha256"],))
+            dead = [r[0] for r in self.db.execute("SELECT sha256 FROM blobs WHERE refs <= 0")]
+            self.db.execute("DELETE FROM blobs WHERE refs <= 0")
+        for sha in dead:
+            try:
+                os.remove(self.blob_path(sha))
+            except OSError:
+                pass
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM blobs").fetchone()[0]
+        while total > self.max_bytes:
+            row = self.db.execute("SELECT key FROM entries ORDER BY last_used LIMIT 1").fetchone()
+            if not row:
+                break
+            self._drop(row[0])
+            self.evicted += 1
+            total = self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM blobs").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
 # ---------- Providers ----------
-def gen_openai(prompt: str, size: str, model: str, api_key: str) -> Dict[str, Any]:
-    if OpenAI is None:
-        raise RuntimeError("OpenAI SDK not installed. Run: pip install openai")
-    client = OpenAI(api_key=api_key)
+def gen_openai(prompt: str, size: str, model: str, api_key: str, client=None) -> Dict[str, Any]:
+    if client is None:
+        client = openai_sdk().OpenAI(api_key=api_key)
     resp = client.images.generate(model=model, prompt=prompt, size=size, n=1)
+    return parse_openai_response(resp)
+
+def parse_openai_response(resp) -> Dict[str, Any]:
     b64 = resp.data[0].b64_json
     img_bytes = base64.b64decode(b64)
     return {"image_bytes": img_bytes, "raw_response": resp.to_dict()}
 
-def gen_stability(
-    prompt: str,
-    size: str,
-    engine: str,
-    api_base: str,
-    api_key: str,
-    seed: Optional[int] = None
-) -> Dict[str, Any]:
-
+def stability_request(prompt: str, size: str, engine: str, api_base: str, api_key: str, seed: Optional[int] = None):
+    """URL, cabeceras y campos multipart de una petición a Stability (común a ambos motores)."""
     w, h = (int(x) for x in size.split("x"))
     url = f"{api_base}/v2beta/stable-image/generate/{engine}"
 
@@ -142,42 +1431,203 @@ def gen_stability(
     if seed is not None and int(seed) >= 0:
         files["seed"] = (None, str(seed))
 
-    r = requests.post(url, headers=headers, files=files, timeout=300)
+    return url, headers, files
 
-    if r.status_code == 200 and r.headers.get("Content-Type", "").startswith("image"):
+def stability_ok(status: int, headers) -> bool:
+    return status == 200 and headers.get("Content-Type", "").startswith("image")
+
+def parse_stability_response(status: int, headers, content: bytes) -> Dict[str, Any]:
+    if stability_ok(status, headers):
         return {
-            "image_bytes": r.content,
-            "raw_response": {"headers": dict(r.headers)}
+            "image_bytes": content,
+            "raw_response": {"headers": dict(headers)}
         }
 
+    text = content.decode("utf-8", errors="replace")
     try:
-        err = r.json()
+        err = json.loads(text)
     except Exception:
-        err = {"text": r.text, "status": r.status_code}
-
-    raise RuntimeError(f"Stability API error: {err}")
+        err = {"text": text, "status": status}
 
+    raise ProviderHTTPError(f"Stability API error: {err}", status, headers)
 
-def gen_automatic1111(prompt: str, size: str, api_base: str, sampler_name: str, steps: int, cfg_scale: float, seed: int, timeout: int) -> Dict[str, Any]:
+def gen_stability(
+    prompt: str,
+    size: str,
+    engine: str,
+    api_base: str,
+    api_key: str,
+    seed: Optional[int] = None,
+    session=None,
+    save_dir: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Sin save_dir devuelve la imagen en "image_bytes". Con save_dir la escribe en streaming a un
+    temporal de ese directorio y la devuelve en "saved_images" (ver job_rows).
+    """
+    url, headers, files = stability_request(prompt, size, engine, api_base, api_key, seed)
+    if save_dir is None:
+        r = (session or requests).post(url, headers=headers, files=files, timeout=300)
+        return parse_stability_response(r.status_code, r.headers, r.content)
+
+    with (session or requests).post(url, headers=headers, files=files, timeout=300, stream=True) as r:
+        if not stability_ok(r.status_code, r.headers):
+            parse_stability_response(r.status_code, r.headers, r.content)  # lanza ProviderHTTPError
+        saved = consume_stream(RawImageStream(save_dir), r.iter_content(STREAM_CHUNK))
+        return {"saved_images": saved, "raw_response": {"headers": dict(r.headers)}}
+
+
+def gen_automatic1111(prompt: str, size: str, api_base: str, sampler_name: str, steps: int, cfg_scale: float, seed: int, timeout: int, session=None,
+                      batch_size: int = 1, n_iter: int = 1, save_dir: Optional[str] = None,
+                      checkpoint: Optional[str] = None) -> Dict[str, Any]:
+    """
+    txt2img de A1111. Con batch_size/n_iter > 1 genera batch_size × n_iter imágenes en una
+    sola petición; se devuelven en "images_bytes" (y la primera en "image_bytes"), o en
+    "saved_images" si se pasa save_dir (decodificadas en streaming a temporales).
+    checkpoint fija el modelo de la petición (override_settings), por si otro cliente lo cambia.
+    """
+    url, payload = a1111_request(prompt, size, api_base, sampler_name, steps, cfg_scale, seed, batch_size, n_iter,
+                                 checkpoint)
+    timeout = timeout if timeout is not None else 900
+    if save_dir is None:
+        r = (session or requests).post(url, json=payload, timeout=timeout)
+        r.raise_for_status()
+        return parse_a1111_response(r.json(), batch_size * n_iter)
+
+    with (session or requests).post(url, json=payload, timeout=timeout, stream=True) as r:
+        r.raise_for_status()
+        data, saved = consume_stream(A1111ImageStream(save_dir), r.iter_content(STREAM_CHUNK))
+    return parse_a1111_response(data, batch_size * n_iter, saved)
+
+def a1111_request(prompt: str, size: str, api_base: str, sampler_name: str, steps: int, cfg_scale: float, seed: int,
+                  batch_size: int = 1, n_iter: int = 1, checkpoint: Optional[str] = None):
     w, h = (int(x) for x in size.split("x"))
     url = f"{api_base}/sdapi/v1/txt2img"
     payload = {
         "prompt": prompt, "width": w, "height": h,
         "sampler_name": sampler_name, "steps": steps,
-        "cfg_scale": cfg_scale, "seed": seed if seed is not None else -1, "batch_size": 1
+        "cfg_scale": cfg_scale, "seed": seed if seed is not None else -1,
+        "batch_size": batch_size, "n_iter": n_iter
     }
-    timeout = timeout if timeout is not None else 900
-    r = requests.post(url, json=payload, timeout=timeout)
-    r.raise_for_status()
-    data = r.json()
-    if "images" not in data or not data["images"]:
+    if checkpoint:
+        # Sin restaurar al acabar: si ya es el cargado no hay recarga, y si no, se carga una vez
+        payload["override_settings"] = {"sd_model_checkpoint": checkpoint}
+        payload["override_settings_restore_afterwards"] = False
+    return url, payload
+
+def parse_a1111_response(data: Dict[str, Any], expected: int, saved: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
+    """saved: imágenes ya volcadas a temporales por A1111ImageStream (entonces data no trae "images")."""
+    images = saved if saved is not None else data.get("images")
+    if not images:
         raise RuntimeError("Automatic1111 returned no images.")
-    img_b64 = data["images"][0].split(",",1)[-1] if "," in data["images"][0] else data["images"][0]
-    img_bytes = base64.b64decode(img_b64)
-    return {"image_bytes": img_bytes, "raw_response": data}
-
-
-def validate_provider(provider: str, pc: ProviderConfig):
+    # Con opts.return_grid (por defecto) A1111 antepone la cuadrícula si hay más de una imagen
+    if expected > 1 and len(images) == expected + 1:
+        if saved is not None:
+            discard_image(images[0])
+        images = images[1:]
+    try:
+        seeds = json.loads(data.get("info") or "{}").get("all_seeds") or []
+    except Exception:
+        seeds = []
+    if saved is not None:
+        return {"saved_images": images, "seeds": seeds, "raw_response": data}
+    images_bytes = [base64.b64decode(s.split(",", 1)[-1] if "," in s else s) for s in images]
+    return {"image_bytes": images_bytes[0], "images_bytes": images_bytes, "seeds": seeds, "raw_response": data}
+
+
+# ---------- Providers (asyncio) ----------
+async def agen_openai(prompt: str, size: str, model: str, client) -> Dict[str, Any]:
+    resp = await client.images.generate(model=model, prompt=prompt, size=size, n=1)
+    return parse_openai_response(resp)
+
+async def agen_stability(prompt: str, size: str, engine: str, api_base: str, api_key: str,
+                         seed: Optional[int] = None, http=None, save_dir: Optional[str] = None) -> Dict[str, Any]:
+    url, headers, files = stability_request(prompt, size, engine, api_base, api_key, seed)
+    if save_dir is None:
+        r = await http.post(url, headers=headers, files=files, timeout=300)
+        return parse_stability_response(r.status_code, r.headers, r.content)
+
+    async with http.stream("POST", url, headers=headers, files=files, timeout=300) as r:
+        if not stability_ok(r.status_code, r.headers):
+            parse_stability_response(r.status_code, r.headers, await r.aread())
+        saved = await aconsume_stream(RawImageStream(save_dir), r.aiter_bytes(STREAM_CHUNK))
+        return {"saved_images": saved, "raw_response": {"headers": dict(r.headers)}}
+
+async def agen_automatic1111(prompt: str, size: str, api_base: str, sampler_name: str, steps: int, cfg_scale: float,
+                             seed: int, timeout: int, http=None, batch_size: int = 1, n_iter: int = 1,
+                             save_dir: Optional[str] = None, checkpoint: Optional[str] = None) -> Dict[str, Any]:
+    url, payload = a1111_request(prompt, size, api_base, sampler_name, steps, cfg_scale, seed, batch_size, n_iter,
+                                 checkpoint)
+    timeout = timeout if timeout is not None else 900
+    if save_dir is None:
+        r = await http.post(url, json=payload, timeout=timeout)
+        r.raise_for_status()
+        return parse_a1111_response(r.json(), batch_size * n_iter)
+
+    async with http.stream("POST", url, json=payload, timeout=timeout) as r:
+        if r.is_error:
+            await r.aread()
+        r.raise_for_status()
+        data, saved = await aconsume_stream(A1111ImageStream(save_dir), r.aiter_bytes(STREAM_CHUNK))
+    return parse_a1111_response(data, batch_size * n_iter, saved)
+
+
+def a1111_find_checkpoint(models: List[Dict[str, Any]], wanted: str) -> Optional[Dict[str, Any]]:
+    """Entrada de /sdapi/v1/sd-models para wanted: título, nombre, hash o nombre de fichero (con o sin extensión)."""
+    w = wanted.strip().lower()
+    for m in models:
+        fname = re.split(r"[\\/]", str(m.get("filename") or ""))[-1]
+        names = {str(m.get(k) or "").lower() for k in ("title", "model_name", "hash", "sha256")}
+        names.update((fname.lower(), os.path.splitext(fname)[0].lower()))
+        if w in names:
+            return m
+    return None
+
+def a1111_preflight(base: str, pc: ProviderConfig, session=None) -> Dict[str, Any]:
+    """
+    Pre-vuelo de un nodo A1111 antes del lote: carga el checkpoint de pc.model si no es el activo
+    y lanza una generación mínima (64x64, 1 paso, sin devolver la imagen), para que la primera
+    imagen del lote no pague la carga del modelo en VRAM ni la inicialización del sampler.
+    """
+    http = session or requests
+    timeout = pc.timeout_seconds or 900
+    info = {"endpoint": base, "checkpoint": None, "checkpoint_load_seconds": None, "warmup_seconds": None}
+
+    pinned = None
+    if pc.model:
+        r = http.get(f"{base}/sdapi/v1/options", timeout=10)
+        r.raise_for_status()
+        current = (r.json() or {}).get("sd_model_checkpoint")
+        r = http.get(f"{base}/sdapi/v1/sd-models", timeout=10)
+        r.raise_for_status()
+        models = r.json() or []
+        model = a1111_find_checkpoint(models, str(pc.model))
+        if model is None:
+            available = ", ".join(str(m.get("title")) for m in models) or "none"
+            raise RuntimeError(f"Checkpoint not found at {base}: {pc.model} (available: {available})")
+        pinned = info["checkpoint"] = model["title"]
+        if pinned != current:
+            t0 = time.time()
+            r = http.post(f"{base}/sdapi/v1/options", json={"sd_model_checkpoint": pinned}, timeout=timeout)
+            r.raise_for_status()
+            info["checkpoint_load_seconds"] = round(time.time() - t0, 3)
+
+    if pc.warmup:
+        url, payload = a1111_request("warmup", "64x64", base, pc.sampler_name or "DPM++ 2M Karras", 1,
+                                     float(pc.cfg_scale or 6.5), 0, checkpoint=pinned)
+        payload.update(send_images=False, save_images=False)
+        t0 = time.time()
+        r = http.post(url, json=payload, timeout=timeout)
+        r.raise_for_status()
+        info["warmup_seconds"] = round(time.time() - t0, 3)
+    return info
+
+def validate_provider(provider: str, pc: ProviderConfig, session=None,
+                      balancer: Optional[A1111Balancer] = None) -> List[Dict[str, Any]]:
+    """
+    Lanza si el proveedor no está disponible. Para A1111 hace además el pre-vuelo de cada nodo
+    (a1111_preflight) y devuelve sus tiempos; un nodo que falla queda fuera de rotación.
+    """
     if provider == "openai":
         key = os.getenv(pc.api_key_env or "OPENAI_API_KEY")
         if not key:
@@ -188,250 +1638,2048 @@ def validate_provider(provider: str, pc: ProviderConfig):
         if not key:
             raise RuntimeError("Missing STABILITY_API_KEY env var.")
 
+    elif provider == "automatic1111" and balancer is not None:
+        # Basta con un nodo vivo; los demás quedan fuera de rotación hasta que respondan
+        if not balancer.probe_all():
+            raise RuntimeError(f"No Automatic1111 API reachable at {', '.join(n.url for n in balancer.nodes)}")
+        if not (pc.model or pc.warmup):
+            return []
+        nodes = [n for n in balancer.nodes if n.healthy]
+        with ThreadPoolExecutor(len(nodes), thread_name_prefix="preflight") as pool:
+            futures = [pool.submit(a1111_preflight, n.url, pc, session) for n in nodes]
+        done, errors = [], []
+        for node, fut in zip(nodes, futures):
+            try:
+                done.append(fut.result())
+            except Exception as e:
+                errors.append(e)
+                with balancer._lock:
+                    node.healthy = False
+                console(f"Nodo A1111 fuera de rotación: {node.url} (pre-vuelo: {e})")
+        if not done:
+            raise errors[0]
+        return done
+
     elif provider == "automatic1111":
         base = pc.api_base or "http://127.0.0.1:7860"
         try:
-            r = requests.get(f"{base}/sdapi/v1/progress", timeout=2)
+            r = (session or requests).get(f"{base}/sdapi/v1/progress", timeout=2)
             r.raise_for_status()
         except Exception:
             raise RuntimeError(f"Automatic1111 API not reachable at {base}")
-
+        return [a1111_preflight(base, pc, session)] if pc.model or pc.warmup else []
+    return []
+
+
+# ---------- Eventos de progreso (--events) ----------
+# Un JSON por línea a un socket local (lo abre la GUI): batch, queued, started, finished, failed,
+# skipped, provider_done y done. Cada evento de réplicas lleva count (réplicas que cubre), así
+# que finished + failed + skipped llega al total de batch. Sin --events, emit() no hace nada.
+class EventStream:
+    def __init__(self, address: str):
+        host, _, port = address.rpartition(":")
+        self.sock = socket.create_connection((host or "127.0.0.1", int(port)), timeout=10)
+        self._lock = threading.Lock()
+
+    def send(self, ev: Dict[str, Any]):
+        data = (json.dumps(ev, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            if self.sock is None:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                # quien escuchaba se fue (GUI cerrada): el lote sigue sin eventos
+                self.sock.close()
+                self.sock = None
+
+    def close(self):
+        with self._lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+EVENTS: Optional[EventStream] = None
+
+def emit(event: str, **fields):
+    if EVENTS is not None:
+        EVENTS.send({"event": event, "t": round(time.time(), 3), **fields})
+
+def emit_rows(provider: str, rows: List[Dict[str, Any]]):
+    for r in rows:
+        if "file_path" in r:
+            emit("finished", provider=provider, prompt_id=r["prompt_id"], replicate_index=r["replicate_index"], count=1,
+                 latency_seconds=r.get("latency_seconds"), bytes=r.get("stored_bytes"), file_path=r["file_path"],
+                 cache_hit=bool(r.get("cache_hit")))
+        elif "replicate_index" in r:
+            emit("failed", provider=provider, prompt_id=r["prompt_id"], replicate_index=r["replicate_index"], count=1,
+                 error=r.get("error"), error_kind=r.get("error_kind"))
+
+def emit_batch_total(prompts_path: str, repeats: int, providers: int = 1):
+    """Cuenta los prompts del CSV en segundo plano (el lote no lo espera) y emite el total de réplicas."""
+    def count():
+        try:
+            n = sum(1 for _ in iter_prompts_csv(prompts_path))
+        except (OSError, csv.Error, UnicodeError):
+            return
+        emit("batch", prompts=n, total=n * repeats * providers)
+    threading.Thread(target=count, name="events-total", daemon=True).start()
+
+def announce_jobs(provider: str, rc: RunConfig, jobs):
+    """Emite queued por trabajo según sale de iter_jobs, y skipped/failed por las réplicas que no se piden."""
+    planned = 0
+    for job in jobs:
+        if job.count and job.prompt_text:
+            emit("queued", provider=provider, prompt_id=job.prompt_id, replicate_index=job.rep, count=job.count)
+            planned += job.count
+        if job.last_rep:
+            if not job.prompt_text:
+                emit("failed", provider=provider, prompt_id=job.prompt_id, count=rc.repeats, error="Empty prompt")
+            elif rc.repeats > planned:
+                emit("skipped", provider=provider, prompt_id=job.prompt_id, count=rc.repeats - planned)
+            planned = 0
+        yield job
 
 # ---------- Runner ----------
-def main():
-    parser = argparse.ArgumentParser(description="Batch image generation")
-    parser.add_argument("--provider", required=True, choices=["openai","stability","automatic1111"])
-    parser.add_argument("--config", default="config.yaml")
-    parser.add_argument("--prompts", default="prompts.csv")
-    parser.add_argument("--out", default=None)
-    parser.add_argument("--repeats", type=int, default=None)
-    parser.add_argument("--size", default=None)
-    args = parser.parse_args()
+@dataclass
+class Job:
+    seq: int            # orden de envío (el manifiesto se escribe en este orden)
+    idx: int            # índice 1-based del prompt en el CSV (tras barajar)
+    prompt_id: str
+    prompt_text: str
+    rep: int            # primera réplica 1-based del trabajo
+    last_rep: bool      # último trabajo del prompt (para la barra de progreso)
+    prompt_dir: str
+    count: int = 1      # réplicas consecutivas que cubre (batch de A1111); 0 = ya generadas (--resume)
+    prompt_hash: str = ""
+    params_hash: str = ""
+    store: Optional[ObjectStore] = None  # almacén por contenido (dedup), si está activo
+    cache: Optional[ResultCache] = None  # caché de resultados (sólo con seed fija)
+    ledger: Optional["JobLedger"] = None  # estado por réplica (ledger.sqlite)
+    params: Optional[Dict[str, Any]] = None  # generation_params, para los metadatos embebidos
+
+# ---------- Errores ----------
+# Clases de error por proveedor. Las transitorias se reintentan; las fatales abortan el lote.
+ERR_NETWORK = "transient_network"
+ERR_RATE = "rate_limited"
+ERR_SERVER = "server_error"
+ERR_CONTENT = "content_filtered"
+ERR_BILLING = "billing_fatal"
+ERR_AUTH = "auth_fatal"
+ERR_CLIENT = "client_error"
+ERR_UNKNOWN = "unknown"
+
+RETRYABLE_ERRORS = (ERR_NETWORK, ERR_RATE, ERR_SERVER)
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+CONTENT_MARKERS = (
+    "content_moderation", "content_policy_violation", "moderation_blocked",
+    "safety system", "flagged", "nsfw",
+)
+BILLING_MARKERS = {
+    # STABILITY: créditos / pago
+    "stability": ("sufficient credits", "payment_required", "purchase more credits"),
+    # OPENAI: cuota / billing / créditos
+    "openai": ("insufficient_quota", "exceeded your current quota", "billing", "payment", "quota"),
+}
+# API key inválida / ausente
+AUTH_MARKERS = (
+    "invalid api key", "incorrect api key", "invalid_api_key", "no api key",
+    "missing openai_api_key", "missing stability_api_key",
+)
+
+FATAL_MESSAGES = {
+    (ERR_BILLING, "stability"): "Stability API credits exhausted",
+    (ERR_BILLING, "openai"): "OpenAI quota or billing limit reached",
+    (ERR_AUTH, "openai"): "Invalid or missing OpenAI API key",
+    (ERR_AUTH, "stability"): "Invalid or missing Stability API key",
+    (ERR_AUTH, "automatic1111"): "Automatic1111 API authentication failed",
+}
+
+def _network_error_types():
+    types = [ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout,
+             requests.exceptions.ChunkedEncodingError]
+    # httpx/openai sólo pueden haber lanzado el error si ya están importados
+    if "httpx" in sys.modules:
+        types.append(sys.modules["httpx"].TransportError)
+    if "openai" in sys.modules:
+        types.append(sys.modules["openai"].APIConnectionError)  # incluye APITimeoutError
+    return tuple(types)
+
+def classify_error(provider: str, e: BaseException) -> str:
+    """Clasifica un error por código HTTP y cuerpo de la respuesta (ver ERR_*)."""
+    status, _ = http_status_and_headers(e)
+    err_l = str(e).lower()
+    if any(m in err_l for m in CONTENT_MARKERS):
+        return ERR_CONTENT
+    if status == 402 or any(m in err_l for m in BILLING_MARKERS.get(provider, ())):
+        return ERR_BILLING
+    if status in (401, 403) or any(m in err_l for m in AUTH_MARKERS):
+        return ERR_AUTH
+    if status == 429:
+        return ERR_RATE
+    if status is not None and status >= 500:
+        return ERR_SERVER
+    if isinstance(e, _network_error_types()):
+        return ERR_NETWORK
+    if status is not None and 400 <= status < 500:
+        return ERR_CLIENT
+    return ERR_UNKNOWN
+
+def fatal_reason(provider: str, kind: str) -> Optional[str]:
+    if kind not in (ERR_BILLING, ERR_AUTH):
+        return None
+    return FATAL_MESSAGES.get((kind, provider), f"{provider}: {kind}")
+
+def retry_delay(attempt: int) -> float:
+    """Backoff exponencial con jitter: [d/2, d] con d = base × 2^(intento-1), acotado."""
+    d = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return random.uniform(d / 2, d)
+
+def console(msg: str):
+    """Línea de log compatible con la barra de tqdm cuando hay terminal."""
+    if sys.stdout.isatty():
+        tqdm_class().write(msg)
+    else:
+        print(msg, flush=True)
+
+def replicate_seed(rc: RunConfig, rep: int) -> int:
+    """
+    Semilla de la réplica rep (1-based). Con seed fija cada réplica usa seed + rep - 1, que es como
+    A1111 numera las imágenes de un batch: la réplica da la misma imagen se pida sola o en batch.
+    """
+    if rc.seed is None or int(rc.seed) < 0:
+        return -1
+    return int(rc.seed) + rep - 1
+
+def call_provider(provider: str, pc: ProviderConfig, rc: RunConfig, prompt_text: str, client: ProviderClient,
+                  count: int = 1, save_dir: Optional[str] = None, rep: int = 1) -> Dict[str, Any]:
+    """Genera count réplicas de prompt_text a partir de la réplica rep (de ella sale la semilla)."""
+    if provider == "openai":
+        api_key = os.getenv(pc.api_key_env or "OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("Missing OPENAI_API_KEY env var.")
 
-    if yaml is None:
-        raise RuntimeError("YAML support not available. Please install pyyaml.")
+        return gen_openai(
+            prompt_text,
+            rc.size,
+            pc.model or "gpt-image-1",
+            api_key,
+            client=client.openai(api_key)
+        )
 
-    with open(args.config, "r", encoding="utf-8") as f:
-        cfg = yaml.safe_load(f)
+    elif provider == "stability":
+        api_key = os.getenv(pc.api_key_env or "STABILITY_API_KEY")
+        if not api_key:
+            raise RuntimeError("Missing STABILITY_API_KEY env var.")
 
-    run = cfg.get("default", {})
-    cfg_out = args.out if args.out is not None else run.get("out_dir", "out")
+        return gen_stability(
+            prompt_text,
+            rc.size,
+            pc.engine or "sd3",
+            pc.api_base or "https://api.stability.ai",
+            api_key,
+            seed=replicate_seed(rc, rep),
+            session=client.session,
+            save_dir=save_dir
+        )
+
+    else:  # automatic1111
+        batch = max(1, int(pc.batch_size or 1))
+        batch_size, n_iter = (count, 1) if count <= batch else (batch, count // batch)
+        gen = lambda base: gen_automatic1111(
+            prompt_text,
+            rc.size,
+            base,
+            pc.sampler_name or "DPM++ 2M Karras",
+            int(pc.steps or 30),
+            float(pc.cfg_scale or 6.5),
+            replicate_seed(rc, rep),
+            pc.timeout_seconds or 900,
+            session=client.session,
+            batch_size=batch_size,
+            n_iter=n_iter,
+            save_dir=save_dir,
+            checkpoint=client.checkpoints.get(base, pc.model)
+        )
+        if client.balancer is not None:
+            return balanced_call(client.balancer, gen)
+        return gen(pc.api_base or "http://127.0.0.1:7860")
+
+async def acall_provider(provider: str, pc: ProviderConfig, rc: RunConfig, prompt_text: str, client: AsyncProviderClient,
+                         count: int = 1, save_dir: Optional[str] = None, rep: int = 1) -> Dict[str, Any]:
+    """Versión asyncio de call_provider (mismos valores por defecto)."""
+    if provider == "openai":
+        api_key = os.getenv(pc.api_key_env or "OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("Missing OPENAI_API_KEY env var.")
+        return await agen_openai(prompt_text, rc.size, pc.model or "gpt-image-1", client.openai(api_key))
 
-    rc = RunConfig(
-        out_dir = cfg_out,
-        repeats = args.repeats or int(run.get("repeats", 3)),
-        size = args.size or run.get("size", "1024x1024"),
-        temperature = run.get("temperature", None),
-        randomize_order = bool(run.get("randomize_order", True)),
-        concurrency = int(run.get("concurrency", 1)),
-        delay_seconds = float(run.get("delay_seconds", 0)),
-        seed = run.get("seed", None),
-    )
+    elif provider == "stability":
+        api_key = os.getenv(pc.api_key_env or "STABILITY_API_KEY")
+        if not api_key:
+            raise RuntimeError("Missing STABILITY_API_KEY env var.")
+        return await agen_stability(
+            prompt_text, rc.size, pc.engine or "sd3", pc.api_base or "https://api.stability.ai",
+            api_key, seed=replicate_seed(rc, rep), http=client.http, save_dir=save_dir
+        )
+
+    else:  # automatic1111
+        batch = max(1, int(pc.batch_size or 1))
+        batch_size, n_iter = (count, 1) if count <= batch else (batch, count // batch)
+        agen = lambda base: agen_automatic1111(
+            prompt_text, rc.size, base,
+            pc.sampler_name or "DPM++ 2M Karras", int(pc.steps or 30), float(pc.cfg_scale or 6.5),
+            replicate_seed(rc, rep), pc.timeout_seconds or 900,
+            http=client.http, batch_size=batch_size, n_iter=n_iter, save_dir=save_dir,
+            checkpoint=client.checkpoints.get(base, pc.model)
+        )
+        if client.balancer is not None:
+            return await abalanced_call(client.balancer, agen)
+        return await agen(pc.api_base or "http://127.0.0.1:7860")
+
+def error_row(provider: str, job: Job, rep: int, err_txt: str, kind: str = ERR_UNKNOWN, attempts: int = 1) -> Dict[str, Any]:
+    return {
+        "timestamp": timestamp(),
+        "provider": provider,
+        "error": err_txt,
+        "error_kind": kind,
+        "attempts": attempts,
+        "prompt_id": job.prompt_id,
+        "replicate_index": rep,
+        "fatal": False
+    }
 
-    providers = cfg.get("providers", {})
-    pconf = providers.get(args.provider, {})
+def staged_images(job: Job, out: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Temporales de la respuesta; las imágenes que llegan en memoria (OpenAI) se escriben ahora."""
+    staged = out.get("saved_images")
+    if staged is None:
+        staged = [stage_image_bytes(b, job.prompt_dir) for b in (out.get("images_bytes") or [out["image_bytes"]])]
+    return staged
+
+def job_rows(provider: str, job: Job, out: Dict[str, Any], latency: float,
+             rc: Optional[RunConfig] = None) -> List[Dict[str, Any]]:
+    """
+    Da su nombre definitivo a las imágenes devueltas por el proveedor (recodificadas, con sus
+    metadatos embebidos y con miniatura según rc) y construye sus filas del manifiesto. El nombre
+    lleva el hash de la imagen original, sea cual sea el formato guardado.
+    """
+    staged = staged_images(job, out)
+    for extra in staged[job.count:]:
+        discard_image(extra)
+    images = staged[:job.count]
+    seeds = out.get("seeds") or []
+    rows = []
+    for i, img in enumerate(images):
+        rep = job.rep + i
+        img_hash = img["sha256"][:16]
+        row = {
+            "timestamp": timestamp(),
+            "provider": provider,
+            "prompt_id": job.prompt_id,
+            "replicate_index": rep,
+            "sha256_16": img_hash,
+            "file_path": None,
+            "latency_seconds": round(latency / len(images), 3),
+            "prompt_sha256_16": job.prompt_hash,
+            "params_sha256_16": job.params_hash,
+        }
+        if i < len(seeds):
+            row["seed"] = seeds[i]
+        if out.get("endpoint"):
+            row["endpoint"] = out["endpoint"]
+
+        meta = image_metadata(row, job) if rc is not None and rc.embed_metadata else None
+        if rc is not None and needs_encoding(rc):
+            img = encode_image(img, rc, meta)
+        elif meta is not None:
+            img = embed_png_metadata(img, meta)
+        if img.get("encode_error"):
+            row["encode_error"] = img["encode_error"]
+        if meta is not None and "stored_sha256" not in img:
+            # ni recodificada ni PNG bien cerrado: --rebuild-manifest no la verá
+            row["metadata_embedded"] = False
+        fname = f"{safe_name(job.prompt_id)}_rep{rep}_{img_hash}{img.get('ext', '.png')}"
+        fpath = os.path.join(job.prompt_dir, fname)
+        if job.store is not None:
+            fpath, dup = job.store.put(img, fpath)
+        else:
+            commit_image(img, fpath)
+        row["file_path"] = fpath
+        if img.get("bytes") is not None:
+            # original = lo que devolvió el proveedor; stored = el fichero guardado (igual si no se recodifica)
+            row["original_bytes"] = img["bytes"]
+            row["stored_sha256_16"] = stored_sha256(img)[:16]
+            row["stored_bytes"] = img.get("stored_bytes", img["bytes"])
+        if img.get("format"):
+            row["format"] = img["format"]
+        if rc is not None and rc.thumbnail_px:
+            thumb = write_thumbnail(fpath, job.prompt_dir, rc.thumbnail_px)
+            if thumb:
+                row["thumbnail_path"] = thumb
+        if job.store is not None:
+            row["object_sha256"] = stored_sha256(img)
+            if dup:
+                row["dedup"] = True
+        if job.count > 1:
+            row["batch_images"] = job.count
+            row["batch_latency_seconds"] = round(latency, 3)
+        rows.append(row)
+
+    for rep in range(job.rep + len(images), job.rep + job.count):
+        rows.append(error_row(provider, job, rep, "Provider returned fewer images than requested"))
+    return rows
 
-    pc = ProviderConfig(
-        model = pconf.get("model"),
-        api_key_env = pconf.get("api_key_env"),
-        engine = pconf.get("engine"),
-        api_base = pconf.get("api_base"),
-        sampler_name = pconf.get("sampler_name"),
-        steps = pconf.get("steps"),
-        cfg_scale = pconf.get("cfg_scale"),
-        timeout_seconds = pconf.get("timeout_seconds", 900),
-    )
+def job_failed(provider: str, job: Job, e: Exception, kind: str, attempts: int):
+    err_txt = str(e) or repr(e)  # p.ej. httpx.ReadError('') no trae mensaje
+    rows = [error_row(provider, job, rep, err_txt, kind, attempts) for rep in range(job.rep, job.rep + job.count)]
+    return rows, fatal_reason(provider, kind)
+
+def should_retry(provider: str, job: Job, e: Exception, kind: str, attempt: int, rc: RunConfig, stop: threading.Event):
+    """Devuelve la espera antes del siguiente intento, o None si no se reintenta."""
+    if kind not in RETRYABLE_ERRORS or attempt > rc.max_retries or stop.is_set():
+        return None
+    delay = retry_delay(attempt)
+    if job.ledger is not None:
+        job.ledger.retry(job, kind, str(e) or repr(e))
+    console(f"Reintento {attempt}/{rc.max_retries} de {job.prompt_id} rep{job.rep} ({kind}) en {delay:.1f}s")
+    return delay
+
+def with_attempts(rows: List[Dict[str, Any]], attempts: int) -> List[Dict[str, Any]]:
+    if attempts > 1:
+        for r in rows:
+            r.setdefault("attempts", attempts)
+    return rows
 
-    # -------- VALIDACIÓN PREVIA (FAIL FAST) --------
-    out_root = os.path.join(resolve_out_dir(rc.out_dir), args.provider)
-    ensure_dir(out_root)
-    manifest_path = os.path.join(out_root, "manifest.jsonl")
+def with_rate(rows: List[Dict[str, Any]], limiter: RateController) -> List[Dict[str, Any]]:
+    rate = limiter.current_rps()
+    if rate is not None:
+        for r in rows:
+            r["rate_rps"] = rate
+    return rows
 
+def result_key(provider: str, pc: ProviderConfig, rc: RunConfig, job: Job) -> str:
+    """Clave de la caché: todos los parámetros de generación, el prompt, las réplicas que cubre y su reparto en la petición."""
+    params = generation_params(provider, pc, rc)
+    params.update(prompt=job.prompt_text, count=job.count, batch_size=max(1, int(pc.batch_size or 1)),
+                  seed=replicate_seed(rc, job.rep))
+    return sha256_bytes(json.dumps(params, sort_keys=True).encode("utf-8"))
+
+def cached_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    for r in rows:
+        if "file_path" in r:
+            r["cache_hit"] = True
+    return rows
+
+def cache_result(job: Job, key: str, staged: List[Dict[str, str]], seeds: List[Any]):
+    if len(staged) < job.count:
+        return  # resultado incompleto: no se cachea
+    images = [dict(s, seed=seeds[i] if i < len(seeds) else None) for i, s in enumerate(staged[:job.count])]
+    try:
+        job.cache.put(key, images)
+    except (OSError, sqlite3.Error) as e:
+        console(f"Caché: no se pudo guardar {job.prompt_id} rep{job.rep} ({e})")
+
+def postprocess(provider: str, rc: RunConfig, job: Job, out: Dict[str, Any], latency: float, key: Optional[str],
+                attempts: int, limiter: RateController, cache_hit: bool = False):
+    """
+    Todo lo que va a disco tras la respuesta: temporales, caché, recodificación, miniaturas, nombre
+    definitivo (o almacén dedup) y filas del manifiesto. Devuelve (filas, motivo_fatal) como run_job.
+    """
+    staged = []
     try:
-        validate_provider(args.provider, pc)
+        staged = staged_images(job, out)
+        if key is not None and not cache_hit:
+            cache_result(job, key, staged, out.get("seeds") or [])
+        rows = job_rows(provider, job, dict(out, saved_images=staged), latency, rc)
     except Exception as e:
-        write_jsonl(manifest_path, [{
-            "timestamp": timestamp(),
-            "provider": args.provider,
-            "error": str(e),
-            "fatal": True
-        }])
-        print(f"\nError: {e}")
-        print(f"Manifest: {manifest_path}")
-        return
+        for s in staged:
+            discard_image(s)
+        return job_failed(provider, job, e, classify_error(provider, e), attempts)
+    if cache_hit:
+        rows = cached_rows(rows)
+    return with_rate(with_attempts(rows, attempts), limiter), None
+
+def finish_job(provider: str, rc: RunConfig, job: Job, out: Dict[str, Any], latency: float, key: Optional[str],
+               attempts: int, limiter: RateController, post: Optional[ThreadPoolExecutor], cache_hit: bool = False):
+    """Con pool de post-proceso devuelve su Future y el worker de red queda libre; si no, lo hace aquí."""
+    if post is not None:
+        try:
+            return post.submit(postprocess, provider, rc, job, out, latency, key, attempts, limiter, cache_hit)
+        except RuntimeError:
+            pass  # pool ya cerrado (interrupción): se termina aquí para no dejar temporales
+    return postprocess(provider, rc, job, out, latency, key, attempts, limiter, cache_hit)
+
+def run_job(provider: str, pc: ProviderConfig, rc: RunConfig, job: Job, client: ProviderClient, stop: threading.Event,
+            post: Optional[ThreadPoolExecutor] = None):
+    """
+    Ejecuta un trabajo (una réplica, o job.count réplicas en batch) en un worker del pool,
+    con reintentos acotados para los errores transitorios.
+    Devuelve (filas_manifiesto, motivo_fatal), o con post el Future del post-proceso que las
+    dará. No escribe el manifiesto: el hilo principal lo hace en orden de envío.
+    """
+    if job.ledger is not None:
+        job.ledger.start(job)
+    emit("started", provider=provider, prompt_id=job.prompt_id, replicate_index=job.rep, count=job.count)
+    key = None
+    if job.cache is not None:
+        key = result_key(provider, pc, rc, job)
+        t0 = time.time()
+        out = job.cache.get(key, job.prompt_dir)
+        if out is not None:
+            return finish_job(provider, rc, job, out, time.time() - t0, key, 1, client.limiter, post, cache_hit=True)
+
+    attempt = 0
+    while True:
+        if stop.is_set():
+            return [], None
+        attempt += 1
+        client.limiter.acquire()
+        t0 = time.time()
+        try:
+            out = call_provider(provider, pc, rc, job.prompt_text, client, count=job.count, save_dir=job.prompt_dir,
+                                rep=job.rep)
+            client.limiter.on_success((out.get("raw_response") or {}).get("headers"))
+            return finish_job(provider, rc, job, out, time.time() - t0, key, attempt, client.limiter, post)
+
+        except Exception as e:
+            client.limiter.on_error(e)
+            kind = classify_error(provider, e)
+            delay = should_retry(provider, job, e, kind, attempt, rc, stop)
+            if delay is not None:
+                stop.wait(delay)
+                continue
+            rows, fatal = job_failed(provider, job, e, kind, attempt)
+            return with_rate(rows, client.limiter), fatal
+
+async def arun_job(provider: str, pc: ProviderConfig, rc: RunConfig, job: Job, client: AsyncProviderClient,
+                   stop: threading.Event, sem: "asyncio.Semaphore", post: ThreadPoolExecutor):
+    """
+    Como run_job, en el bucle de eventos. El post-proceso va al pool de post-proceso y fuera del
+    semáforo: la siguiente petición sale sin esperar al disco.
+    """
+    if job.ledger is not None:
+        job.ledger.start(job)
+    emit("started", provider=provider, prompt_id=job.prompt_id, replicate_index=job.rep, count=job.count)
+    key = None
+    if job.cache is not None:
+        key = result_key(provider, pc, rc, job)
+        t0 = time.time()
+        out = await asyncio.to_thread(job.cache.get, key, job.prompt_dir)
+        if out is not None:
+            return await asyncio.wrap_future(
+                finish_job(provider, rc, job, out, time.time() - t0, key, 1, client.limiter, post, cache_hit=True))
+
+    async with sem:
+        attempt = 0
+        while True:
+            if stop.is_set():
+                return [], None
+            attempt += 1
+            await client.limiter.aacquire()
+            t0 = time.time()
+            try:
+                out = await acall_provider(provider, pc, rc, job.prompt_text, client, count=job.count,
+                                           save_dir=job.prompt_dir, rep=job.rep)
+                client.limiter.on_success((out.get("raw_response") or {}).get("headers"))
+                latency = time.time() - t0
+                break
 
-    # -------- CARGA DE PROMPTS --------
-    prompts = load_prompts_csv(args.prompts)
-    if rc.randomize_order:
-        random.shuffle(prompts)
+            except Exception as e:
+                client.limiter.on_error(e)
+                kind = classify_error(provider, e)
+                delay = should_retry(provider, job, e, kind, attempt, rc, stop)
+                if delay is not None:
+                    await asyncio.sleep(delay)
+                    continue
+                rows, fatal = job_failed(provider, job, e, kind, attempt)
+                return with_rate(rows, client.limiter), fatal
+
+    return await asyncio.wrap_future(finish_job(provider, rc, job, out, latency, key, attempt, client.limiter, post))
+
+def replicate_groups(reps: List[int], batch_size: int):
+    """
+    Reparte las réplicas pendientes de un prompt en (primera_réplica, nº) por petición.
+    Sin batch: una por réplica. Con batch B, cada tramo consecutivo de L réplicas va en un
+    bloque de B × (L // B) (batch_size=B, n_iter=L // B) y, si sobra, otro con el resto.
+    """
+    if batch_size <= 1:
+        return [(rep, 1) for rep in reps]
+    groups = []
+    i = 0
+    while i < len(reps):
+        j = i
+        while j + 1 < len(reps) and reps[j + 1] == reps[j] + 1:
+            j += 1
+        start, length = reps[i], j - i + 1
+        full = (length // batch_size) * batch_size
+        if full:
+            groups.append((start, full))
+        if length > full:
+            groups.append((start + full, length - full))
+        i = j + 1
+    return groups
+
+# ---------- Reanudación (--resume) ----------
+def prompt_hash(prompt_text: str) -> str:
+    return sha256_bytes(prompt_text.encode("utf-8"))[:16]
+
+def generation_params(provider: str, pc: ProviderConfig, rc: RunConfig) -> Dict[str, Any]:
+    """Parámetros que determinan la imagen (no incluye api_base ni batch)."""
+    return {
+        "provider": provider, "model": pc.model, "engine": pc.engine,
+        "sampler_name": pc.sampler_name, "steps": pc.steps, "cfg_scale": pc.cfg_scale,
+        "size": rc.size, "seed": rc.seed,
+    }
 
-    meta_rows: List[Dict[str, Any]] = []
+def params_hash(provider: str, pc: ProviderConfig, rc: RunConfig) -> str:
+    return sha256_bytes(json.dumps(generation_params(provider, pc, rc), sort_keys=True).encode("utf-8"))[:16]
+
+# ---------- Registro de trabajos (ledger) ----------
+LEDGER_STATES = ("pending", "running", "done", "failed")
+
+class JobLedger:
+    """
+    Estado de cada réplica (prompt_id, réplica, huella del prompt, huella de parámetros) en
+    <out>/<provider>/ledger.sqlite (WAL): pending, running, done o failed, con intentos, último
+    error y su última fila del manifiesto. Es la fuente de verdad de --resume y de --status;
+    manifest.jsonl se sigue escribiendo como exportación. Lo escriben a la vez los workers
+    (inicio y reintentos) y el hilo que recoge resultados; otros procesos (la GUI) lo leen sin bloquearlo.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS replicates (
+            prompt_id TEXT NOT NULL,
+            replicate_index INTEGER NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            params_hash TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            error_kind TEXT,
+            file_path TEXT,
+            row TEXT,
+            updated REAL NOT NULL,
+            PRIMARY KEY (prompt_id, replicate_index, prompt_hash, params_hash)
+        );
+        CREATE INDEX IF NOT EXISTS replicates_status ON replicates(status, params_hash);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+    UPSERT = """
+        INSERT INTO replicates (prompt_id, replicate_index, prompt_hash, params_hash, status, attempts,
+                                error, error_kind, file_path, row, updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (prompt_id, replicate_index, prompt_hash, params_hash) DO UPDATE SET
+            status = excluded.status, attempts = attempts + excluded.attempts,
+            error = excluded.error, error_kind = excluded.error_kind,
+            file_path = COALESCE(excluded.file_path, file_path), row = COALESCE(excluded.row, row),
+            updated = excluded.updated
+    """
+    IMPORT = """
+        INSERT INTO replicates (prompt_id, replicate_index, prompt_hash, params_hash, status, attempts,
+                                error, error_kind, file_path, row, updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (prompt_id, replicate_index, prompt_hash, params_hash) DO UPDATE SET
+            status = 'done', error = NULL, error_kind = NULL, file_path = excluded.file_path,
+            row = excluded.row, updated = excluded.updated
+        WHERE status != 'done'
+    """
+
+    def __init__(self, path: str, manifest_path: Optional[str] = None):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        with self._lock, self.db:
+            # Lo que quedó "running" es de una ejecución que se cortó
+            self.db.execute("UPDATE replicates SET status = 'pending' WHERE status = 'running'")
+        if manifest_path and not self._meta("imported"):
+            self.import_manifest(manifest_path)
+
+    def _meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            r = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return r[0] if r else None
+
+    def _keys(self, job: Job):
+        return [(str(job.prompt_id), rep, job.prompt_hash, job.params_hash) for rep in range(job.rep, job.rep + job.count)]
+
+    def import_manifest(self, manifest_path: str):
+        """Primera apertura junto a un manifiesto anterior al ledger: importa sus réplicas generadas."""
+        n = 0
+        if os.path.exists(manifest_path):
+            batch = []
+            with open(manifest_path, "r", encoding="utf-8", errors="replace", buffering=1 << 20) as f:
+                for line in f:
+                    if '"params_sha256_16"' not in line or '"error"' in line:
+                        continue  # sólo las filas de éxito llevan las huellas de la clave
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        continue  # línea truncada (p.ej. tras un corte)
+                    batch.append((str(r["prompt_id"]), r["replicate_index"], r["prompt_sha256_16"], r["params_sha256_16"],
+                                  "done", r.get("attempts", 1), None, None, r.get("file_path"), line.rstrip("\n"), time.time()))
+                    if len(batch) >= 10000:
+                        n += self._upsert(batch)
+                        batch = []
+            n += self._upsert(batch)
+        with self._lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported', ?)", (str(n),))
+        if n:
+            console(f"Ledger: {n} réplicas importadas de {os.path.basename(manifest_path)}")
+
+    def import_rows(self, rows: List[Dict[str, Any]]) -> int:
+        """Marca como done las réplicas de estas filas (p. ej. reconstruidas desde las imágenes) que no lo estén."""
+        now = time.time()
+        values = [(str(r["prompt_id"]), r["replicate_index"], r.get("prompt_sha256_16") or "", r.get("params_sha256_16") or "",
+                   "done", 1, None, None, r["file_path"], json.dumps(r, ensure_ascii=False), now) for r in rows]
+        with self._lock, self.db:
+            before = self.db.total_changes
+            self.db.executemany(self.IMPORT, values)
+            return self.db.total_changes - before
+
+    def _upsert(self, values) -> int:
+        if not values:
+            return 0
+        with self._lock, self.db:
+            self.db.executemany(self.UPSERT, values)
+        return len(values)
+
+    def start(self, job: Job):
+        now = time.time()
+        self._upsert([(*k, "running", 0, None, None, None, None, now) for k in self._keys(job)])
+
+    def retry(self, job: Job, kind: str, err_txt: str):
+        now = time.time()
+        self._upsert([(*k, "running", 1, err_txt, kind, None, None, now) for k in self._keys(job)])
+
+    def finish(self, job: Job, rows: List[Dict[str, Any]]):
+        """Estado final de las réplicas del trabajo según sus filas; sin filas (parada), vuelven a pending."""
+        by_rep = {r.get("replicate_index"): r for r in rows}
+        now = time.time()
+        values = []
+        for k in self._keys(job):
+            r = by_rep.get(k[1])
+            if r is None:
+                values.append((*k, "pending", 0, None, None, None, None, now))
+            elif "file_path" in r:
+                values.append((*k, "done", 1, None, None, r["file_path"], json.dumps(r, ensure_ascii=False), now))
+            else:
+                values.append((*k, "failed", 1, r.get("error"), r.get("error_kind"), None,
+                               json.dumps(r, ensure_ascii=False), now))
+        self._upsert(values)
+
+    def done_index(self, params_hash: str) -> set:
+        """{(prompt_id, réplica, huella prompt, huella parámetros)} ya generadas con estos parámetros."""
+        with self._lock:
+            return set(self.db.execute(
+                "SELECT prompt_id, replicate_index, prompt_hash, params_hash FROM replicates "
+                "WHERE status = 'done' AND params_hash = ?", (params_hash,)))
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+def ledger_status(path: str, limit: int = 20) -> Dict[str, Any]:
+    """Resumen de un ledger.sqlite (sólo lectura): réplicas por estado, reintentos y las que faltan."""
+    db = sqlite3.connect(f"file:{pathlib.Path(path).as_posix()}?mode=ro", uri=True)
+    try:
+        counts = dict(db.execute("SELECT status, COUNT(*) FROM replicates GROUP BY status").fetchall())
+        retries = db.execute("SELECT COALESCE(SUM(attempts - 1), 0) FROM replicates WHERE attempts > 1").fetchone()[0]
+        missing = db.execute(
+            "SELECT prompt_id, replicate_index, status, attempts, error_kind, error FROM replicates "
+            "WHERE status != 'done' ORDER BY updated DESC LIMIT ?", (limit,)).fetchall()
+    finally:
+        db.close()
+    return {"counts": {s: counts.get(s, 0) for s in LEDGER_STATES}, "retries": retries,
+            "missing": [dict(zip(("prompt_id", "replicate_index", "status", "attempts", "error_kind", "error"), m))
+                        for m in missing]}
+
+def print_ledger_status(provider: str, path: str):
+    if not os.path.exists(path):
+        print(f"{provider}: sin ledger ({path})")
+        return
+    st = ledger_status(path)
+    print(f"{provider}: " + ", ".join(f"{n} {s}" for s, n in st["counts"].items()) + f"; {st['retries']} reintentos")
+    for m in st["missing"]:
+        print(f"  {m['prompt_id']} rep{m['replicate_index']}: {m['status']}"
+              + (f" ({m['error_kind']}: {m['error']})" if m["error"] else ""))
+
+def open_ledger(out_root: str) -> JobLedger:
+    return JobLedger(os.path.join(out_root, "ledger.sqlite"), os.path.join(out_root, "manifest.jsonl"))
+
+def export_manifest(ledger_path: str, out_path: str) -> int:
+    """Escribe un manifiesto JSONL con la última fila de cada réplica del ledger (sin duplicados ni eventos)."""
+    db = sqlite3.connect(f"file:{pathlib.Path(ledger_path).as_posix()}?mode=ro", uri=True)
+    n = 0
+    try:
+        with open(out_path, "w", encoding="utf-8") as f:
+            for (row,) in db.execute("SELECT row FROM replicates WHERE row IS NOT NULL ORDER BY rowid"):
+                f.write(row + "\n")
+                n += 1
+    finally:
+        db.close()
+    return n
+
+def iter_jobs(prompts, rc: RunConfig, out_root: str, log, batch_size: int = 1,
+              phash: str = "", done: Optional[set] = None, store: Optional[ObjectStore] = None,
+              cache: Optional[ResultCache] = None, ledger: Optional[JobLedger] = None,
+              params: Optional[Dict[str, Any]] = None):
+    """Genera los trabajos (prompt × réplica, o prompt × bloque de réplicas) en orden de envío."""
+    seq = 0
+    for idx, pr in enumerate(prompts, start=1):
+        prompt_id = pr.get("id") or pr.get("prompt_id") or f"prompt{idx}"
+        prompt_text = (pr.get("prompt") or "").strip()
+        h = prompt_hash(prompt_text)
+        reps = list(range(1, rc.repeats + 1))
+        if done and prompt_text:
+            reps = [r for r in reps if (str(prompt_id), r, h, phash) not in done]
+            if not reps:
+                # count=0: todas las réplicas ya están en el manifiesto
+                yield Job(seq, idx, prompt_id, prompt_text, 0, True, "", 0, h, phash)
+                seq += 1
+                continue
+
+        log("")
+        log(f"Procesando prompt {idx}: {prompt_id}")
 
-    # -------- LOOP PRINCIPAL --------
-    USE_TQDM = sys.stdout.isatty()
-    iterator = (
-        tqdm(prompts, desc="Prompts", dynamic_ncols=True, leave=True)
-        if USE_TQDM
-        else prompts
-    )
+        if not prompt_text:
+            # prompt vacío: no se envía al pool, sólo ocupa su turno en el manifiesto
+            yield Job(seq, idx, prompt_id, "", 0, True, "")
+            seq += 1
+            continue
 
-    for idx, pr in enumerate(iterator, start=1):
-        prompt_id = pr.get("id") or pr.get("prompt_id") or f"prompt{idx}"
+        prompt_dir = os.path.join(out_root, safe_name(prompt_id))
+        ensure_dir(prompt_dir)
 
-        if USE_TQDM:
-            tqdm.write("")
-            tqdm.write(f"Procesando prompt {idx}/{len(prompts)}: {prompt_id}")
+        groups = replicate_groups(reps, batch_size)
+        for n, (rep, count) in enumerate(groups, start=1):
+            yield Job(seq, idx, prompt_id, prompt_text, rep, n == len(groups), prompt_dir, count, h, phash, store, cache,
+                      ledger, params)
+            seq += 1
+
+class OrderedRows:
+    """
+    Reorder buffer: los trabajos terminan en cualquier orden, pero sus filas se escriben
+    en el manifiesto en orden de envío. El primer error fatal activa `stop`.
+    """
+    def __init__(self, provider: str, manifest: ManifestWriter, stop: threading.Event, pbar=None,
+                 ledger: Optional[JobLedger] = None, on_prompt=None):
+        self.provider = provider
+        self.on_prompt = on_prompt
+        self.manifest = manifest
+        self.ledger = ledger
+        self.stop = stop
+        self.pbar = pbar
+        self.fatal: Optional[str] = None
+        self.skipped = 0
+        self._next_seq = 0
+        self._done: Dict[int, Any] = {}   # seq -> (job, rows, fatal)
+
+    def put(self, job: Job, rows: List[Dict[str, Any]], fatal: Optional[str] = None):
+        if job.count and job.prompt_text:
+            if self.ledger is not None:
+                self.ledger.finish(job, rows)  # el ledger no espera al orden de envío
+            if EVENTS is not None:
+                emit_rows(self.provider, rows)
+        self._done[job.seq] = (job, rows, fatal)
+        while self._next_seq in self._done:
+            job, rows, job_fatal = self._done.pop(self._next_seq)
+            if rows:
+                self.manifest.write(rows)
+            if job_fatal and self.fatal is None:
+                self.fatal = job_fatal
+                self.stop.set()
+            if self.pbar is not None and job.last_rep:
+                self.pbar.update(1)
+            self._next_seq += 1
+
+    def attempted(self, job: Job, fut=None):
+        """
+        Avisa a on_prompt de que el prompt del trabajo ya tiene resultado. Se llama al terminar
+        el trabajo (no al escribirlo en orden), así no depende de que el bucle siga recogiendo;
+        un trabajo cancelado antes de empezar no cuenta.
+        """
+        if self.on_prompt is not None and not (fut is not None and fut.cancelled()):
+            self.on_prompt(job.idx)
+
+    def settle_trivial(self, job: Job) -> bool:
+        """Resuelve sin llamar al proveedor los trabajos ya hechos (--resume) y los prompts vacíos."""
+        if job.count and job.prompt_text:
+            return False
+        self.attempted(job)
+        if job.count == 0:
+            self.skipped += 1
+            self.put(job, [])
         else:
-            print(f"\nProcesando prompt {idx}/{len(prompts)}: {prompt_id}")
-
-        prompt_text = (pr.get("prompt") or "").strip()
-        if not prompt_text:
-            write_jsonl(manifest_path, [{
+            self.put(job, [{
                 "timestamp": timestamp(),
-                "provider": args.provider,
+                "provider": self.provider,
                 "error": "Empty prompt",
-                "prompt_id": prompt_id,
+                "prompt_id": job.prompt_id,
                 "fatal": False
             }])
-            continue
+        return True
+
+def run_jobs_threaded(provider: str, pc: ProviderConfig, rc: RunConfig, client: ProviderClient,
+                      jobs, ordered: OrderedRows, stop: threading.Event, post: ThreadPoolExecutor):
+    """
+    Motor por hilos: un pool de rc.concurrency workers de red con como mucho 2×concurrency
+    peticiones en vuelo. Cada worker pasa la respuesta al pool de post-proceso y sigue con la
+    siguiente; el Future del post-proceso ocupa entonces el sitio del trabajo en pending.
+    """
+    pending: Dict[Any, Job] = {}      # future (red o post-proceso) -> job
+    posting = set()                   # futures de post-proceso en pending
+
+    def collect(block: bool):
+        if not pending:
+            return
+        # Espera en tramos cortos: así SIGTERM/SIGBREAK se atienden también en Windows
+        finished, _ = wait(pending, timeout=0.5 if block else 0, return_when=FIRST_COMPLETED)
+        for f in finished:
+            job = pending.pop(f)
+            posting.discard(f)
+            if f.cancelled():
+                ordered.put(job, [])
+                continue
+            res = f.result()
+            if isinstance(res, Future):
+                pending[res] = job
+                posting.add(res)
+            else:
+                ordered.put(job, *res)
+
+    max_in_flight = rc.concurrency * 2
+    max_posting = post_workers(rc) * 4  # acota los temporales a medio procesar si el disco no da abasto
+    pool = ThreadPoolExecutor(max_workers=rc.concurrency, thread_name_prefix="gen")
+    try:
+        for job in jobs:
+            if stop.is_set():
+                break
+            if ordered.settle_trivial(job):
+                continue
+            f = pool.submit(run_job, provider, pc, rc, job, client, stop, post)
+            f.add_done_callback(lambda f, job=job: ordered.attempted(job, f))
+            pending[f] = job
+            while (len(pending) - len(posting) >= max_in_flight or len(posting) >= max_posting) and not stop.is_set():
+                collect(block=True)
+            collect(block=False)
+
+        if stop.is_set():
+            for f in pending:
+                if f not in posting:  # el post-proceso termina: sus imágenes ya están generadas
+                    f.cancel()
+        while pending:
+            collect(block=True)
+    except BaseException:
+        # Interrupción (señal / Ctrl+C): no se esperan las peticiones en curso
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+async def run_jobs_async(provider: str, pc: ProviderConfig, rc: RunConfig, limiter: RateController,
+                         jobs, ordered: OrderedRows, stop: threading.Event, post: ThreadPoolExecutor,
+                         balancer: Optional[A1111Balancer] = None, checkpoints: Optional[Dict[str, str]] = None):
+    """
+    Motor asyncio: un único bucle de eventos con un semáforo de rc.concurrency peticiones
+    por proveedor. Escala a cientos de peticiones en vuelo sin un hilo por petición.
+    """
+    sem = asyncio.Semaphore(rc.concurrency)
+    pending: Dict[asyncio.Task, Job] = {}
+    max_in_flight = rc.concurrency * 2
+
+    async def collect():
+        finished, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for t in finished:
+            job = pending.pop(t)
+            if t.cancelled():
+                ordered.put(job, [])
+            else:
+                ordered.put(job, *t.result())
+
+    async with AsyncProviderClient(pool_size=rc.concurrency, limiter=limiter, balancer=balancer,
+                                   checkpoints=checkpoints) as client:
+        try:
+            while True:
+                # Fuera del bucle de eventos: en multi-proveedor el siguiente prompt puede esperar a
+                # la cola compartida, y mientras tanto las tareas en vuelo tienen que seguir
+                job = await asyncio.to_thread(next, jobs, None)
+                if job is None or stop.is_set():
+                    break
+                if ordered.settle_trivial(job):
+                    continue
+                t = asyncio.create_task(arun_job(provider, pc, rc, job, client, stop, sem, post))
+                t.add_done_callback(lambda t, job=job: ordered.attempted(job, t))
+                pending[t] = job
+                while len(pending) >= max_in_flight and not stop.is_set():
+                    await collect()
+
+            if stop.is_set():
+                for t in pending:
+                    t.cancel()
+            while pending:
+                await collect()
+        except BaseException:
+            stop.set()
+            for t in pending:
+                t.cancel()
+            raise
+
+def open_prompts(prompts_path: str, rc: RunConfig):
+    # Las filas se leen según se consumen: el primer trabajo sale sin esperar al CSV completo
+    prompts = iter_prompts_csv(prompts_path)
+    if rc.randomize_order:
+        prompts = shuffle_stream(prompts, rc.shuffle_buffer)
+    return prompts
+
+def process_batch(provider: str, pc: ProviderConfig, rc: RunConfig, client: ProviderClient,
+                  out_root: str, manifest: ManifestWriter, prompts_path: str, resume: bool = False,
+                  cache: Optional[ResultCache] = None, prompts=None, stop: Optional[threading.Event] = None,
+                  position: Optional[int] = None, ledger: Optional[JobLedger] = None, on_prompt=None) -> Optional[str]:
+    """
+    Ejecuta el lote de un proveedor. prompts (opcional) sustituye a la lectura de prompts_path:
+    en modo multi-proveedor es la cola de PromptFanout, y on_prompt(idx) le avisa de cada prompt
+    que ya tiene resultado. Con position (multi-proveedor), la barra de progreso y el log llevan
+    el nombre del proveedor. Devuelve el motivo del error fatal, si lo hubo.
+    """
+    # -------- CARGA DE PROMPTS --------
+    if prompts is None:
+        prompts = open_prompts(prompts_path, rc)
 
-        prompt_dir = os.path.join(out_root, safe_name(prompt_id))
-        ensure_dir(prompt_dir)
+    # -------- LOOP PRINCIPAL --------
+    USE_TQDM = sys.stdout.isatty()
+    pbar = tqdm_class()(desc=provider if position is not None else "Prompts", unit=" prompt", dynamic_ncols=True,
+                leave=True, position=position) if USE_TQDM else None
+    log = console if position is None else (lambda msg: console(f"[{provider}] {msg}" if msg else msg))
+
+    # Sólo A1111 agrupa réplicas: txt2img admite batch_size/n_iter para un mismo prompt
+    batch_size = max(1, int(pc.batch_size or 1)) if provider == "automatic1111" else 1
+
+    phash = params_hash(provider, pc, rc)
+    done = None
+    if resume and ledger is not None:
+        t0 = time.time()
+        done = ledger.done_index(phash)
+        log(f"Reanudando: {len(done)} réplicas ya generadas según el ledger ({time.time() - t0:.1f}s).")
+
+    def on_rate_event(ev: Dict[str, Any]):
+        manifest.write([{"timestamp": timestamp(), "provider": provider, **ev}])
+        rate = f"{ev['rate_rps']} req/s" if ev.get("rate_rps") else "sin límite"
+        if ev["event"] == "throttle":
+            log(f"Throttle ({ev['status']}): ritmo -> {rate}, pausa {ev['wait_seconds']}s")
+        else:
+            log(f"Ritmo recuperado: {rate}")
+
+    store = ObjectStore(os.path.join(out_root, "objects"), rc.dedup) if rc.dedup != "off" else None
+    if store is not None and rc.embed_metadata:
+        log("Dedup con embed_metadata: cada réplica lleva sus metadatos, así que sólo se comparten "
+            "ficheros idénticos. Para ahorrar espacio con semillas fijas, desactiva embed_metadata.")
+
+    stop = stop or threading.Event()
+    ordered = OrderedRows(provider, manifest, stop, pbar, ledger, on_prompt)
+    jobs = iter_jobs(prompts, rc, out_root, log, batch_size, phash, done, store, cache, ledger,
+                     generation_params(provider, pc, rc))
+    if EVENTS is not None:
+        jobs = announce_jobs(provider, rc, jobs)
+    # Post-proceso (disco, recodificación, miniaturas) en su propio pool: la red no espera al disco
+    post = ThreadPoolExecutor(max_workers=post_workers(rc), thread_name_prefix="post")
+    # El limitador es del proveedor y lo comparten los lotes en curso del servicio: un throttle
+    # frena a todos, así que cada lote lo anota en su propio manifiesto mientras corre
+    try:
+        with client.limiter.listen(on_rate_event):
+            if rc.engine == "async":
+                asyncio.run(run_jobs_async(provider, pc, rc, client.limiter, jobs, ordered, stop, post,
+                                           client.balancer, client.checkpoints))
+            else:
+                run_jobs_threaded(provider, pc, rc, client, jobs, ordered, stop, post)
+    finally:
+        post.shutdown(wait=True)
+
+    if pbar is not None:
+        pbar.close()
+    emit("provider_done", provider=provider, fatal=ordered.fatal)
+
+    # -------- ERRORES FATALES POR PROVEEDOR --------
+    if ordered.fatal:
+        manifest.write([{
+            "timestamp": timestamp(),
+            "provider": provider,
+            "error": ordered.fatal,
+            "fatal": True
+        }])
+        print(f"RuntimeError: {ordered.fatal}. Aborting batch.")
+        return ordered.fatal
+
+    if client.limiter.throttle_events:
+        rate = client.limiter.current_rps()
+        print(f"\nThrottles: {client.limiter.throttle_events} (ritmo final: {f'{rate} req/s' if rate else 'sin límite'})")
+    if client.balancer is not None:
+        print(f"\nNodos A1111: {client.balancer.summary()}")
+    if cache is not None:
+        total = cache.hits + cache.misses
+        print(f"\nCaché: {cache.hits} aciertos, {cache.misses} fallos"
+              f" ({100 * cache.hits / total if total else 0:.0f}% acierto), {cache.stored} nuevas, {cache.evicted} expulsadas")
+    if store is not None:
+        print(f"\nDedup ({store.mode}): {store.stored} imágenes nuevas, {store.deduped} duplicadas"
+              f" ({store.bytes_saved / 2**20:.1f} MB sin escribir)")
+    if resume:
+        print(f"\nPrompts ya completos (omitidos): {ordered.skipped}")
+    print("\nDone.")
+    print(f"Manifest: {manifest.path}")
+    return None
+
+# ---------- Multi-proveedor ----------
+FANOUT_MODES = ("all", "split")
+
+class PromptFanout:
+    """
+    Un único lector del CSV para varios proveedores. Cada fila va a todos ("all", para comparar
+    proveedores con el mismo orden de prompts) o a uno solo según su peso ("split", round-robin
+    ponderado suave). Cada proveedor consume de su cola, pequeña (buffer filas) para que el
+    reparto siga vivo. El reparto empieza cuando todos han validado (ready) o se han descartado
+    (close). En "split", si uno termina antes de tiempo (error fatal), las filas de su cola y las
+    que ya había tomado sin llegar a pedirlas (handled) pasan a los demás; por eso nadie da su
+    cola por terminada mientras otro pueda devolver filas.
+    """
+    def __init__(self, prompts, weights: Dict[str, float], mode: str = "all", buffer: int = 4):
+        self.prompts = prompts
+        self.mode = mode
+        self.weights = weights
+        self.buffer = max(1, buffer)
+        self.queues = {name: collections.deque() for name in weights}
+        self.taken: Dict[str, Dict[int, Any]] = {name: {} for name in weights}  # idx -> fila sin resultado
+        self.closed = set()
+        self.abort = threading.Event()
+        self.lost = 0
+        self.requeued = 0
+        self._current = {name: 0.0 for name in weights}
+        self._settled = set()
+        self._cv = threading.Condition()
+        self._orphans = collections.deque()
+        self._reading = True
+        self._thread: Optional[threading.Thread] = None
+
+    def _pick(self) -> Optional[str]:
+        with self._cv:
+            open_ = [n for n in self.weights if n not in self.closed]
+        if not open_:
+            return None
+        total = sum(self.weights[n] for n in open_)
+        for n in open_:
+            self._current[n] += self.weights[n]
+        best = max(open_, key=lambda n: self._current[n])
+        self._current[best] -= total
+        return best
+
+    def _put(self, name: str, row) -> bool:
+        with self._cv:
+            while not self.abort.is_set() and name not in self.closed:
+                if len(self.queues[name]) < self.buffer:
+                    self.queues[name].append(row)
+                    self._cv.notify_all()
+                    return True
+                self._cv.wait(0.5)
+        return False
+
+    def _send(self, row) -> bool:
+        if self.mode == "split":
+            while True:
+                name = self._pick()
+                if name is None:
+                    return False
+                if self._put(name, row):
+                    return True
+        return any([self._put(name, row) for name in self.queues])
+
+    def _send_orphans(self):
+        # La fila sale de _orphans sólo cuando ya está en otra cola: nadie la ve "en el aire"
+        while not self.abort.is_set():
+            with self._cv:
+                if not self._orphans:
+                    return
+                row = self._orphans[0]
+            if not self._send(row):
+                return
+            with self._cv:
+                self._orphans.popleft()
+                self._cv.notify_all()
+
+    def _feed(self):
+        with self._cv:
+            while len(self._settled) < len(self.queues) and not self.abort.is_set():
+                self._cv.wait(0.5)
+        try:
+            for row in self.prompts:
+                self._send_orphans()
+                if self.abort.is_set() or not self._send(row):
+                    break
+            with self._cv:
+                self._reading = False
+                self._cv.notify_all()
+            # CSV agotado: las filas que devuelva un proveedor se siguen repartiendo mientras quede otro
+            while not self.abort.is_set():
+                with self._cv:
+                    if len(self.closed) == len(self.queues):
+                        break
+                    if not self._orphans:
+                        self._cv.wait(0.5)
+                        continue
+                self._send_orphans()
+        finally:
+            with self._cv:
+                self._reading = False
+                self.lost += len(self._orphans)
+                self._orphans.clear()
+                self._cv.notify_all()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._feed, name="prompts", daemon=True)
+        self._thread.start()
+
+    def _finished(self, name: str) -> bool:
+        """Cola agotada de verdad (con _cv tomado): en "split", ningún otro proveedor puede devolver filas."""
+        if self._reading:
+            return False
+        if self.mode != "split":
+            return True
+        others = [n for n in self.queues if n != name and n not in self.closed]
+        return not self._orphans and not any(self.queues[n] or self.taken[n] for n in others)
+
+    def iter(self, name: str):
+        idx = 0
+        while True:
+            with self._cv:
+                while not self.queues[name]:
+                    if self.abort.is_set() or self._finished(name):
+                        return
+                    self._cv.wait(0.5)
+                row = self.queues[name].popleft()
+                idx += 1
+                if self.mode == "split":
+                    self.taken[name][idx] = row
+                self._cv.notify_all()
+            yield row
+
+    def handled(self, name: str, idx: int):
+        """El prompt idx (1-based, en el orden de iter) ya tiene resultado en este proveedor."""
+        with self._cv:
+            if self.taken[name].pop(idx, None) is not None:
+                self._cv.notify_all()
+
+    def ready(self, name: str):
+        with self._cv:
+            self._settled.add(name)
+            self._cv.notify_all()
+
+    def close(self, name: str):
+        with self._cv:
+            self.closed.add(name)
+            self._settled.add(name)
+            pending = list(self.taken[name].values()) + list(self.queues[name])
+            self.queues[name].clear()
+            self.taken[name].clear()
+            if self.mode == "split" and pending:
+                self._orphans.extend(pending)
+                self.requeued += len(pending)
+            self._cv.notify_all()
+        if self.mode == "split" and pending:
+            console(f"[{name}] {len(pending)} prompts pendientes pasan al resto de proveedores.")
+
+def provider_config(pconf: Dict[str, Any]) -> ProviderConfig:
+    api_base = pconf.get("api_base")
+    endpoints = [str(u).strip() for u in api_base if str(u).strip()] if isinstance(api_base, list) else None
+
+    return ProviderConfig(
+        model = pconf.get("model"),
+        api_key_env = pconf.get("api_key_env"),
+        engine = pconf.get("engine"),
+        api_base = endpoints[0] if endpoints else api_base,
+        endpoints = endpoints,
+        sampler_name = pconf.get("sampler_name"),
+        steps = pconf.get("steps"),
+        cfg_scale = pconf.get("cfg_scale"),
+        timeout_seconds = pconf.get("timeout_seconds", 900),
+        batch_size = pconf.get("batch_size"),
+        warmup = None if pconf.get("warmup") is None else bool(pconf["warmup"]),
+    )
 
-        for rep in range(rc.repeats):
-            t0 = time.time()
+def warmup_enabled(pc: ProviderConfig, rc: RunConfig) -> bool:
+    """
+    warmup sin fijar (null) calienta en los lotes, donde la primera imagen pagaría la carga del
+    modelo; no en una imagen suelta (Test imagen, --repeats 1), que la pagaría igual y dos veces.
+    """
+    return pc.warmup if pc.warmup is not None else rc.repeats > 1
+
+def connect_provider(provider: str, pc: ProviderConfig, rc: RunConfig) -> ProviderClient:
+    """Crea el cliente (pool HTTP, control de ritmo, balanceo A1111) y valida el proveedor; lanza si no valida."""
+    pc = replace(pc, warmup=warmup_enabled(pc, rc))
+    # delay_seconds es ahora el intervalo mínimo entre peticiones al proveedor (techo de ritmo)
+    max_rps = 1.0 / rc.delay_seconds if rc.delay_seconds > 0 else rc.max_rps
+    limiter = RateController(provider, max_rps=float(max_rps) if max_rps else None)
+
+    balancer = None
+    if provider == "automatic1111" and pc.endpoints and len(pc.endpoints) > 1:
+        balancer = A1111Balancer(pc.endpoints)
+
+    client = ProviderClient(pool_size=rc.concurrency, limiter=limiter, balancer=balancer)
+    try:
+        preflight = validate_provider(provider, pc, session=client.session, balancer=balancer)
+    except BaseException:
+        client.close()
+        raise
+    for info in preflight:
+        if pc.model:
+            client.checkpoints[info["endpoint"]] = info["checkpoint"]
+        if info["checkpoint_load_seconds"] is None and info["warmup_seconds"] is None:
+            continue  # checkpoint ya activo y sin calentamiento: nada que medir
+        client.warmup.append(dict({"timestamp": timestamp(), "provider": provider, "event": "warmup"}, **info))
+        steps = ([f"checkpoint {info['checkpoint']} cargado en {info['checkpoint_load_seconds']}s"]
+                 if info["checkpoint_load_seconds"] is not None else [])
+        steps += [f"calentamiento {info['warmup_seconds']}s"] if info["warmup_seconds"] is not None else []
+        console(f"Pre-vuelo {info['endpoint']}: {', '.join(steps)}")
+    if balancer is not None:
+        balancer.start()
+    return client
+
+def write_warmup(client: ProviderClient, manifest: ManifestWriter):
+    """Filas "event": "warmup" del pre-vuelo, una vez por cliente (en modo servicio el cliente se reutiliza)."""
+    rows, client.warmup = client.warmup, []
+    if rows:
+        manifest.write(rows)
+
+def run_provider(provider: str, pc: ProviderConfig, rc: RunConfig, prompts_path: str, resume: bool = False,
+                 prompts=None, stop: Optional[threading.Event] = None, position: Optional[int] = None,
+                 on_ready=None, client: Optional[ProviderClient] = None, manifest: Optional[ManifestWriter] = None,
+                 ledger: Optional[JobLedger] = None, on_prompt=None):
+    """
+    Validación, clientes y lote completo de un proveedor, con su propio manifiesto y ledger.
+    client/manifest/ledger (opcionales) reutilizan los ya abiertos y validados (modo servicio).
+    """
+    out_root = os.path.join(resolve_out_dir(rc.out_dir), provider)
+    ensure_dir(out_root)
+    manifest_path = os.path.join(out_root, "manifest.jsonl")
+
+    with contextlib.ExitStack() as stack:
+        if manifest is None:
+            manifest = stack.enter_context(ManifestWriter(manifest_path))
+        if client is None:
+            # -------- VALIDACIÓN PREVIA (FAIL FAST) --------
             try:
-                if args.provider == "openai":
-                    api_key = os.getenv(pc.api_key_env or "OPENAI_API_KEY")
-                    if not api_key:
-                        raise RuntimeError("Missing OPENAI_API_KEY env var.")
-
-                    out = gen_openai(
-                        prompt_text,
-                        rc.size,
-                        pc.model or "gpt-image-1",
-                        api_key
-                    )
-
-                elif args.provider == "stability":
-                    api_key = os.getenv(pc.api_key_env or "STABILITY_API_KEY")
-                    if not api_key:
-                        raise RuntimeError("Missing STABILITY_API_KEY env var.")
-
-                    out = gen_stability(
-                        prompt_text,
-                        rc.size,
-                        pc.engine or "sd3",
-                        pc.api_base or "https://api.stability.ai",
-                        api_key,
-                        seed=rc.seed
-                    )
-
-                else:  # automatic1111
-                    out = gen_automatic1111(
-                        prompt_text,
-                        rc.size,
-                        pc.api_base or "http://127.0.0.1:7860",
-                        pc.sampler_name or "DPM++ 2M Karras",
-                        int(pc.steps or 30),
-                        float(pc.cfg_scale or 6.5),
-                        rc.seed if rc.seed is not None else -1,
-                        pc.timeout_seconds or 900
-                    )
-
-                img_bytes = out["image_bytes"]
-                img_hash = sha256_bytes(img_bytes)[:16]
-                fname = f"{safe_name(prompt_id)}_rep{rep+1}_{img_hash}.png"
-                fpath = os.path.join(prompt_dir, fname)
-                save_image_bytes(img_bytes, fpath)
-
-                write_jsonl(manifest_path, [{
+                client = stack.enter_context(connect_provider(provider, pc, rc))
+            except Exception as e:
+                manifest.write([{
                     "timestamp": timestamp(),
-                    "provider": args.provider,
-                    "prompt_id": prompt_id,
-                    "replicate_index": rep + 1,
-                    "sha256_16": img_hash,
-                    "file_path": fpath,
-                    "latency_seconds": round(time.time() - t0, 3),
+                    "provider": provider,
+                    "error": str(e),
+                    "fatal": True
                 }])
+                print(f"\nError{f' ({provider})' if position is not None else ''}: {e}")
+                print(f"Manifest: {manifest_path}")
+                return
+        write_warmup(client, manifest)
+        if on_ready is not None:
+            on_ready()
+        if ledger is None:
+            ledger = stack.enter_context(contextlib.closing(open_ledger(out_root)))
+
+        cache = None
+        if rc.result_cache:
+            # Sólo es determinista con semilla fija; OpenAI no admite seed
+            if provider == "openai" or rc.seed is None or int(rc.seed) < 0:
+                print("Caché de resultados desactivada: requiere seed fija (>= 0) y automatic1111/stability.")
+            else:
+                cache = stack.enter_context(contextlib.closing(
+                    ResultCache(os.path.join(resolve_out_dir(rc.out_dir), ".cache"), rc.result_cache_max_mb * 1024 * 1024)))
+        return process_batch(provider, pc, rc, client, out_root, manifest, prompts_path, resume=resume,
+                             cache=cache, prompts=prompts, stop=stop, position=position, ledger=ledger,
+                             on_prompt=on_prompt)
+
+def run_fanout(providers: List[str], pcs: Dict[str, ProviderConfig], rcs: Dict[str, RunConfig],
+               prompts_path: str, mode: str, weights: Dict[str, float], resume: bool = False):
+    """
+    Varios proveedores en una sola ejecución: un lector de prompts compartido (PromptFanout) y un
+    hilo por proveedor, cada uno con su concurrencia, su control de ritmo y su manifiesto.
+    """
+    rc0 = rcs[providers[0]]
+    fanout = PromptFanout(open_prompts(prompts_path, rc0), {p: weights[p] for p in providers}, mode,
+                          buffer=max(rcs[p].concurrency for p in providers))
+    stops = {p: threading.Event() for p in providers}
+    errors: Dict[str, BaseException] = {}
+
+    def worker(provider: str, position: int):
+        try:
+            run_provider(provider, pcs[provider], rcs[provider], prompts_path, resume=resume,
+                         prompts=fanout.iter(provider), stop=stops[provider], position=position,
+                         on_ready=lambda: fanout.ready(provider),
+                         on_prompt=lambda idx: fanout.handled(provider, idx))
+        except BaseException as e:
+            errors[provider] = e
+            console(f"[{provider}] {type(e).__name__}: {e}")
+        finally:
+            fanout.close(provider)
+
+    t0 = time.time()
+    threads = [threading.Thread(target=worker, args=(p, i), name=f"provider-{p}") for i, p in enumerate(providers)]
+    fanout.start()
+    for t in threads:
+        t.start()
+    try:
+        # join por tramos: así SIGTERM/SIGBREAK (SystemExit) llegan al hilo principal
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+    except BaseException:
+        fanout.abort.set()
+        for ev in stops.values():
+            ev.set()
+        for t in threads:
+            t.join(10)
+        raise
+    print(f"\nMulti-proveedor ({mode}): {', '.join(providers)} en {time.time() - t0:.1f}s"
+          + (f"; fallaron: {', '.join(errors)}" if errors else ""))
+    if fanout.lost:
+        print(f"Prompts sin procesar (ningún proveedor quedó para recibirlos): {fanout.lost}")
+
+def load_config(path: str) -> Dict[str, Any]:
+    if yaml is None:
+        raise RuntimeError("YAML support not available. Please install pyyaml.")
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
+
+def run_config(run: Dict[str, Any], out: Optional[str] = None, repeats: Optional[int] = None,
+               size: Optional[str] = None, concurrency: Optional[int] = None, engine: Optional[str] = None,
+               dedup: Optional[str] = None, result_cache: Optional[bool] = None, output_format: Optional[str] = None,
+               output_quality: Optional[int] = None, thumbnail_px: Optional[int] = None) -> RunConfig:
+    """RunConfig de la sección default de config.yaml; los argumentos no nulos mandan sobre ella."""
+    return RunConfig(
+        out_dir = out if out is not None else run.get("out_dir", "out"),
+        repeats = repeats or int(run.get("repeats", 3)),
+        size = size or run.get("size", "1024x1024"),
+        temperature = run.get("temperature", None),
+        randomize_order = bool(run.get("randomize_order", True)),
+        shuffle_buffer = max(1, int(run.get("shuffle_buffer", 10000))),
+        concurrency = max(1, concurrency or int(run.get("concurrency", 1))),
+        engine = engine or run.get("engine", "threads"),
+        delay_seconds = float(run.get("delay_seconds", 0)),
+        max_rps = run.get("max_rps", None),
+        max_retries = max(0, int(run.get("max_retries", 3))),
+        dedup = dedup or run.get("dedup") or "off",
+        result_cache = result_cache if result_cache is not None else bool(run.get("result_cache", False)),
+        result_cache_max_mb = int(run.get("result_cache_max_mb", 10240)),
+        seed = run.get("seed", None),
+        post_workers = max(0, int(run.get("post_workers", 0))),
+        output_format = output_format or run.get("output_format") or "png",
+        output_quality = max(0, min(100, int(output_quality if output_quality is not None else run.get("output_quality", 90)))),
+        output_lossless = bool(run.get("output_lossless", False)),
+        embed_metadata = bool(run.get("embed_metadata", True)),
+        png_compress_level = None if run.get("png_compress_level") is None else max(0, min(9, int(run["png_compress_level"]))),
+        thumbnail_px = max(0, thumbnail_px if thumbnail_px is not None else int(run.get("thumbnail_px", 0))),
+    )
 
+def provider_run_config(rc: RunConfig, pconf: Dict[str, Any], concurrency: Optional[int] = None) -> RunConfig:
+    # concurrency por proveedor (providers.<name>.concurrency); --concurrency manda sobre ambas
+    conc = concurrency or pconf.get("concurrency")
+    return replace(rc, concurrency=max(1, int(conc))) if conc else rc
+
+# ---------- Servicio (--serve) ----------
+DAEMON_PORT = 7870
+SERVICE_TOKEN_HEADER = "X-Batchkit-Token"
+SERVICE_TOKEN_FILE = "token"   # en <out_dir>/.daemon/, junto a la cola
+
+def service_token_path(out_dir: str) -> str:
+    return os.path.join(resolve_out_dir(out_dir), ".daemon", SERVICE_TOKEN_FILE)
+
+def inside(path: str, roots: List[str]) -> bool:
+    real = os.path.realpath(path)
+    for root in roots:
+        root = os.path.realpath(root)
+        try:
+            if os.path.commonpath([real, root]) == root:
+                return True
+        except ValueError:
+            pass  # otra unidad (Windows)
+    return False
+PROVIDERS = ("openai", "stability", "automatic1111")
+JOB_FINAL = ("done", "failed", "cancelled")
+
+class JobQueue:
+    """
+    Cola persistente del servicio (SQLite): los trabajos sobreviven a un reinicio. Dos carriles:
+    "image" (imágenes sueltas, que no esperan detrás de un lote) y "batch" (lotes CSV).
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            lane TEXT NOT NULL,
+            status TEXT NOT NULL,
+            request TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            created REAL NOT NULL,
+            started REAL,
+            finished REAL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_lane_status ON jobs(lane, status, id);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        ensure_dir(os.path.dirname(path))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+        self.cv = threading.Condition()
+        # Lo que estaba en curso al parar el servicio vuelve a la cola
+        running = [r[0] for r in self.db.execute("SELECT id FROM jobs WHERE status = 'running'")]
+        for job_id in running:
+            self.requeue(job_id)
+        self.requeued = len(running)
+
+    @staticmethod
+    def _row(r) -> Dict[str, Any]:
+        keys = ("id", "lane", "status", "request", "result", "error", "created", "started", "finished")
+        d = dict(zip(keys, r))
+        for k in ("request", "result"):
+            d[k] = json.loads(d[k]) if d[k] else None
+        return d
+
+    def submit(self, lane: str, request: Dict[str, Any]) -> int:
+        with self.cv:
+            with self.db:
+                cur = self.db.execute("INSERT INTO jobs (lane, status, request, created) VALUES (?, 'queued', ?, ?)",
+                                      (lane, json.dumps(request, ensure_ascii=False), time.time()))
+            self.cv.notify_all()
+            return cur.lastrowid
+
+    def claim(self, lane: str, timeout: float):
+        """Pasa a running el trabajo más antiguo del carril; espera hasta timeout si no hay ninguno."""
+        with self.cv:
+            deadline = time.time() + timeout
+            while True:
+                r = self.db.execute("SELECT id, request FROM jobs WHERE lane = ? AND status = 'queued' ORDER BY id LIMIT 1",
+                                    (lane,)).fetchone()
+                if r:
+                    with self.db:
+                        self.db.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), r[0]))
+                    return r[0], json.loads(r[1])
+                left = deadline - time.time()
+                if left <= 0 or not self.cv.wait(left):
+                    return None
+
+    def finish(self, job_id: int, status: str, result=None, error: Optional[str] = None):
+        with self.cv:
+            with self.db:
+                self.db.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ?",
+                                (status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                                 error, time.time() if status in JOB_FINAL else None, job_id))
+            self.cv.notify_all()
+
+    def requeue(self, job_id: int):
+        """Devuelve un trabajo a la cola; al volver a ejecutarse, un lote se reanuda (--resume)."""
+        with self.cv:
+            r = self.db.execute("SELECT request FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            request = dict(json.loads(r[0]), resume=True)
+            with self.db:
+                self.db.execute("UPDATE jobs SET status = 'queued', request = ?, started = NULL WHERE id = ?",
+                                (json.dumps(request, ensure_ascii=False), job_id))
+            self.cv.notify_all()
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self.cv:
+            r = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(r) if r else None
+
+    def list(self, limit: int = 50) -> List[Dict[str, Any]]:
+        with self.cv:
+            rows = self.db.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [self._row(r) for r in rows]
+
+    def cancel(self, job_id: int) -> Optional[str]:
+        """Cancela un trabajo en cola. Devuelve el estado que tenía (running: lo para el servicio)."""
+        with self.cv:
+            r = self.db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if r and r[0] == "queued":
+                with self.db:
+                    self.db.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?", (time.time(), job_id))
+                self.cv.notify_all()
+        return r[0] if r else None
+
+    def wait(self, job_id: int, timeout: float) -> Optional[Dict[str, Any]]:
+        deadline = time.time() + timeout
+        with self.cv:
+            while True:
+                job = self.get(job_id)
+                left = deadline - time.time()
+                if job is None or job["status"] in JOB_FINAL or left <= 0:
+                    return job
+                self.cv.wait(left)
+
+    def close(self):
+        with self.cv:
+            self.db.close()
+
+class GeneratorService:
+    """
+    generator.py --serve: mantiene calientes los clientes de cada proveedor (pool HTTP, cliente
+    OpenAI, control de ritmo y validación ya hecha) y ejecuta los trabajos de la cola persistente,
+    un carril para imágenes sueltas y otro para lotes. config.yaml se relee en cada trabajo; un
+    proveedor se reconecta si cambia su sección o la concurrencia/ritmo.
+    """
+    def __init__(self, config_path: str, out: Optional[str] = None):
+        self.config_path = config_path
+        self.out = out
+        run = load_config(config_path).get("default", {})
+        out_dir = self.out_dir = resolve_out_dir(out if out is not None else run.get("out_dir", "out"))
+        self.queue = JobQueue(os.path.join(out_dir, ".daemon", "queue.sqlite"))
+        # Token por arranque: sólo quien puede leer <out_dir>/.daemon/token (la GUI) manda trabajos
+        self.token = secrets.token_urlsafe(32)
+        token_path = service_token_path(out_dir)
+        with open(os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w", encoding="utf-8") as f:
+            f.write(self.token)
+        self.closing = threading.Event()
+        self._lock = threading.Lock()
+        self._clients: Dict[str, Any] = {}      # provider -> (huella de config, ProviderClient)
+        self._retired: List[ProviderClient] = []
+        self._manifests: Dict[str, ManifestWriter] = {}
+        self._ledgers: Dict[str, JobLedger] = {}
+        self._stops: Dict[int, threading.Event] = {}
+        self._cancelled = set()
+        self._threads: List[threading.Thread] = []
+
+    def check_paths(self, req: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Rutas de la petición resueltas y confinadas: out dentro del out_dir del servicio, prompts
+        dentro del proyecto o del out_dir. Lanza ValueError si se salen.
+        """
+        req = dict(req)
+        if req.get("out") is not None:
+            out = resolve_out_dir(str(req["out"]))
+            if not inside(out, [self.out_dir]):
+                raise ValueError(f"out must be inside {self.out_dir}")
+            req["out"] = out
+        if req.get("prompts") is not None:
+            prompts = os.path.realpath(str(req["prompts"]))
+            if not inside(prompts, [str(PROJECT_ROOT), self.out_dir]):
+                raise ValueError(f"prompts must be inside {PROJECT_ROOT} or {self.out_dir}")
+            req["prompts"] = prompts
+        return req
+
+    def _configs(self, req: Dict[str, Any]):
+        req = self.check_paths(req)
+        cfg = load_config(self.config_path)
+        provider = req["provider"]
+        pconf = (cfg.get("providers") or {}).get(provider, {})
+        rc = run_config(cfg.get("default", {}), out=req.get("out", self.out), repeats=req.get("repeats"),
+                        size=req.get("size"), concurrency=req.get("concurrency"), engine=req.get("engine"),
+                        dedup=req.get("dedup"), result_cache=req.get("result_cache"),
+                        output_format=req.get("output_format"), output_quality=req.get("output_quality"),
+                        thumbnail_px=req.get("thumbnail_px"))
+        if rc.output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Invalid output format: {rc.output_format}")
+        return provider, provider_config(pconf), provider_run_config(rc, pconf, req.get("concurrency")), pconf
+
+    def _client(self, provider: str, pc: ProviderConfig, rc: RunConfig, pconf: Dict[str, Any]) -> ProviderClient:
+        key = json.dumps([pconf, rc.concurrency, rc.delay_seconds, rc.max_rps], sort_keys=True, default=str)
+        with self._lock:
+            cur = self._clients.get(provider)
+            if cur and cur[0] == key:
+                return cur[1]
+        client = connect_provider(provider, pc, rc)  # valida; lanza si el proveedor no está disponible
+        with self._lock:
+            old = self._clients.get(provider)
+            self._clients[provider] = (key, client)
+            if old:
+                self._retired.append(old[1])  # puede seguir en uso en el otro carril: se cierra al salir
+        console(f"[servicio] {provider}: cliente listo")
+        return client
+
+    def _outputs(self, rc: RunConfig, provider: str):
+        """Manifiesto y ledger de <out>/<provider>, abiertos una vez y compartidos entre trabajos."""
+        out_root = os.path.join(resolve_out_dir(rc.out_dir), provider)
+        ensure_dir(out_root)
+        with self._lock:
+            if out_root not in self._manifests:
+                self._manifests[out_root] = ManifestWriter(os.path.join(out_root, "manifest.jsonl"))
+                self._ledgers[out_root] = open_ledger(out_root)
+            return self._manifests[out_root], self._ledgers[out_root]
+
+    def run_image(self, job_id: int, req: Dict[str, Any], stop: threading.Event) -> Dict[str, Any]:
+        provider, pc, rc, pconf = self._configs(req)
+        rc = replace(rc, repeats=1, seed=req.get("seed", rc.seed))
+        prompt = (req.get("prompt") or "").strip()
+        if not prompt:
+            raise ValueError("Empty prompt")
+        client = self._client(provider, pc, rc, pconf)
+        manifest, ledger = self._outputs(rc, provider)
+        write_warmup(client, manifest)
+        prompt_id = str(req.get("id") or f"t{job_id}")
+        prompt_dir = os.path.join(os.path.dirname(manifest.path), safe_name(prompt_id))
+        ensure_dir(prompt_dir)
+        job = Job(0, 1, prompt_id, prompt, 1, True, prompt_dir, 1, prompt_hash(prompt), params_hash(provider, pc, rc),
+                  ledger=ledger, params=generation_params(provider, pc, rc))
+        t0 = time.time()
+        rows, fatal = run_job(provider, pc, rc, job, client, stop)
+        ledger.finish(job, rows)
+        manifest.write(rows)
+        manifest.flush()
+        images = [r for r in rows if "file_path" in r]
+        if not images:
+            raise RuntimeError(fatal or (rows[0].get("error") if rows else "Interrupted"))
+        return {"file_path": images[0]["file_path"], "seconds": round(time.time() - t0, 3), "rows": rows}
+
+    def run_batch(self, job_id: int, req: Dict[str, Any], stop: threading.Event) -> Dict[str, Any]:
+        provider, pc, rc, pconf = self._configs(req)
+        prompts = self.check_paths(req).get("prompts")
+        if not prompts or not os.path.exists(prompts):
+            raise ValueError(f"Prompts CSV not found: {prompts}")
+        client = self._client(provider, pc, rc, pconf)
+        manifest, ledger = self._outputs(rc, provider)
+        fatal = run_provider(provider, pc, rc, prompts, resume=bool(req.get("resume")), stop=stop,
+                             client=client, manifest=manifest, ledger=ledger)
+        manifest.flush()
+        if fatal:
+            raise RuntimeError(fatal)
+        return {"manifest": manifest.path}
+
+    def _worker(self, lane: str):
+        run = self.run_image if lane == "image" else self.run_batch
+        while not self.closing.is_set():
+            item = self.queue.claim(lane, timeout=1.0)
+            if item is None:
+                continue
+            job_id, req = item
+            # Parada propia de cada trabajo (cancelación o cierre del servicio), en los dos carriles
+            stop = self._stops[job_id] = threading.Event()
+            if job_id in self._cancelled or self.closing.is_set():
+                stop.set()  # cancelado entre claim y este punto
+            console(f"[servicio] trabajo {job_id} ({lane}, {req.get('provider')})")
+            try:
+                result = run(job_id, req, stop)
+                if self.closing.is_set() and lane == "batch":
+                    # Parada del servicio a mitad de lote: vuelve a la cola y se reanuda al arrancar
+                    self.queue.requeue(job_id)
+                    continue
+                self.queue.finish(job_id, "cancelled" if job_id in self._cancelled else "done", result=result)
             except Exception as e:
-                err_txt = str(e)
-                err_l = err_txt.lower()
+                if job_id in self._cancelled:
+                    self.queue.finish(job_id, "cancelled", error=str(e) or repr(e))
+                    continue
+                self.queue.finish(job_id, "failed", error=str(e) or repr(e))
+                console(f"[servicio] trabajo {job_id} falló: {e}")
+            finally:
+                self._stops.pop(job_id, None)
+                self._cancelled.discard(job_id)
+
+    def cancel(self, job_id: int) -> Optional[str]:
+        status = self.queue.cancel(job_id)
+        if status == "running":
+            self._cancelled.add(job_id)
+            stop = self._stops.get(job_id)
+            if stop is not None:
+                stop.set()
+        return status
+
+    def start(self):
+        for lane in ("image", "batch"):
+            t = threading.Thread(target=self._worker, args=(lane,), name=f"service-{lane}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def close(self):
+        self.closing.set()
+        for ev in list(self._stops.values()):
+            ev.set()
+        for t in self._threads:
+            t.join(10)
+        with self._lock:
+            for m in self._manifests.values():
+                m.close()
+            for lg in self._ledgers.values():
+                lg.close()
+            for _, c in self._clients.values():
+                c.close()
+            for c in self._retired:
+                c.close()
+        self.queue.close()
+        try:
+            os.remove(service_token_path(self.out_dir))
+        except OSError:
+            pass
+
+class ServiceHandler:
+    """
+    Métodos del manejador HTTP (se combina con BaseHTTPRequestHandler en serve(), que es
+    quien importa http.server). API local del servicio (JSON):
+      GET  /health              estado y trabajos pendientes
+      POST /jobs                encola {"provider", "prompts": csv} (lote) o {"provider", "prompt"} (imagen)
+      POST /generate            {"provider", "prompt", ...}: encola la imagen y responde al terminar
+      GET  /jobs, /jobs/<id>    consulta
+      POST /jobs/<id>/cancel    cancela (en cola o en curso)
+    Salvo /health, todo exige la cabecera X-Batchkit-Token; los POST, Content-Type application/json
+    (una página web no puede mandarlo sin preflight CORS). Host debe ser 127.0.0.1/localhost.
+    """
+    protocol_version = "HTTP/1.1"
+    service: GeneratorService = None
+
+    def log_message(self, *_):
+        pass
+
+    def _json(self, code: int, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self) -> Dict[str, Any]:
+        n = int(self.headers.get("Content-Length") or 0)
+        data = json.loads(self.rfile.read(n) or b"{}") if n else {}
+        if not isinstance(data, dict):
+            raise ValueError("JSON object expected")
+        return data
+
+    def _request(self) -> Dict[str, Any]:
+        req = self._body()
+        if req.get("provider") not in PROVIDERS:
+            raise ValueError(f"provider must be one of {', '.join(PROVIDERS)}")
+        return self.service.check_paths(req)
+
+    def _denied(self, path: str, post: bool) -> bool:
+        """Responde 403/415 y devuelve True si la petición no viene de un cliente local autorizado."""
+        port = self.server.server_address[1]
+        if self.headers.get("Host") not in (f"127.0.0.1:{port}", f"localhost:{port}"):
+            code, error = 403, "forbidden host"
+        elif path == "/health":
+            return False
+        elif not hmac.compare_digest(self.headers.get(SERVICE_TOKEN_HEADER, ""), self.service.token):
+            code, error = 403, f"missing or invalid {SERVICE_TOKEN_HEADER}"
+        elif post and self.headers.get_content_type() != "application/json":
+            code, error = 415, "Content-Type must be application/json"
+        else:
+            return False
+        self.close_connection = True  # el cuerpo queda sin leer
+        self._json(code, {"error": error})
+        return True
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if self._denied(path, post=False):
+            return
+        q = self.service.queue
+        if path == "/health":
+            with q.cv:
+                pending = q.db.execute("SELECT lane, status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') "
+                                       "GROUP BY lane, status").fetchall()
+            self._json(200, {"ok": True, "pid": os.getpid(), "pending": [list(r) for r in pending]})
+        elif path == "/jobs":
+            self._json(200, q.list())
+        elif re.fullmatch(r"/jobs/\d+", path):
+            job = q.get(int(path.rsplit("/", 1)[1]))
+            self._json(200 if job else 404, job or {"error": "not found"})
+        else:
+            self._json(404, {"error": "not found"})
 
-                write_jsonl(manifest_path, [{
-                    "timestamp": timestamp(),
-                    "provider": args.provider,
-                    "error": err_txt,
-                    "prompt_id": prompt_id,
-                    "replicate_index": rep + 1,
-                    "fatal": False
-                }])
+    def do_POST(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if self._denied(path, post=True):
+            return
+        try:
+            if path in ("/jobs", "/generate"):
+                req = self._request()
+                lane = "image" if (path == "/generate" or "prompt" in req) else "batch"
+                job_id = self.service.queue.submit(lane, req)
+                if path == "/jobs":
+                    return self._json(202, {"id": job_id, "lane": lane})
+                job = self.service.queue.wait(job_id, float(req.get("timeout", 900)))
+                return self._json(200 if job["status"] == "done" else 500, job)
+            m = re.fullmatch(r"/jobs/(\d+)/cancel", path)
+            if m:
+                status = self.service.cancel(int(m.group(1)))
+                return self._json(200 if status else 404, {"id": int(m.group(1)), "was": status})
+            self._json(404, {"error": "not found"})
+        except (ValueError, KeyError) as e:
+            self._json(400, {"error": str(e)})
+
+def serve(config_path: str, port: int = DAEMON_PORT, out: Optional[str] = None):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    service = GeneratorService(config_path, out)
+    handler = type("Handler", (ServiceHandler, BaseHTTPRequestHandler), {"service": service})
+    srv = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    srv.daemon_threads = True
+    service.start()
+    print(f"Servicio en http://127.0.0.1:{port} (cola: {service.queue.path}; "
+          f"{service.queue.requeued} trabajos reanudados)", flush=True)
+    try:
+        srv.serve_forever(poll_interval=0.5)
+    finally:
+        srv.server_close()
+        service.close()
+        print("Servicio detenido.", flush=True)
 
-                # -------- ERRORES FATALES POR PROVEEDOR --------
-
-                # STABILITY: créditos / pago
-                if args.provider == "stability":
-                    fatal_markers = (
-                        "sufficient credits",
-                        "lack sufficient credits",
-                        "payment_required",
-                        "purchase more credits",
-                        "402"
-                    )
-                    if any(m in err_l for m in fatal_markers):
-                        write_jsonl(manifest_path, [{
-                            "timestamp": timestamp(),
-                            "provider": args.provider,
-                            "error": "Stability API credits exhausted",
-                            "fatal": True
-                        }])
-                        print("RuntimeError: Stability API credits exhausted. Aborting batch.")
-                        return
+def main():
+    parser = argparse.ArgumentParser(description="Batch image generation")
+    parser.add_argument("--provider", nargs="+", choices=["openai","stability","automatic1111"],
+                        help="One provider, or several to run them in a single invocation (see --fanout)")
+    parser.add_argument("--fanout", choices=FANOUT_MODES, default=None,
+                        help="With several providers: send every prompt to all of them (all, default) or split "
+                             "the prompts between them by providers.<name>.weight (split)")
+    parser.add_argument("--config", default="config.yaml")
+    parser.add_argument("--prompts", default="prompts.csv")
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--repeats", type=int, default=None)
+    parser.add_argument("--size", default=None)
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument("--engine", choices=["threads", "async"], default=None,
+                        help="Execution engine: thread pool (default) or a single asyncio event loop")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip replicates already generated successfully according to the job ledger (ledger.sqlite)")
+    parser.add_argument("--dedup", choices=DEDUP_MODES, default=None,
+                        help="Content-addressed store under <out>/<provider>/objects/: per-prompt files become "
+                             "hardlinks, symlinks or manifest references")
+    parser.add_argument("--result-cache", action=argparse.BooleanOptionalAction, default=None,
+                        help="Reuse cached images for identical requests with a fixed seed (automatic1111/stability)")
+    parser.add_argument("--output-format", choices=list(OUTPUT_FORMATS), default=None,
+                        help="Stored image format: png (as returned, or recompressed with png_compress_level), "
+                             "webp (output_lossless for lossless), jpeg or avif")
+    parser.add_argument("--output-quality", type=int, default=None, help="Quality 0-100 for webp/jpeg/avif")
+    parser.add_argument("--thumbnail-px", type=int, default=None,
+                        help="Also write a JPEG thumbnail with this longest side under <prompt>/thumbs/ (0 = off)")
+    parser.add_argument("--dedup-report", action="store_true",
+                        help="Print a duplicate report for manifest.jsonl (and write dedup_report.json) and exit")
+    parser.add_argument("--status", action="store_true",
+                        help="Print per-replicate job state from ledger.sqlite (done, failed, pending...) and exit")
+    parser.add_argument("--export-manifest", metavar="PATH", default=None,
+                        help="Write the latest manifest row of every replicate in the ledger to PATH (JSONL) and exit")
+    parser.add_argument("--rebuild-manifest", metavar="PATH", nargs="?", const="", default=None,
+                        help="Rebuild the manifest from the metadata embedded in the images (default: manifest.jsonl "
+                             "if missing, else manifest.rebuilt.jsonl), mark those replicates done in the ledger and exit")
+    parser.add_argument("--image-info", metavar="IMAGE", nargs="+", default=None,
+                        help="Print the generation metadata embedded in IMAGE(s) (prompt, seed, params) and exit")
+    parser.add_argument("--events", metavar="HOST:PORT", default=None,
+                        help="Send progress events as JSON lines (queued, started, finished, failed...) to a local "
+                             "TCP listener, e.g. the GUI")
+    parser.add_argument("--serve", action="store_true",
+                        help="Run as a long-lived service: keeps provider clients warm and accepts jobs over local HTTP")
+    parser.add_argument("--port", type=int, default=None, help=f"Service port (default {DAEMON_PORT})")
+    args = parser.parse_args()
 
-                # OPENAI: cuota / billing / créditos
-                if args.provider == "openai":
-                    fatal_markers = (
-                        "insufficient_quota",
-                        "exceeded your current quota",
-                        "billing",
-                        "payment",
-                        "quota",
-                        "402"
-                    )
-                    if any(m in err_l for m in fatal_markers):
-                        write_jsonl(manifest_path, [{
-                            "timestamp": timestamp(),
-                            "provider": args.provider,
-                            "error": "OpenAI quota or billing limit reached",
-                            "fatal": True
-                        }])
-                        print("RuntimeError: OpenAI quota or billing limit reached. Aborting batch.")
-                        return
+    if args.image_info:
+        for path in args.image_info:
+            meta = read_image_metadata(path)
+            print(f"{path}: " + (json.dumps(meta, ensure_ascii=False, indent=2) if meta else "sin metadatos"))
+        return
 
-                # OPENAI: API key inválida / ausente
-                if args.provider == "openai" and (
-                    "invalid api key" in err_l
-                    or "incorrect api key" in err_l
-                    or "no api key" in err_l
-                    or "missing openai_api_key" in err_l
-                ):
-                    write_jsonl(manifest_path, [{
-                        "timestamp": timestamp(),
-                        "provider": args.provider,
-                        "error": "Invalid or missing OpenAI API key",
-                        "fatal": True
-                    }])
-                    print("RuntimeError: Invalid or missing OpenAI API key. Aborting batch.")
-                    return
+    cfg = load_config(args.config)
+    run = cfg.get("default", {})
+
+    if args.serve:
+        install_exit_signals()
+        serve(args.config, port=args.port or int(run.get("daemon_port", DAEMON_PORT)), out=args.out)
+        return
+    if not args.provider:
+        parser.error("--provider is required (unless --serve or --image-info)")
 
+    rc = run_config(run, out=args.out, repeats=args.repeats, size=args.size, concurrency=args.concurrency,
+                    engine=args.engine, dedup=args.dedup, result_cache=args.result_cache,
+                    output_format=args.output_format, output_quality=args.output_quality,
+                    thumbnail_px=args.thumbnail_px)
+
+    selected = list(dict.fromkeys(args.provider))  # sin repetidos, en el orden dado
+    providers = cfg.get("providers", {})
+    pcs, rcs, weights = {}, {}, {}
+    for name in selected:
+        pconf = providers.get(name, {})
+        pcs[name] = provider_config(pconf)
+        rcs[name] = provider_run_config(rc, pconf, args.concurrency)
+        weights[name] = float(pconf.get("weight", 1.0))
+
+    if args.dedup_report:
+        for name in selected:
+            out_root = os.path.join(resolve_out_dir(rc.out_dir), name)
+            manifest_path = os.path.join(out_root, "manifest.jsonl")
+            if not os.path.exists(manifest_path):
+                print(f"No manifest at {manifest_path}")
+                continue
+            report = dedup_report(manifest_path)
+            with open(os.path.join(out_root, "dedup_report.json"), "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            if len(selected) > 1:
+                print(f"\n[{name}]")
+            print_dedup_report(report)
+        return
+
+    if args.rebuild_manifest is not None:
+        for name in selected:
+            out_root = os.path.join(resolve_out_dir(rc.out_dir), name)
+            if not os.path.isdir(out_root):
+                print(f"No output folder at {out_root}")
+                continue
+            out_path = args.rebuild_manifest
+            if out_path and len(selected) > 1:
+                out_path = f"{out_path}.{name}"
+            elif not out_path:
+                out_path = os.path.join(out_root, "manifest.jsonl")
+                if os.path.exists(out_path):
+                    out_path = os.path.join(out_root, "manifest.rebuilt.jsonl")
+            t0 = time.time()
+            ledger = JobLedger(os.path.join(out_root, "ledger.sqlite"))
+            try:
+                n, missing = rebuild_manifest(out_root, out_path, ledger)
             finally:
-                if rc.delay_seconds:
-                    time.sleep(rc.delay_seconds)
+                ledger.close()
+            print(f"{name}: {n} filas -> {out_path} ({time.time() - t0:.1f}s)"
+                  + (f"; {missing} imágenes sin metadatos" if missing else ""))
+        return
 
-    print("\nDone.")
-    print(f"Manifest: {manifest_path}")
+    if args.status or args.export_manifest:
+        for name in selected:
+            ledger_path = os.path.join(resolve_out_dir(rc.out_dir), name, "ledger.sqlite")
+            if args.status:
+                print_ledger_status(name, ledger_path)
+            elif os.path.exists(ledger_path):
+                out_path = args.export_manifest if len(selected) == 1 else f"{args.export_manifest}.{name}"
+                print(f"{name}: {export_manifest(ledger_path, out_path)} filas -> {out_path}")
+            else:
+                print(f"No ledger at {ledger_path}")
+        return
+
+    if rc.dedup not in DEDUP_MODES:
+        raise RuntimeError(f"Invalid dedup mode: {rc.dedup} (expected one of {', '.join(DEDUP_MODES)})")
+    if rc.output_format not in OUTPUT_FORMATS:
+        raise RuntimeError(f"Invalid output format: {rc.output_format} (expected one of {', '.join(OUTPUT_FORMATS)})")
+
+    mode = args.fanout or run.get("fanout") or "all"
+    if mode not in FANOUT_MODES:
+        raise RuntimeError(f"Invalid fanout mode: {mode} (expected one of {', '.join(FANOUT_MODES)})")
+    if mode == "split" and any(w <= 0 for w in weights.values()):
+        raise RuntimeError("Provider weights must be positive in split mode")
+
+    install_exit_signals()
 
+    global EVENTS
+    if args.events:
+        try:
+            EVENTS = EventStream(args.events)
+        except (OSError, ValueError) as e:
+            print(f"No se pudo conectar el canal de eventos {args.events} ({e}); se sigue sin eventos.")
+        else:
+            emit_batch_total(args.prompts, rc.repeats, len(selected) if mode == "all" else 1)
+    try:
+        if len(selected) == 1:
+            run_provider(selected[0], pcs[selected[0]], rcs[selected[0]], args.prompts, resume=args.resume)
+        else:
+            run_fanout(selected, pcs, rcs, args.prompts, mode, weights, resume=args.resume)
+    finally:
+        if EVENTS is not None:
+            emit("done")
+            EVENTS.close()
 
 
 if __name__ == "__main__":
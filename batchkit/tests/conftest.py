@@ -0,0 +1,114 @@
+# Utilidades de los tests: servidor A1111 de pega en local y arranque de generator.py contra él.
+import base64, io, json, os, pathlib, socket, subprocess, sys, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+KIT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(KIT))
+
+
+def png_bytes(seed: int) -> bytes:
+    """PNG 8x8 que depende sólo de la semilla: misma semilla, mismos bytes (como A1111 con seed fija)."""
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), (seed * 37 % 256, seed * 91 % 256, seed * 13 % 256)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+class StubA1111(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests_seen = None  # lista de (path, payload) por servidor
+    gets_seen = None      # rutas GET recibidas
+    checkpoint = "m1.safetensors [abc]"
+    options_api = True    # False: nodo sin /sdapi/v1/options ni /sdapi/v1/sd-models
+    txt2img_status = None  # p. ej. 500: el txt2img falla siempre con ese estado
+
+    def log_message(self, *_):
+        pass
+
+    def _send(self, obj, code=200):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.gets_seen.append(self.path)
+        if self.path.startswith(("/sdapi/v1/sd-models", "/sdapi/v1/options")) and not self.options_api:
+            return self._send({"detail": "Not Found"}, 404)
+        if self.path.startswith("/sdapi/v1/sd-models"):
+            return self._send([{"title": self.checkpoint, "model_name": "m1", "hash": "abc"}])
+        if self.path.startswith("/sdapi/v1/options"):
+            return self._send({"sd_model_checkpoint": self.checkpoint})
+        self._send({"progress": 0, "state": {"job_count": 0}})
+
+    def do_POST(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(n) or b"{}") if n else {}
+        self.requests_seen.append((self.path, payload))
+        if not self.path.startswith("/sdapi/v1/txt2img"):
+            return self._send({})
+        if self.txt2img_status:
+            return self._send({"error": "stub failure"}, self.txt2img_status)
+        k = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+        seed = int(payload.get("seed", -1))
+        seeds = [seed + i if seed >= 0 else 1000 + len(self.requests_seen) * 10 + i for i in range(k)]
+        images = [base64.b64encode(png_bytes(s)).decode() for s in seeds]
+        self._send({"images": images, "info": json.dumps({"all_seeds": seeds, "seed": seeds[0]})})
+
+
+def start_stub(**attrs) -> ThreadingHTTPServer:
+    """
+    A1111 de pega en un puerto libre (attrs sobrescribe los de StubA1111). .base es su URL;
+    .requests_seen guarda los POST recibidos y .gets_seen las rutas GET.
+    """
+    handler = type("Handler", (StubA1111,), dict({"requests_seen": [], "gets_seen": []}, **attrs))
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    srv.base = f"http://127.0.0.1:{srv.server_address[1]}"
+    srv.requests_seen = handler.requests_seen
+    srv.gets_seen = handler.gets_seen
+    return srv
+
+
+def stop_stub(srv):
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def a1111():
+    srv = start_stub()
+    yield srv
+    stop_stub(srv)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(tmp_path, base: str, default=None, a1111=None) -> str:
+    """config.yaml mínimo (JSON es YAML válido) contra el stub."""
+    cfg = {"default": dict({"out_dir": str(tmp_path / "out"), "repeats": 1, "size": "8x8",
+                            "randomize_order": False}, **(default or {})),
+           "providers": {"automatic1111": dict({"api_base": base, "steps": 1}, **(a1111 or {}))}}
+    path = tmp_path / "config.yaml"
+    path.write_text(json.dumps(cfg), encoding="utf-8")
+    return str(path)
+
+
+def write_prompts(tmp_path, rows) -> str:
+    path = tmp_path / "prompts.csv"
+    path.write_text("id,prompt\n" + "".join(f"{i},{p}\n" for i, p in rows), encoding="utf-8")
+    return str(path)
+
+
+def run_generator(*args, timeout=120) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, "generator.py", *args], cwd=KIT, capture_output=True,
+                          text=True, timeout=timeout, env=dict(os.environ, PYTHONIOENCODING="utf-8"))
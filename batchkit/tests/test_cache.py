@@ -0,0 +1,38 @@
+# Caché de resultados compartida entre proveedores: un SQLite bloqueado es un fallo de caché, no un error.
+import sqlite3
+
+import generator
+from conftest import png_bytes
+
+
+class LockedWrites:
+    """Conexión que falla como SQLite con otro proceso escribiendo: lecturas sí, escrituras no."""
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, sql, *args):
+        if not sql.lstrip().upper().startswith("SELECT"):
+            raise sqlite3.OperationalError("database is locked")
+        return self.db.execute(sql, *args)
+
+    def __enter__(self):
+        return self.db.__enter__()
+
+    def __exit__(self, *exc):
+        return self.db.__exit__(*exc)
+
+
+def test_locked_cache_is_a_miss(tmp_path):
+    cache = generator.ResultCache(str(tmp_path / ".cache"), 1 << 20)
+    src = tmp_path / "src.png"
+    src.write_bytes(png_bytes(7))
+    work = tmp_path / "work"
+    work.mkdir()
+    cache.put("k", [dict(generator.stage_file(str(src), str(work)), seed=7)])
+    assert cache.get("k", str(work))["seeds"] == [7]
+
+    cache.db = LockedWrites(cache.db)
+    before = set(work.iterdir())
+    assert cache.get("k", str(work)) is None
+    assert set(work.iterdir()) == before  # sin temporales huérfanos
+    assert (cache.hits, cache.misses) == (1, 1)
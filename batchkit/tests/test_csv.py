@@ -0,0 +1,23 @@
+# CSV en streaming: la codificación se elige con una muestra, pero nunca se sustituyen bytes.
+import codecs
+
+import generator
+
+
+def test_cp1252_past_the_sample_is_decoded(tmp_path):
+    path = tmp_path / "prompts.csv"
+    ascii_rows = b"".join(b"%d;a cat, number %d\n" % (i, i) for i in range(5000))  # > 64 KB
+    path.write_bytes(b"id;prompt\n" + ascii_rows + "9999;niño en la montaña\n".encode("cp1252"))
+    assert generator.detect_csv_format(str(path)) == ("utf-8", ";")
+
+    rows = list(generator.iter_prompts_csv(str(path)))
+    assert len(rows) == 5001
+    assert [r["id"] for r in rows] == [str(i) for i in range(5000)] + ["9999"]
+    assert rows[-1]["prompt"] == "niño en la montaña"
+
+
+def test_utf8_bom_header(tmp_path):
+    path = tmp_path / "prompts.csv"
+    path.write_bytes(codecs.BOM_UTF8 + "id,prompt\n1,niño\n".encode("utf-8"))
+    assert list(generator.iter_prompts_csv(str(path))) == [{"id": "1", "prompt": "niño"}]
+
@@ -0,0 +1,25 @@
+# engine: async con varios proveedores: cada hilo de proveedor arranca su propio bucle a la vez.
+import subprocess, sys
+
+from conftest import KIT
+
+SCRIPT = """
+import threading, generator
+errors = []
+def run():
+    try:
+        generator.asyncio.run(generator.asyncio.sleep(0))
+    except Exception as e:
+        errors.append(repr(e))
+threads = [threading.Thread(target=run) for _ in range(8)]
+for t in threads: t.start()
+for t in threads: t.join()
+print(errors or "ok")
+"""
+
+
+def test_asyncio_from_several_provider_threads():
+    for _ in range(3):  # proceso nuevo cada vez: el fallo estaba en la primera carga del módulo
+        out = subprocess.run([sys.executable, "-c", SCRIPT], cwd=KIT, capture_output=True, text=True, timeout=60)
+        assert out.returncode == 0, out.stderr
+        assert out.stdout.strip() == "ok"
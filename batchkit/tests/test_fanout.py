@@ -0,0 +1,62 @@
+# --fanout split: si un proveedor se detiene, sus prompts pendientes pasan a los que siguen.
+import threading
+
+import generator
+
+
+def rows(n):
+    return [{"id": str(i), "prompt": f"p{i}"} for i in range(n)]
+
+
+def test_split_requeues_pending_rows_of_a_stopped_provider():
+    fanout = generator.PromptFanout(iter(rows(50)), {"a": 1.0, "b": 1.0}, "split", buffer=2)
+    got_b = []
+    b_started = threading.Event()
+
+    def provider_b():
+        fanout.ready("b")
+        for idx, row in enumerate(fanout.iter("b"), start=1):
+            b_started.set()
+            got_b.append(row["id"])
+            fanout.handled("b", idx)
+        fanout.close("b")
+
+    t = threading.Thread(target=provider_b)
+    t.start()
+    fanout.ready("a")
+    fanout.start()
+    it = fanout.iter("a")
+    first, second, third = next(it), next(it), next(it)
+    fanout.handled("a", 1)               # sólo el primero llegó a tener resultado
+    assert all(len(q) <= 2 for q in fanout.queues.values())
+    fanout.close("a")                    # error fatal: el resto de lo suyo vuelve al reparto
+    t.join(30)
+
+    assert not t.is_alive()
+    assert fanout.lost == 0
+    assert first["id"] not in got_b
+    assert {second["id"], third["id"]} <= set(got_b)
+    assert sorted(got_b + [first["id"]], key=int) == [str(i) for i in range(50)]
+
+
+def test_split_waits_for_a_provider_with_rows_in_flight():
+    fanout = generator.PromptFanout(iter(rows(2)), {"a": 1.0, "b": 1.0}, "split", buffer=1)
+    fanout.ready("a"), fanout.ready("b")
+    fanout.start()
+    a, b = fanout.iter("a"), fanout.iter("b")
+    row_a, row_b = next(a), next(b)
+    fanout.handled("b", 1)
+    got_b = [row_b["id"]]
+    done_b = threading.Event()
+
+    def drain_b():
+        for row in b:  # no termina mientras "a" pueda devolver su fila
+            got_b.append(row["id"])
+        done_b.set()
+
+    threading.Thread(target=drain_b, daemon=True).start()
+    assert not done_b.wait(1.0)
+    fanout.close("a")                    # "a" se detiene con su fila sin resultado
+    assert done_b.wait(10)
+    assert got_b == [row_b["id"], row_a["id"]]
+    assert fanout.requeued == 1 and fanout.lost == 0
@@ -0,0 +1,52 @@
+# Metadatos embebidos: cada réplica conserva los suyos, también con dedup, y el manifiesto se
+# puede reconstruir desde las imágenes.
+import json
+
+import generator
+
+from conftest import run_generator, write_config, write_prompts
+
+
+def read_rows(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_dedup_keeps_per_replicate_metadata_and_rebuilds(tmp_path, a1111):
+    # Semilla fija y un stub que sólo depende de la semilla: todas las réplicas salen iguales
+    cfg = write_config(tmp_path, a1111.base, default={"seed": 5, "repeats": 3}, a1111={"warmup": False})
+    prompts = write_prompts(tmp_path, [("p1", "a cat"), ("p2", "a dog")])
+    r = run_generator("--provider", "automatic1111", "--config", cfg, "--prompts", prompts, "--dedup", "hardlink")
+    assert r.returncode == 0, r.stdout + r.stderr
+
+    out_root = tmp_path / "out" / "automatic1111"
+    rows = [row for row in read_rows(out_root / "manifest.jsonl") if "file_path" in row]
+    assert len(rows) == 6
+    for row in rows:
+        meta = generator.read_image_metadata(row["file_path"])
+        assert (meta["prompt_id"], meta["replicate_index"]) == (row["prompt_id"], row["replicate_index"])
+        assert meta["prompt"] == {"p1": "a cat", "p2": "a dog"}[row["prompt_id"]]
+    for row in rows:
+        assert row["object_sha256"] == generator._file_sha256(row["file_path"])
+
+    rebuilt = tmp_path / "rebuilt.jsonl"
+    r = run_generator("--provider", "automatic1111", "--config", cfg, "--rebuild-manifest", str(rebuilt))
+    assert r.returncode == 0, r.stdout + r.stderr
+    got = {(row["prompt_id"], row["replicate_index"]): row["file_path"] for row in read_rows(rebuilt)}
+    assert got == {(row["prompt_id"], row["replicate_index"]): row["file_path"] for row in rows}
+
+
+def test_encode_failure_keeps_metadata_and_flags_row(tmp_path, monkeypatch):
+    from conftest import png_bytes
+
+    def broken(rc):
+        raise OSError("encoder missing")
+    monkeypatch.setattr(generator, "encode_options", broken)
+    rc = generator.RunConfig(output_format="webp")
+    job = generator.Job(0, 1, "p1", "a cat", 1, True, str(tmp_path), params_hash="h")
+    rows = generator.job_rows("automatic1111", job, {"images_bytes": [png_bytes(1)]}, 1.0, rc)
+
+    assert rows[0]["encode_error"] == "encoder missing"
+    assert "metadata_embedded" not in rows[0]
+    meta = generator.read_image_metadata(rows[0]["file_path"])
+    assert (meta["prompt_id"], meta["prompt"]) == ("p1", "a cat")
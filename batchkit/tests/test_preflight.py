@@ -0,0 +1,75 @@
+# Pre-vuelo de A1111: calentamiento por defecto en lotes, sólo si hay algo que hacer, una fila por nodo que calentó y checkpoint por nodo.
+import json
+
+from conftest import run_generator, start_stub, stop_stub, write_config, write_prompts
+
+
+def manifest_rows(tmp_path):
+    with open(tmp_path / "out" / "automatic1111" / "manifest.jsonl", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def txt2img(stub):
+    return [payload for path, payload in stub.requests_seen if path.startswith("/sdapi/v1/txt2img")]
+
+
+def test_no_preflight_by_default(tmp_path):
+    stub = start_stub(options_api=False)
+    try:
+        cfg = write_config(tmp_path, stub.base)
+        prompts = write_prompts(tmp_path, [("p1", "a cat")])
+        r = run_generator("--provider", "automatic1111", "--config", cfg, "--prompts", prompts)
+        assert r.returncode == 0, r.stdout + r.stderr
+        rows = manifest_rows(tmp_path)
+        assert [row.get("event") for row in rows if "event" in row] == []
+        assert len([row for row in rows if "file_path" in row]) == 1
+        assert not [p for p in stub.gets_seen if p.startswith("/sdapi/v1/options")]
+        assert len(txt2img(stub)) == 1
+    finally:
+        stop_stub(stub)
+
+
+def test_warmup_by_default_only_for_batches(tmp_path, a1111):
+    cfg = write_config(tmp_path, a1111.base, default={"repeats": 3})
+    prompts = write_prompts(tmp_path, [("p1", "a cat")])
+    r = run_generator("--provider", "automatic1111", "--config", cfg, "--prompts", prompts)
+    assert r.returncode == 0, r.stdout + r.stderr
+    assert [row.get("event") for row in manifest_rows(tmp_path) if "event" in row] == ["warmup"]
+    assert txt2img(a1111)[0]["prompt"] == "warmup"
+    assert len(txt2img(a1111)) == 4  # calentamiento + 3 réplicas
+
+    # Test imagen de la GUI: una sola réplica, sin calentamiento
+    sent = len(a1111.requests_seen)
+    r = run_generator("--provider", "automatic1111", "--config", cfg, "--prompts", prompts, "--repeats", "1",
+                      "--out", str(tmp_path / "test"))
+    assert r.returncode == 0, r.stdout + r.stderr
+    assert [payload["prompt"] for _, payload in a1111.requests_seen[sent:]] == ["a cat"]
+
+
+def test_warmup_row_only_when_it_ran(tmp_path, a1111):
+    cfg = write_config(tmp_path, a1111.base, a1111={"warmup": True})
+    prompts = write_prompts(tmp_path, [("p1", "a cat")])
+    r = run_generator("--provider", "automatic1111", "--config", cfg, "--prompts", prompts)
+    assert r.returncode == 0, r.stdout + r.stderr
+    warmups = [row for row in manifest_rows(tmp_path) if row.get("event") == "warmup"]
+    assert len(warmups) == 1 and warmups[0]["warmup_seconds"] is not None
+    assert len(txt2img(a1111)) == 2  # calentamiento + la imagen
+
+
+def test_checkpoint_is_pinned_per_node(tmp_path):
+    nodes = [start_stub(checkpoint="m1.safetensors [abc]"), start_stub(checkpoint="m1.safetensors [abc1234]")]
+    try:
+        cfg = write_config(tmp_path, [n.base for n in nodes], default={"repeats": 4, "concurrency": 2},
+                           a1111={"model": "m1", "warmup": False})
+        prompts = write_prompts(tmp_path, [("p1", "a cat"), ("p2", "a dog")])
+        r = run_generator("--provider", "automatic1111", "--config", cfg, "--prompts", prompts)
+        assert r.returncode == 0, r.stdout + r.stderr
+        # checkpoint activo en los dos y sin calentamiento: no hay filas de pre-vuelo
+        assert not [row for row in manifest_rows(tmp_path) if row.get("event") == "warmup"]
+        for node, title in zip(nodes, ("m1.safetensors [abc]", "m1.safetensors [abc1234]")):
+            sent = {p.get("override_settings", {}).get("sd_model_checkpoint") for p in txt2img(node)}
+            assert sent in (set(), {title})
+        assert sum(len(txt2img(n)) for n in nodes) == 8
+    finally:
+        for n in nodes:
+            stop_stub(n)
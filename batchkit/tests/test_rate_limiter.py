@@ -0,0 +1,16 @@
+# Limitador compartido (cliente cacheado del servicio): cada lote escucha sus eventos sin pisar a otro.
+import generator
+
+
+def test_listeners_are_per_job():
+    limiter = generator.RateController("automatic1111")
+    job_a, job_b = [], []
+    with limiter.listen(job_a.append):
+        with limiter.listen(job_b.append):
+            limiter._throttle(429, {"Retry-After": "0"})
+        limiter._throttle(503, {})
+    limiter._throttle(429, {})
+
+    assert [ev["status"] for ev in job_a] == [429, 503]
+    assert [ev["status"] for ev in job_b] == [429]
+    assert limiter.throttle_events == 3
@@ -0,0 +1,53 @@
+# Semilla fija: cada réplica tiene la suya (seed + réplica - 1), se pida sola o en batch.
+import json
+
+import pytest
+
+from conftest import run_generator, write_config, write_prompts
+
+
+def generated(tmp_path, out):
+    rows = []
+    with open(tmp_path / out / "automatic1111" / "manifest.jsonl", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            if "file_path" in row:
+                with open(row["file_path"], "rb") as img:
+                    row["content"] = img.read()
+                rows.append(row)
+    return {row["replicate_index"]: row for row in rows}
+
+
+@pytest.mark.parametrize("engine", ["threads", "async"])
+def test_fixed_seed_replicates_are_distinct_and_batch_neutral(tmp_path, a1111, engine):
+    prompts = write_prompts(tmp_path, [("p1", "a cat")])
+    by_batch = {}
+    for batch in (1, 2):
+        cfg = write_config(tmp_path, a1111.base, default={"seed": 5, "repeats": 3, "embed_metadata": False},
+                           a1111={"batch_size": batch, "warmup": False})
+        out = f"out{batch}"
+        r = run_generator("--provider", "automatic1111", "--config", cfg, "--prompts", prompts,
+                          "--out", str(tmp_path / out), "--engine", engine)
+        assert r.returncode == 0, r.stdout + r.stderr
+        by_batch[batch] = generated(tmp_path, out)
+
+    for rows in by_batch.values():
+        assert [rows[rep]["seed"] for rep in (1, 2, 3)] == [5, 6, 7]
+        assert len({rows[rep]["content"] for rep in (1, 2, 3)}) == 3
+    for rep in (1, 2, 3):
+        assert by_batch[1][rep]["content"] == by_batch[2][rep]["content"]
+
+
+def test_result_cache_serves_each_replicate_its_own_image(tmp_path, a1111):
+    cfg = write_config(tmp_path, a1111.base, default={"seed": 5, "repeats": 3, "embed_metadata": False,
+                                                      "result_cache": True}, a1111={"warmup": False})
+    prompts = write_prompts(tmp_path, [("p1", "a cat")])
+    runs = []
+    for _ in range(2):
+        r = run_generator("--provider", "automatic1111", "--config", cfg, "--prompts", prompts)
+        assert r.returncode == 0, r.stdout + r.stderr
+        runs.append(generated(tmp_path, "out"))  # la segunda pasada sobrescribe las réplicas en el dict
+    first, second = runs
+    assert all(second[rep].get("cache_hit") for rep in (1, 2, 3))
+    assert len({second[rep]["content"] for rep in (1, 2, 3)}) == 3
+    assert [second[rep]["seed"] for rep in (1, 2, 3)] == [5, 6, 7]
@@ -0,0 +1,103 @@
+# Modo servicio (--serve): sólo clientes locales con token; rutas de la petición confinadas.
+import json, os, subprocess, sys, time
+
+import pytest
+import requests
+
+from conftest import KIT, free_port, start_stub, stop_stub, write_config
+
+
+def start_service(tmp_path, stub, **default):
+    port = free_port()
+    cfg = write_config(tmp_path, stub.base, default=default, a1111={"warmup": False})
+    out = tmp_path / "out"
+    proc = subprocess.Popen([sys.executable, "generator.py", "--serve", "--config", cfg, "--port", str(port),
+                             "--out", str(out)], cwd=KIT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                if requests.get(f"{base}/health", timeout=1).ok:
+                    break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        token = (out / ".daemon" / "token").read_text(encoding="utf-8")
+        return proc, (base, token, out)
+    except BaseException:
+        proc.terminate()
+        raise
+
+
+@pytest.fixture
+def service(tmp_path, a1111):
+    proc, svc = start_service(tmp_path, a1111)
+    try:
+        yield svc
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+def generate(base, headers, body, **kw):
+    return requests.post(f"{base}/generate", headers=headers, timeout=60, **kw)
+
+
+def test_cross_origin_simple_post_is_rejected(service, tmp_path, a1111):
+    base, token, out = service
+    evil = tmp_path / "evil"
+    body = json.dumps({"provider": "automatic1111", "prompt": "x", "out": str(evil)})
+    # Lo que puede mandar una página web sin preflight: text/plain y sin token
+    r = generate(base, {"Content-Type": "text/plain"}, body, data=body)
+    assert r.status_code == 403
+    r = generate(base, {"Content-Type": "text/plain", "X-Batchkit-Token": token}, body, data=body)
+    assert r.status_code == 415
+    r = generate(base, {"Host": "evil.example", "X-Batchkit-Token": token}, body, json=json.loads(body))
+    assert r.status_code == 403
+    assert not evil.exists()
+    assert not [p for p, _ in a1111.requests_seen if p.startswith("/sdapi/v1/txt2img")]
+
+
+def test_paths_are_confined_to_out_dir_and_project(service, tmp_path):
+    base, token, out = service
+    headers = {"X-Batchkit-Token": token}
+    r = generate(base, headers, None, json={"provider": "automatic1111", "prompt": "x", "out": str(tmp_path / "evil")})
+    assert r.status_code == 400
+    r = requests.post(f"{base}/jobs", headers=headers, timeout=10,
+                      json={"provider": "automatic1111", "prompts": str(tmp_path / "p.csv")})
+    assert r.status_code == 400
+    assert not (tmp_path / "evil").exists()
+
+
+def test_authorized_request_generates_inside_out_dir(service):
+    base, token, out = service
+    r = generate(base, {"X-Batchkit-Token": token}, None,
+                 json={"provider": "automatic1111", "prompt": "x", "out": str(out / "test")})
+    assert r.status_code == 200, r.text
+    path = r.json()["result"]["file_path"]
+    assert os.path.commonpath([path, str(out)]) == str(out)
+    assert os.path.exists(path)
+
+
+def test_running_image_job_can_be_cancelled(tmp_path):
+    stub = start_stub(txt2img_status=500)  # error transitorio: reintentos con backoff creciente
+    proc, (base, token, out) = start_service(tmp_path, stub, max_retries=8)
+    try:
+        headers = {"X-Batchkit-Token": token}
+        r = requests.post(f"{base}/jobs", headers=headers, timeout=10, json={"provider": "automatic1111", "prompt": "x"})
+        job_id = r.json()["id"]
+        for _ in range(100):
+            if stub.requests_seen:
+                break
+            time.sleep(0.1)
+        r = requests.post(f"{base}/jobs/{job_id}/cancel", headers=headers, json={}, timeout=10)
+        assert r.json()["was"] == "running"
+        for _ in range(50):
+            job = requests.get(f"{base}/jobs/{job_id}", headers=headers, timeout=10).json()
+            if job["status"] != "running":
+                break
+            time.sleep(0.1)
+        assert job["status"] == "cancelled"
+    finally:
+        proc.terminate()
+        proc.wait(10)
+        stop_stub(stub)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# webui_console.py — consola visible de la WebUI lanzada desde la GUI
+#
+# Ejecuta webui-user.bat, muestra su salida en esta ventana tal cual (barras de progreso
+# incluidas) y la copia a un log que sigue la GUI (WebUIWatcher) para saber cuándo está lista.
+# La ventana no depende de la GUI: cerrar la GUI no bloquea ni mata la WebUI. Al terminar la
+# WebUI se escribe WEBUI_EXIT_MARKER en el log y la ventana queda abierta (como `cmd /k`).
+#
+# Uso: python webui_console.py <webui-user.bat> <log>
+import os, subprocess, sys
+
+WEBUI_EXIT_MARKER = b"[batchkit] WebUI exited with code"
+
+def main():
+    bat, log_path = sys.argv[1], sys.argv[2]
+    proc = subprocess.Popen(["cmd.exe", "/c", "call", bat], cwd=os.path.dirname(os.path.abspath(bat)),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            env={**os.environ, "PYTHONUNBUFFERED": "1"})
+    out = sys.stdout.buffer
+    with open(log_path, "wb") as log:
+        try:
+            # os.read devuelve lo que haya: los \r de tqdm se ven al momento, sin esperar al \n
+            while True:
+                chunk = os.read(proc.stdout.fileno(), 65536)
+                if not chunk:
+                    break
+                out.write(chunk); out.flush()
+                log.write(chunk); log.flush()
+        except KeyboardInterrupt:
+            pass  # Ctrl+C llega también a la WebUI (misma consola)
+        rc = proc.wait()
+        log.write(b"\n" + WEBUI_EXIT_MARKER + f" {rc}\n".encode())
+    print(f"\nWebUI terminada (código {rc}).")
+    try:
+        input("Pulsa Enter para cerrar esta ventana…")
+    except (EOFError, KeyboardInterrupt):
+        pass
+
+if __name__ == "__main__":
+    main()